@@ -0,0 +1 @@
+"""pytest configuration, makes the twitchoglc package importable from the checkout"""
@@ -66,6 +66,7 @@ if __name__ == "__main__":
                 'twitch-parse-bsp = twitchoglc.bsp:main',
                 'twitch-viewer = twitchoglc.viewer:main',
                 'twitch-downloader = twitchoglc.downloader:main',
+                'twitch-bench = twitchoglc.bench:main',
             ]
         },
         classifiers= [
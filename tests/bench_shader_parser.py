@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+'''Benchmark the shader-script lexer against the simpleparse grammar
+
+Parses synthetic shader corpora of increasing size (or the .shader files
+and the scripts in the .pk3 files named on the command line) with both
+shaderparser parsers, checking they produce the same productions.
+
+    python tests/bench_shader_parser.py [baseq3/pak0.pk3 scripts/x.shader ...]
+'''
+from __future__ import print_function
+import sys, time, random
+from twitchoglc import shaderparser, pk3
+
+STAGES = [
+    '\t{\n\t\tmap $lightmap\n\t\trgbGen identity\n\t}\n',
+    '\t{\n\t\tmap textures/%(name)s.tga\n\t\tblendFunc GL_DST_COLOR GL_ZERO\n\t\trgbGen identity\n\t}\n',
+    '\t{\n\t\tclampmap textures/%(name)s_glow.tga\n\t\tblendFunc GL_ONE GL_ONE\n\t\trgbGen wave sin 0.5 0.5 0 0.25\n\t\ttcMod rotate 30\n\t\ttcMod stretch sin .8 0.2 0 .3\n\t}\n',
+    '\t{\n\t\tanimMap 10 textures/%(name)s_1.tga textures/%(name)s_2.tga\n\t\ttcMod transform 0.25 0 0 0.25 0.1075 0.1075\n\t\talphaFunc GE128\n\t\tdepthWrite\n\t}\n',
+]
+HEADER = '''textures/%(name)s	// %(name)s
+{
+	qer_editorimage textures/%(name)s.tga
+	surfaceparm nomarks
+	q3map_surfacelight 400
+	deformVertexes wave 100 sin 3 0 0 0
+	fogparms ( 0.5 0.25 0.1 ) 256
+'''
+
+def synthetic_corpus( count, seed=1 ):
+    """Create shader script text with count shaders resembling base Q3 scripts"""
+    random.seed( seed )
+    chunks = []
+    for i in range( count ):
+        values = {'name':'bench_%s/shader_%s'%( i % 37, i )}
+        chunks.append( HEADER%values )
+        for stage in random.sample( STAGES, random.randint( 1, len(STAGES) ) ):
+            chunks.append( stage%values )
+        chunks.append( '}\n\n' )
+    return ''.join( chunks )
+
+def read_scripts( paths ):
+    """Read the .shader files in paths, including scripts/*.shader in archives"""
+    texts = []
+    for path in paths:
+        if pk3.is_archive( path ):
+            scripts = pk3.glob_path( pk3.join_path( path, 'scripts/*.shader' ) )
+        else:
+            scripts = [path]
+        for script in scripts:
+            with pk3.open_path( script ) as fh:
+                texts.append( fh.read().decode( 'latin-1' ).replace( '\r\n', '\n' ) )
+    return texts
+
+def timed( parser, texts ):
+    start = time.time()
+    result = [shaderparser.parse( text, parser ) for text in texts]
+    return time.time() - start, result
+
+def report( label, texts ):
+    lines = sum( [text.count( '\n' ) for text in texts] )
+    grammar_time, expected = timed( 'simpleparse', texts )
+    lexer_time, result = timed( 'lexer', texts )
+    assert result == expected, label
+    print( '%-24s %9d %14.4f %10.4f %7.1fx'%(
+        label, lines, grammar_time, lexer_time, grammar_time/max(lexer_time,1e-9),
+    ))
+
+def main():
+    print( '%-24s %9s %14s %10s %8s'%('corpus','lines','simpleparse (s)','lexer (s)','speedup') )
+    if sys.argv[1:]:
+        report( 'command line', read_scripts( sys.argv[1:] ) )
+        return
+    for count in (100,1000,5000,20000):
+        report( '%s shaders'%(count,), [synthetic_corpus( count )] )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+'''Benchmark the simple-face index builder against the original Python loop
+
+Generates synthetic face tables of increasing size and reports the time
+taken by bsp.simple_face_batches versus the per-face loop it replaced.
+'''
+from __future__ import print_function
+import numpy, time
+from twitchoglc import bsp
+
+def synthetic_faces( count, textures=200, lightmaps=64, seed=1 ):
+    """Create a face table and meshverts resembling a real map"""
+    random = numpy.random.RandomState( seed )
+    faces = numpy.zeros( (count,), numpy.dtype( bsp.FACE_RECORD ) )
+    faces['type'] = random.choice( [1,1,1,2,3], count )
+    faces['texture'] = random.randint( 0, textures, count )
+    faces['lm_index'] = random.randint( -1, lightmaps, count )
+    n_vertices = random.randint( 3, 12, count )
+    faces['n_vertices'] = n_vertices
+    faces['vertex'] = numpy.cumsum( n_vertices ) - n_vertices
+    faces['n_meshverts'] = (n_vertices - 2) * 3
+    faces['meshvert'] = numpy.cumsum( faces['n_meshverts'] ) - faces['n_meshverts']
+    meshverts = random.randint( 0, 3, numpy.sum( faces['n_meshverts'] ) ).astype( 'i' )
+    return faces, meshverts
+
+def loop_indices( faces, meshverts ):
+    """The original per-face loop (index buffer only)"""
+    simple_types = numpy.logical_or( faces['type'] == 1, faces['type'] == 3)
+    simple_faces = numpy.compress( simple_types, faces )
+    sortorder = numpy.lexsort( (simple_faces['lm_index'],simple_faces['texture'],) )
+    simple_faces = numpy.take( simple_faces, sortorder )
+    indices = numpy.zeros( (numpy.sum( simple_faces['n_meshverts'] ),), numpy.uint32 )
+    starts = simple_faces['meshvert']
+    stops = simple_faces['meshvert'] + simple_faces['n_meshverts']
+    current = 0
+    for start,stop,index in zip(starts,stops,simple_faces['vertex']):
+        end = current + (stop-start)
+        indices[current:end] = meshverts[start:stop] + index
+        current = end
+    return indices
+
+def timed( function, *args ):
+    start = time.time()
+    result = function( *args )
+    return time.time() - start, result
+
+def main():
+    print( '%8s %10s %10s %8s'%('faces','loop (s)','numpy (s)','speedup') )
+    for count in (1000,5000,20000,50000,100000):
+        faces, meshverts = synthetic_faces( count )
+        loop_time, expected = timed( loop_indices, faces, meshverts )
+        fast_time, (indices,texture_set,_,_,_) = timed( bsp.simple_face_batches, faces, meshverts )
+        assert numpy.array_equal( indices, expected )
+        assert texture_set[-1][2] == len(indices)
+        print( '%8d %10.4f %10.4f %7.1fx'%(
+            count, loop_time, fast_time, loop_time/max(fast_time,1e-9),
+        ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""CPU-side texture packing and layout (no GPU needed)"""
+from __future__ import absolute_import
+import numpy
+from twitchoglc import atlas, bsp
+
+def solid( width, height, value ):
+    return numpy.full( (height,width,4), value, dtype='B' )
+
+def test_pack_tiles( ):
+    tiles = numpy.arange( 5, dtype='B' )[:,None,None,None] * numpy.ones( (1,2,2,3), 'B' )
+    pages, tile_pages, offsets = atlas.pack_tiles( tiles, max_size=4 )
+    assert pages.shape == (2,4,4,3)
+    assert list( tile_pages ) == [0,0,0,0,1]
+    assert offsets.tolist() == [[0,0],[2,0],[0,2],[2,2],[0,0]]
+    assert pages[0,2,2,0] == 3
+    assert pages[1,0,0,0] == 4
+
+def test_shelf_pack( ):
+    pages, positions, page_sizes = atlas.shelf_pack( [(16,16),(8,8),(8,8),(64,8)], 32 )
+    assert page_sizes == [32,64]
+    assert list( pages ) == [0,0,0,1]
+    assert positions.tolist()[:3] == [[0,0],[16,0],[24,0]]
+    # the oversized rectangle's page doesn't start a new shelf page
+    pages, positions, page_sizes = atlas.shelf_pack( [(16,16),(64,8),(8,8)], 32 )
+    assert page_sizes == [32,64]
+    assert list( pages ) == [0,1,0]
+
+def test_arrays_grouped_by_size( ):
+    images = {
+        0: solid( 8, 8, 10 ),
+        1: solid( 16, 8, 20 ),
+        2: solid( 8, 8, 30 ),
+        4: solid( 8, 8, 40 ),
+    }
+    pack = atlas.TexturePack( 6, images, max_layers=2 )
+    assert pack.use_arrays
+    assert [group.shape for group in pack.groups] == [(2,8,8,4),(1,8,8,4),(1,8,16,4)]
+    assert list( pack.texture_group ) == [0,2,0,-1,1,-1]
+    assert list( pack.texture_layer[[0,2,4,1]] ) == [0,1,0,0]
+    assert pack.groups[0][1,0,0,0] == 30
+    assert pack.texture_rect[0].tolist() == [0,0,1,1]
+
+def test_atlas_fallback( ):
+    images = {
+        1: solid( 16, 16, 10 ),
+        3: solid( 8, 16, 20 ),
+    }
+    pack = atlas.TexturePack( 4, images, use_arrays=False, max_size=32 )
+    assert not pack.use_arrays
+    assert [group.shape for group in pack.groups] == [(1,32,32,4)]
+    assert list( pack.texture_group ) == [-1,0,-1,0]
+    assert pack.texture_rect[1].tolist() == [0,0,.5,.5]
+    assert pack.texture_rect[3].tolist() == [.5,0,.25,.5]
+    page = pack.groups[0][0]
+    assert page[15,15,0] == 10
+    assert page[15,16,0] == 20
+    assert page[0,24,0] == 0
+
+def test_vertex_data( ):
+    pack = atlas.TexturePack( 3, {0: solid( 8, 8, 1 ), 2: solid( 8, 8, 2 )} )
+    faces = numpy.zeros( (4,), dtype=bsp.FACE_RECORD )
+    faces['texture'] = [2,1,0,-1]
+    faces['vertex'] = [0,2,4,6]
+    faces['n_vertices'] = 2
+    data = pack.vertex_data( numpy.zeros( (8,), dtype=bsp.VERTEX_RECORD ), faces )
+    assert data.shape == (8,5)
+    assert data[:,0].tolist() == [1,1,0,0,0,0,0,0]
+    # unpacked (and invalid) textures keep the whole-texture rectangle
+    assert (data[:,1:] == [0,0,1,1]).all()
+
+def test_merge_batches( ):
+    texture_group = numpy.array( [0,-1,0,1], 'i' )
+    ranges = lambda *starts: (numpy.array( starts, 'i' ), numpy.full( (len(starts),), 3, 'i' ))
+    batches = [
+        (0,0) + ranges( 0 ),
+        (0,1) + ranges( 3 ),
+        (0,2) + ranges( 6, 9 ),
+        (1,2) + ranges( 15 ),
+        (0,3) + ranges( 18 ),
+        (0,5) + ranges( 21 ),
+    ]
+    packed, unpacked = atlas.merge_batches( batches, texture_group )
+    assert [batch[:2] for batch in unpacked] == [(0,1),(0,5)]
+    assert [batch[:2] for batch in packed] == [(0,0),(1,0),(0,1)]
+    lightmap, group, starts, counts = packed[0]
+    # texture 2's adjacent ranges are merged, texture 1's range separates them from 0's
+    assert starts.tolist() == [0,6]
+    assert counts.tolist() == [3,6]
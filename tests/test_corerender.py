@@ -0,0 +1,121 @@
+"""Render a synthetic map with the core (shader/VAO) backend offscreen
+
+Uses the benchmark's EGL (or, with PYOPENGL_PLATFORM=osmesa, OSMesa)
+context, skipped where no offscreen context can be created.
+"""
+from __future__ import absolute_import
+import os
+import numpy
+import pytest
+from twitchoglc import bench, bsp
+
+SIZE = 32
+RED = (255,0,0,255)
+GREEN = (0,255,0,255)
+
+@pytest.fixture( scope='module' )
+def context( ):
+    platform = os.environ.get( 'PYOPENGL_PLATFORM' )
+    if platform not in bench.CONTEXTS:
+        platform = 'egl'
+    bench.configure_platform( platform )
+    try:
+        context = bench.CONTEXTS[platform]( SIZE, SIZE )
+    except Exception as err:
+        pytest.skip( 'No offscreen %s context: %s'%( platform, err ) )
+    try:
+        from twitchoglc import maprender, corerender
+    except ImportError as err:
+        pytest.skip( 'Renderer unavailable: %s'%( err, ) )
+    if corerender.gl_version() < (3,0):
+        pytest.skip( 'Core renderer needs OpenGL 3.0' )
+    return context
+
+def quad( x, y ):
+    """Vertices of a quarter-viewport quad with its lower-left corner at x,y"""
+    vertices = numpy.zeros( (4,), dtype=bsp.VERTEX_RECORD )
+    vertices['position'] = [(x,y,0),(x+.5,y,0),(x+.5,y+.5,0),(x,y+.5,0)]
+    vertices['texcoord_surface'] = [(0,0),(1,0),(1,1),(0,1)]
+    vertices['texcoord_lightmap'] = .5
+    return vertices
+
+def solid( id, colour ):
+    from twitchoglc import brushviewer, texturecache
+    return brushviewer.MipmapTexture(
+        id, texturecache.MipTexture( numpy.array( colour, 'B' ), 1, 1 ),
+    )
+
+def synthetic_map( ):
+    """Three quads, the first and third in one two-range draw of red, the second green"""
+    from OpenGL.GL import GL_ELEMENT_ARRAY_BUFFER
+    from OpenGL.arrays import vbo
+    from twitchoglc import brushviewer, maprender
+    map = maprender.Map( 'synthetic' )
+    map.simple_vertices = vbo.VBO( numpy.concatenate( [
+        quad( -.75, -.75 ), quad( .25, -.75 ), quad( -.75, .25 ),
+    ] ) )
+    map.simple_indices = vbo.VBO(
+        numpy.array( [
+            (base,base+1,base+2,base,base+2,base+3) for base in (0,4,8)
+        ], 'I' ).ravel(),
+        target=GL_ELEMENT_ARRAY_BUFFER,
+    )
+    map.patch_indices = None
+    map.lightmaps = {0: brushviewer.Lightmap( 0, numpy.full( (2,2,3), 255, 'B' ) )}
+    map.textures = {0: solid( 0, RED ), 1: solid( 1, GREEN )}
+    map.draws = [
+        (('none',0,0), numpy.array( [0,12], 'i' ), numpy.array( [6,6], 'i' )),
+        (('none',0,1), numpy.array( [6], 'i' ), numpy.array( [6], 'i' )),
+    ]
+    return map
+
+def render( use_indirect ):
+    from OpenGL.GL import (
+        glClear, glClearColor, glDisable, glFinish, glGetError, glReadPixels, glViewport,
+        GL_COLOR_BUFFER_BIT, GL_DEPTH_BUFFER_BIT, GL_DEPTH_TEST, GL_NO_ERROR,
+        GL_RGBA, GL_UNSIGNED_BYTE,
+    )
+    from twitchoglc import corerender, renderstats
+    map = synthetic_map()
+    map.stats = stats = renderstats.RenderStats()
+    renderer = corerender.CoreRenderer( map )
+    renderer.use_indirect = use_indirect
+    glViewport( 0, 0, SIZE, SIZE )
+    glClearColor( 0, 0, 0, 1 )
+    glClear( GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT )
+    glDisable( GL_DEPTH_TEST )
+    stats.begin_frame()
+    renderer.render( None, numpy.identity( 4, 'f' ) )
+    counters = stats.current.counters
+    stats.end_frame()
+    glFinish()
+    assert glGetError() == GL_NO_ERROR
+    pixels = numpy.frombuffer(
+        glReadPixels( 0, 0, SIZE, SIZE, GL_RGBA, GL_UNSIGNED_BYTE ), 'B',
+    ).reshape( (SIZE,SIZE,4) )
+    return renderer, pixels, counters
+
+def check_pixels( pixels ):
+    low, high = SIZE//4, SIZE*3//4
+    assert tuple( pixels[low,low] ) == RED
+    assert tuple( pixels[low,high] ) == GREEN
+    assert tuple( pixels[high,low] ) == RED
+    assert tuple( pixels[high,high][:3] ) == (0,0,0)
+
+def test_multi_draw( context ):
+    renderer, pixels, counters = render( False )
+    assert renderer.indirect is None
+    check_pixels( pixels )
+    # the red draw's two ranges go out in one glMultiDrawElements
+    assert counters['draw_calls'] == 2
+    assert counters['triangles'] == 6
+
+def test_indirect( context ):
+    from twitchoglc import corerender
+    if not corerender.supports_indirect():
+        pytest.skip( 'glMultiDrawElementsIndirect needs OpenGL 4.3' )
+    renderer, pixels, counters = render( True )
+    assert renderer.indirect is not None
+    check_pixels( pixels )
+    assert counters['draw_calls'] == 2
+    assert counters['triangles'] == 6
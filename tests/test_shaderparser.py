@@ -0,0 +1,53 @@
+"""Check the shader-script lexer against the simpleparse grammar"""
+from __future__ import absolute_import
+import pytest
+from twitchoglc import shaderparser
+
+# file-level cases where the grammar's behaviour is less obvious
+QUIRK_CASES = [
+    '',
+    'junk',
+    'a\n{\n}\n_bad',
+    'a { b ( 1 2 )\n c d }',
+    'a { b ( 1 x ) }',
+    'a{b 1.5.3 -x -5abc $lm $ }',
+    'a { b 0x10 }',
+    'b {} a { b . }',
+    'x//c\n{//\n}//eof',
+    'a { { map x } }\r\nb{\r\n}',
+]
+PRODUCTION_CASES = [
+    content for content,production in shaderparser.PARSER_CASES
+    if production == 'production'
+]
+
+def parse_result( content, parser ):
+    """Parse content, ValueError (the class) if the parser rejects it"""
+    try:
+        return shaderparser.parse( content, parser )
+    except ValueError:
+        return ValueError
+
+def test_grammar():
+    shaderparser.test_parser()
+
+@pytest.mark.parametrize( 'content', PRODUCTION_CASES )
+def test_lexer_productions( content ):
+    expected = parse_result( content, 'simpleparse' )
+    assert expected
+    assert parse_result( content, 'lexer' ) == expected
+
+@pytest.mark.parametrize( 'content', QUIRK_CASES )
+def test_lexer_quirks( content ):
+    assert parse_result( content, 'lexer' ) == parse_result( content, 'simpleparse' )
+
+def test_parse_files_parallel( tmp_path ):
+    paths = []
+    for i in range( shaderparser.PARALLEL_MINIMUM ):
+        path = tmp_path/('%s.shader'%(i,))
+        path.write_text( u'textures/base/t%s\n{\n\t{\n\t\tmap t%s.tga\n\t}\n}\n'%(i,i) )
+        paths.append( str(path) )
+    paths.append( str(tmp_path/'missing.shader') )
+    serial = shaderparser.parse_files( paths, 0 )
+    assert serial[-1][0] == {} and serial[-1][1]
+    assert shaderparser.parse_files( paths, 2 ) == serial
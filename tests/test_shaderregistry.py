@@ -0,0 +1,54 @@
+"""Caching of parsed shader scripts across search paths"""
+from __future__ import absolute_import
+import os
+from twitchoglc import searchpath, shaderparser, shaderregistry
+
+SCRIPT = '''textures/base/%(name)s
+{
+	{
+		map textures/base/%(name)s.tga
+	}
+}
+'''
+
+def write_pack( directory, name ):
+    scripts = os.path.join( str(directory), 'scripts' )
+    os.makedirs( scripts )
+    with open( os.path.join( scripts, '%s.shader'%(name,) ), 'w' ) as fh:
+        fh.write( SCRIPT%{'name':name} )
+    return str(directory)
+
+def test_shared_scripts_parsed_once( tmp_path, monkeypatch ):
+    base = write_pack( tmp_path/'base', 'base' )
+    maps = [write_pack( tmp_path/name, name ) for name in ('one','two')]
+    cache = str( tmp_path/'cache' )
+    parsed = []
+    parse_files = shaderparser.parse_files
+    def recording( paths, processes=None ):
+        parsed.extend( paths )
+        return parse_files( paths, 0 )
+    monkeypatch.setattr( shaderparser, 'parse_files', recording )
+    for map in maps:
+        search = searchpath.SearchPath.build( [map, base], None )
+        registry = shaderregistry.ShaderRegistry( search, cache_directory=cache )
+        assert 'textures/base/base' in registry
+        assert os.path.basename( map ) in [
+            name.split( '/' )[-1] for name,_,_ in registry.definitions.values()
+        ]
+    # each map's own script, the shared base script only for the first map
+    assert sorted( [os.path.basename( path ) for path in parsed] ) == [
+        'base.shader', 'one.shader', 'two.shader',
+    ]
+
+def test_modified_script_reparsed( tmp_path ):
+    base = write_pack( tmp_path/'base', 'base' )
+    cache = str( tmp_path/'cache' )
+    search = searchpath.SearchPath.build( [base], None )
+    shaderregistry.ShaderRegistry( search, cache_directory=cache )
+    script = os.path.join( base, 'scripts', 'base.shader' )
+    with open( script, 'w' ) as fh:
+        fh.write( SCRIPT%{'name':'changed'} )
+    os.utime( script, (1,1) )
+    registry = shaderregistry.ShaderRegistry( search, cache_directory=cache )
+    assert 'textures/base/changed' in registry
+    assert 'textures/base/base' not in registry
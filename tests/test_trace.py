@@ -0,0 +1,88 @@
+"""Collision traces against a synthetic one-brush map"""
+from __future__ import absolute_import
+import numpy
+from twitchoglc import bsp, trace
+
+EPSILON = trace.SURFACE_CLIP_EPSILON
+
+def make_tracer( ):
+    """A solid cube brush (0..64 on each axis) in the front leaf of a single node at x=0"""
+    planes = numpy.zeros( (7,), dtype=bsp.PLANE_RECORD )
+    for axis in range( 3 ):
+        planes[axis*2]['normal'][axis] = 1
+        planes[axis*2]['distance'] = 64
+        planes[axis*2+1]['normal'][axis] = -1
+    planes[6]['normal'] = (1,0,0)
+    nodes = numpy.zeros( (1,), dtype=bsp.NODE_RECORD )
+    nodes[0]['plane'] = 6
+    nodes[0]['children'] = (-1,-2)
+    leafs = numpy.zeros( (2,), dtype=bsp.LEAF_RECORD )
+    leafs[0]['n_leafbrushes'] = 1
+    leafbrushes = numpy.zeros( (1,), dtype='i' )
+    brushes = numpy.zeros( (1,), dtype=bsp.BRUSH_RECORD )
+    brushes[0]['n_brushsides'] = 6
+    brushsides = numpy.zeros( (6,), dtype=bsp.BRUSHSIDE_RECORD )
+    brushsides['plane'] = numpy.arange( 6 )
+    textures = numpy.zeros( (1,), dtype=bsp.TEXTURE_RECORD )
+    textures[0]['contents'] = trace.CONTENTS_SOLID
+    return trace.Tracer( nodes, planes, leafs, leafbrushes, brushes, brushsides, textures )
+
+def test_ray_hit( ):
+    result = make_tracer().trace( (-32,32,32), (32,32,32) )
+    assert numpy.isclose( result['fraction'], (32-EPSILON)/64 )
+    assert result['plane'] == 1
+    assert tuple( result['normal'] ) == (-1,0,0)
+    assert result['brush'] == 0
+    assert result['contents'] == trace.CONTENTS_SOLID
+    assert numpy.isclose( result['end'][0], -EPSILON )
+    assert not result['start_solid']
+
+def test_ray_miss( ):
+    result = make_tracer().trace( (-32,100,32), (32,100,32) )
+    assert result['fraction'] == 1
+    assert result['brush'] == -1
+    assert result['plane'] == -1
+
+def test_box_hit( ):
+    result = make_tracer().trace( (-32,32,32), (32,32,32), (-8,-8,-8), (8,8,8) )
+    assert numpy.isclose( result['fraction'], (24-EPSILON)/64 )
+    assert result['plane'] == 1
+    # the box's extent reaches the brush even though the centre passes above
+    result = make_tracer().trace( (-32,70,32), (32,70,32), (-8,-8,-8), (8,8,8) )
+    assert result['plane'] == 1
+    assert result['fraction'] < 1
+
+def test_point( ):
+    tracer = make_tracer()
+    assert tracer.trace( (-32,32,32), (-32,32,32) )['fraction'] == 1
+    assert list( tracer.point_contents( [(32,32,32),(-32,32,32)] ) ) == [trace.CONTENTS_SOLID,0]
+
+def test_start_solid( ):
+    tracer = make_tracer()
+    result = tracer.trace( (32,32,32), (100,32,32) )
+    assert result['start_solid']
+    assert not result['all_solid']
+    result = tracer.trace( (16,32,32), (48,32,32) )
+    assert result['start_solid']
+    assert result['all_solid']
+    assert result['fraction'] == 0
+
+def test_near_surface_move( ):
+    """A short move towards a side from within the epsilon is blocked at 0"""
+    result = make_tracer().trace( (-0.01,32,32), (-0.005,32,32) )
+    assert result['fraction'] == 0
+    assert result['plane'] == 1
+    assert not result['start_solid']
+
+def test_trace_many( ):
+    tracer = make_tracer()
+    random = numpy.random.RandomState( 5 )
+    starts = random.uniform( -96, 160, (200,3) ).astype( 'f' )
+    ends = random.uniform( -96, 160, (200,3) ).astype( 'f' )
+    for mins,maxs in ((None,None),((-4,-4,-8),(4,4,8))):
+        many = tracer.trace_many( starts, ends, mins, maxs )
+        assert numpy.count_nonzero( many['brush'] >= 0 )
+        for i in range( len(starts) ):
+            single = tracer.trace( starts[i], ends[i], mins, maxs )
+            for field in ('fraction','plane','brush','start_solid','all_solid'):
+                assert single[field] == many[i][field], (i, field)
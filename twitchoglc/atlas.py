@@ -0,0 +1,246 @@
+"""Packing of many small textures into a few large ones
+
+Q3 maps store their lightmaps as hundreds of 128x128 tiles, binding
+each as a separate texture means a texture object (and upload) per tile
+and a bind every time the lightmap changes while rendering.  Instead the
+tiles are laid out on a grid in a few large square pages, and the
+lightmap texture coordinates of the vertices are rewritten to address
+the tile within its page.
+
+Diffuse textures are similarly packed into texture arrays (or atlas
+pages where arrays are not available), see TexturePack.
+
+This module is CPU-only (numpy), the renderer uploads the pages.
+"""
+from __future__ import absolute_import
+import numpy, logging
+from .visibility import gather_ranges, merge_ranges
+log = logging.getLogger( __name__ )
+
+LIGHTMAP_SIZE = 128
+
+def page_layout( count, tile=LIGHTMAP_SIZE, max_size=2048 ):
+    """Choose the page size for count square tiles
+
+    Uses the smallest power-of-two page which holds all the tiles, up to
+    max_size, after which the tiles are spread over multiple pages.
+
+    returns (page_size, tiles_per_row, n_pages)
+    """
+    size = tile
+    while size < max_size and (size//tile)**2 < count:
+        size *= 2
+    per_row = size // tile
+    pages = max( 1, -(-count // (per_row*per_row)) )
+    return size, per_row, pages
+
+def pack_tiles( tiles, max_size=2048 ):
+    """Pack N x T x T x C tiles into square pages with a single copy
+
+    Tile i is at row (i % per_page) // per_row, column (i % per_row)
+    of page i // per_page.
+
+    returns (pages, tile_pages, tile_offsets) where pages is
+    P x S x S x C, tile_pages the page of each tile and tile_offsets
+    the (s,t) pixel offset of each tile within its page
+    """
+    tiles = numpy.asarray( tiles )
+    count, tile = len(tiles), tiles.shape[1]
+    size, per_row, n_pages = page_layout( count, tile, max_size )
+    per_page = per_row * per_row
+    padded = numpy.zeros( (n_pages*per_page,)+tiles.shape[1:], dtype=tiles.dtype )
+    padded[:count] = tiles
+    # (page, row, column, y, x, channel) -> (page, row, y, column, x, channel)
+    pages = padded.reshape(
+        (n_pages, per_row, per_row) + tiles.shape[1:]
+    ).transpose(
+        (0,1,3,2,4,5)
+    ).reshape(
+        (n_pages, size, size) + tiles.shape[3:]
+    )
+    index = numpy.arange( count )
+    slot = index % per_page
+    tile_offsets = numpy.stack( ((slot % per_row)*tile, (slot // per_row)*tile), -1 )
+    return pages, index // per_page, tile_offsets.astype( 'f' )
+
+def remap_lightmap_texcoords( vertices, faces, tile_pages, tile_offsets, page_size, tile=LIGHTMAP_SIZE ):
+    """Rewrite the lightmap texture coordinates of faces' vertices into the pages
+
+    vertices -- VERTEX_RECORD array, not modified
+    faces -- FACE_RECORD array, each face's vertex range is remapped
+        using its lm_index tile
+
+    returns copy of vertices with texcoord_lightmap addressing the
+    face's tile within its page
+    """
+    vertices = vertices.copy()
+    lm_index = faces['lm_index']
+    lit = (lm_index >= 0) & (lm_index < len(tile_pages))
+    vertex_ids, owner = gather_ranges(
+        numpy.arange( len(vertices), dtype='i' ),
+        faces['vertex'][lit], faces['n_vertices'][lit],
+    )
+    tiles = lm_index[lit][owner]
+    coords = vertices['texcoord_lightmap'][vertex_ids]
+    vertices['texcoord_lightmap'][vertex_ids] = (
+        tile_offsets[tiles] + coords * tile
+    ) / page_size
+    return vertices
+
+def image_array( image ):
+    """Convert a PIL image to an H x W x 4 uint8 RGBA array (top row first)
+    
+    texturecache.MipTexture images give their (possibly mapped) top level
+    """
+    levels = getattr( image, 'levels', None )
+    if levels:
+        return levels[0]
+    if image.mode != 'RGBA':
+        image = image.convert( 'RGBA' )
+    return numpy.asarray( image, dtype='B' )
+
+def shelf_pack( sizes, page_size ):
+    """Pack (width,height) rectangles onto square pages in shelves
+    
+    Rectangles are placed tallest first, left-to-right in rows (shelves)
+    as tall as their first rectangle.  Rectangles larger than page_size 
+    get a page of their own.
+    
+    returns (pages, positions, page_sizes) where pages is the page of 
+    each rectangle, positions its (x,y) within the page and page_sizes
+    the (square) size of each page
+    """
+    sizes = numpy.asarray( sizes, dtype='i' ).reshape( (-1,2) )
+    pages = numpy.zeros( (len(sizes),), dtype='i' )
+    positions = numpy.zeros( (len(sizes),2), dtype='i' )
+    page_sizes = []
+    # the page being filled, oversized rectangles' pages don't interrupt it
+    current = None
+    x = y = shelf = 0
+    for index in numpy.lexsort( (-sizes[:,0], -sizes[:,1]) ):
+        width, height = sizes[index]
+        if width > page_size or height > page_size:
+            pages[index] = len(page_sizes)
+            page_sizes.append( max( width, height ) )
+            continue
+        if x + width > page_size:
+            x, y, shelf = 0, y + shelf, 0
+        if current is None or y + height > page_size:
+            current = len(page_sizes)
+            page_sizes.append( page_size )
+            x = y = shelf = 0
+        pages[index] = current
+        positions[index] = (x,y)
+        x += width
+        shelf = max( shelf, height )
+    return pages, positions, page_sizes
+
+class TexturePack( object ):
+    """The map's plain diffuse textures packed to reduce texture binds
+    
+    With use_arrays, textures are grouped by size into texture arrays 
+    (up to max_layers layers each), otherwise they are shelf-packed into
+    atlas pages.  Either way a face's texture is identified by a group
+    (the GL texture to bind), a layer and a rectangle within the layer, 
+    which are provided per-vertex by vertex_data, the texture coordinates
+    being wrapped into the rectangle by the shader.
+    
+    groups -- list of L x H x W x 4 uint8 arrays, the layers of each 
+        texture array, or a single layer for each atlas page
+    texture_group, texture_layer -- for each texture id (-1 if not packed)
+    texture_rect -- (s,t,width,height) of each texture within its layer
+    """
+    def __init__( self, n_textures, images, use_arrays=True, max_layers=256, max_size=2048 ):
+        """Pack images
+        
+        n_textures -- number of textures in the map
+        images -- {texture id: H x W x 4 uint8 array} for the textures 
+            to pack, see image_array
+        """
+        self.use_arrays = use_arrays
+        self.groups = []
+        self.texture_group = numpy.full( (n_textures,), -1, dtype='i' )
+        self.texture_layer = numpy.zeros( (n_textures,), dtype='i' )
+        self.texture_rect = numpy.zeros( (n_textures,4), dtype='f' )
+        self.texture_rect[:,2:] = 1
+        ids = sorted( images )
+        if use_arrays:
+            self._pack_arrays( ids, images, max_layers )
+        else:
+            self._pack_atlas( ids, images, max_size )
+    
+    def _pack_arrays( self, ids, images, max_layers ):
+        by_shape = {}
+        for id in ids:
+            by_shape.setdefault( images[id].shape, [] ).append( id )
+        for shape in sorted( by_shape ):
+            members = by_shape[shape]
+            for start in range( 0, len(members), max_layers ):
+                chunk = members[start:start+max_layers]
+                self.texture_group[chunk] = len(self.groups)
+                self.texture_layer[chunk] = numpy.arange( len(chunk) )
+                self.groups.append( numpy.stack( [images[id] for id in chunk] ) )
+    
+    def _pack_atlas( self, ids, images, max_size ):
+        sizes = [images[id].shape[1::-1] for id in ids]
+        pages, positions, page_sizes = shelf_pack( sizes, max_size )
+        self.groups = [
+            numpy.zeros( (1,size,size,4), dtype='B' ) for size in page_sizes
+        ]
+        for id,page,(x,y),(width,height) in zip( ids, pages, positions, sizes ):
+            self.groups[page][0,y:y+height,x:x+width] = images[id]
+            size = float(page_sizes[page])
+            self.texture_group[id] = page
+            self.texture_rect[id] = (x/size, y/size, width/size, height/size)
+    
+    def vertex_data( self, vertices, faces ):
+        """Create the per-vertex (layer,s,t,width,height) data for faces
+        
+        returns len(vertices) x 5 float array
+        """
+        data = numpy.zeros( (len(vertices),5), dtype='f' )
+        data[:,3:] = 1
+        texture = faces['texture']
+        packed = (texture >= 0) & (texture < len(self.texture_group))
+        packed[packed] = self.texture_group[texture[packed]] >= 0
+        vertex_ids, owner = gather_ranges(
+            numpy.arange( len(vertices), dtype='i' ),
+            faces['vertex'][packed], faces['n_vertices'][packed],
+        )
+        texture = texture[packed][owner]
+        data[vertex_ids,0] = self.texture_layer[texture]
+        data[vertex_ids,1:] = self.texture_rect[texture]
+        return data
+
+def merge_batches( batches, texture_group ):
+    """Combine draw batches whose textures are in the same pack group
+    
+    batches -- [(lightmap,texture,starts,counts),...] as from 
+        Twitch.simple_draw_ranges
+    texture_group -- pack group for each texture (-1 if not packed)
+    
+    returns (packed, unpacked) where packed is [(lightmap,group,starts,counts)]
+    for each (lightmap,group) combination and unpacked the batches for 
+    textures which are not packed
+    """
+    merged = {}
+    order = []
+    unpacked = []
+    for lightmap,texture,starts,counts in batches:
+        group = texture_group[texture] if 0 <= texture < len(texture_group) else -1
+        if group < 0:
+            unpacked.append( (lightmap,texture,starts,counts) )
+            continue
+        key = (lightmap,int(group))
+        if key not in merged:
+            merged[key] = []
+            order.append( key )
+        merged[key].append( (starts,counts) )
+    packed = []
+    for key in order:
+        starts = numpy.concatenate( [starts for starts,counts in merged[key]] )
+        counts = numpy.concatenate( [counts for starts,counts in merged[key]] )
+        sort = numpy.argsort( starts, kind='stable' )
+        starts, counts, _ = merge_ranges( starts[sort], counts[sort] )
+        packed.append( key + (starts,counts) )
+    return packed, unpacked
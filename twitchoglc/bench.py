@@ -0,0 +1,475 @@
+"""Headless load and frame-time benchmark for Quake III style maps
+
+Loads a map (resolved as twitch-viewer does) timing each load phase,
+then renders a camera path into an offscreen buffer, reporting frame
+time percentiles and the render statistics (see twitchoglc.renderstats)
+as text and optionally JSON for regression tracking.
+
+The offscreen context comes from EGL (a pbuffer, surfaceless with Mesa
+when there is no display) or OSMesa, so the benchmark runs on machines
+without a display, e.g. with Mesa's llvmpipe software rasterizer:
+
+    twitch-bench --frames 200 --json result.json maps/test.bsp
+
+Camera paths are lists of [x, y, z, yaw, pitch] records in map
+coordinates (degrees, yaw 0 along +x), read from/saved to JSON files
+({"frames": [...]}).  Without a recorded path one is generated through
+the map's spawn points (or orbiting the map if it has none).
+"""
+
+from __future__ import absolute_import
+import os, sys, json, time, math, logging, collections
+import numpy
+
+log = logging.getLogger(__name__)
+timer = getattr(time, "perf_counter", time.time)
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def configure_platform(platform):
+    """Select the PyOpenGL platform, must run before OpenGL is imported"""
+    if "OpenGL.GL" in sys.modules:
+        log.warning("OpenGL already imported, platform %s may not apply", platform)
+    os.environ["PYOPENGL_PLATFORM"] = platform
+    if platform == "egl" and not (
+        os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")
+    ):
+        # Mesa's default EGL platform needs a display server
+        os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+
+
+def egl_context(width, height):
+    """Create and make current an EGL pbuffer context
+
+    returns the (display, surface, context) to keep alive
+    """
+    import ctypes
+    from OpenGL import EGL
+
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError("Unable to initialize EGL")
+    attributes = (EGL.EGLint * 13)(
+        EGL.EGL_SURFACE_TYPE,
+        EGL.EGL_PBUFFER_BIT,
+        EGL.EGL_RED_SIZE,
+        8,
+        EGL.EGL_GREEN_SIZE,
+        8,
+        EGL.EGL_BLUE_SIZE,
+        8,
+        EGL.EGL_DEPTH_SIZE,
+        24,
+        EGL.EGL_RENDERABLE_TYPE,
+        EGL.EGL_OPENGL_BIT,
+        EGL.EGL_NONE,
+    )
+    config = EGL.EGLConfig()
+    count = EGL.EGLint()
+    if (
+        not EGL.eglChooseConfig(
+            display, attributes, ctypes.pointer(config), 1, ctypes.pointer(count)
+        )
+        or not count.value
+    ):
+        raise RuntimeError("No EGL pbuffer configuration with OpenGL support")
+    surface = EGL.eglCreatePbufferSurface(
+        display,
+        config,
+        (EGL.EGLint * 5)(EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE),
+    )
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    if not EGL.eglMakeCurrent(display, surface, surface, context):
+        raise RuntimeError("Unable to make the EGL context current")
+    return display, surface, context
+
+
+def osmesa_context(width, height):
+    """Create and make current an OSMesa context
+
+    returns the (context, buffer) to keep alive
+    """
+    from OpenGL import osmesa, arrays
+    from OpenGL.GL import GL_UNSIGNED_BYTE
+
+    context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+    if not context:
+        raise RuntimeError("Unable to create an OSMesa context")
+    buffer = arrays.GLubyteArray.zeros((height, width, 4))
+    if not osmesa.OSMesaMakeCurrent(context, buffer, GL_UNSIGNED_BYTE, width, height):
+        raise RuntimeError("Unable to make the OSMesa context current")
+    return context, buffer
+
+
+CONTEXTS = {
+    "egl": egl_context,
+    "osmesa": osmesa_context,
+}
+
+
+def perspective(fovy, aspect, near, far):
+    """Column-vector perspective projection matrix"""
+    f = 1.0 / math.tan(math.radians(fovy) / 2.0)
+    return numpy.array(
+        [
+            [f / aspect, 0, 0, 0],
+            [0, f, 0, 0],
+            [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+            [0, 0, -1, 0],
+        ],
+        "f",
+    )
+
+
+def view_matrix(position, yaw, pitch):
+    """Column-vector OpenGL (y-up) view matrix for a camera in map coordinates
+
+    The viewer rotates the map -90 degrees around x, so map (x,y,z) is
+    OpenGL (x,z,-y) and Q3 yaw 0 (+x) is OpenGL yaw -90 around y.
+    """
+    x, y, z = position
+    yaw = math.radians(yaw - 90)
+    pitch = math.radians(pitch)
+    c, s = math.cos(-yaw), math.sin(-yaw)
+    rotate_y = numpy.array(
+        [[c, 0, s, 0], [0, 1, 0, 0], [-s, 0, c, 0], [0, 0, 0, 1]], "f"
+    )
+    c, s = math.cos(-pitch), math.sin(-pitch)
+    rotate_x = numpy.array(
+        [[1, 0, 0, 0], [0, c, -s, 0], [0, s, c, 0], [0, 0, 0, 1]], "f"
+    )
+    translate = numpy.identity(4, "f")
+    translate[:3, 3] = (-x, -z, y)
+    return numpy.dot(rotate_x, numpy.dot(rotate_y, translate))
+
+
+class ViewPlatform(object):
+    def __init__(self, position):
+        self.position = position
+
+
+class BenchMode(object):
+    """Minimal stand-in for an OpenGLContext render mode
+
+    modelproj is the row-vector model-view-projection matrix (as in
+    OpenGLContext) before the viewer's map rotation.
+    """
+
+    visible = True
+    transparent = False
+
+    def __init__(self, position, modelview, projection):
+        x, y, z = position
+        self.viewPlatform = ViewPlatform((x, z, -y))
+        self.modelview = modelview.T
+        self.projection = projection.T
+        self.modelproj = numpy.dot(self.modelview, self.projection)
+
+
+def generated_path(twitch, frames, view_height=26):
+    """Generate a camera path of frames records for twitch
+
+    Walks between the spawn points looking along the direction of
+    travel (turning in place for a single spawn point), or orbits the
+    map looking at its centre if there are none.
+    """
+    table = twitch.entity_table
+    spawns = table.spawn_points()
+    if len(spawns) > 1:
+        points = table.origins[spawns].astype("d")
+        points[:, 2] += view_height
+        points = numpy.concatenate([points, points[:1]])
+        lengths = numpy.sqrt(numpy.sum(numpy.diff(points, axis=0) ** 2, -1))
+        distance = numpy.concatenate([[0], numpy.cumsum(lengths)])
+        samples = numpy.linspace(0, distance[-1], frames, endpoint=False)
+        segment = numpy.minimum(
+            numpy.searchsorted(distance, samples, side="right") - 1, len(lengths) - 1
+        )
+        fraction = (samples - distance[segment]) / numpy.maximum(lengths[segment], 1e-6)
+        positions = (
+            points[segment]
+            + (points[segment + 1] - points[segment]) * fraction[:, None]
+        )
+        delta = points[segment + 1] - points[segment]
+        yaws = numpy.degrees(numpy.arctan2(delta[:, 1], delta[:, 0]))
+    elif len(spawns) == 1:
+        origin = table.origins[spawns[0]].astype("d") + (0, 0, view_height)
+        positions = numpy.repeat(origin[None, :], frames, axis=0)
+        yaws = table.angles[spawns[0]] + numpy.linspace(0, 360, frames, endpoint=False)
+    else:
+        vertices = twitch.vertices["position"]
+        low, high = vertices.min(0), vertices.max(0)
+        centre = (low + high) / 2.0
+        radius = (high - low)[:2] / 2.0 * 0.6
+        angles = numpy.linspace(0, 2 * numpy.pi, frames, endpoint=False)
+        positions = numpy.zeros((frames, 3), "d")
+        positions[:, 0] = centre[0] + radius[0] * numpy.cos(angles)
+        positions[:, 1] = centre[1] + radius[1] * numpy.sin(angles)
+        positions[:, 2] = centre[2]
+        yaws = numpy.degrees(
+            numpy.arctan2(centre[1] - positions[:, 1], centre[0] - positions[:, 0])
+        )
+    return [
+        [float(x), float(y), float(z), float(yaw), 0.0]
+        for (x, y, z), yaw in zip(positions, yaws)
+    ]
+
+
+def load_path(filename):
+    with open(filename) as fh:
+        return json.load(fh)["frames"]
+
+
+def save_path(filename, path):
+    with open(filename, "w") as fh:
+        json.dump({"frames": path}, fh)
+
+
+def percentiles(values):
+    """Summarize values (seconds) as milliseconds"""
+    values = numpy.asarray(values, "d") * 1000
+    if not len(values):
+        return {}
+    result = {"mean": float(numpy.mean(values)), "max": float(numpy.max(values))}
+    for percentile in PERCENTILES:
+        result["p%s" % (percentile,)] = float(numpy.percentile(values, percentile))
+    return result
+
+
+def load_map(target, backend):
+    """Load target with a maprender.Map, timing each phase
+
+    returns (map, {phase: seconds})
+    """
+    from . import maprender, mapcache
+
+    times = collections.OrderedDict()
+
+    def timed(phase, function):
+        start = timer()
+        function()
+        times[phase] = timer() - start
+
+    renderer = maprender.Map(target)
+    renderer.backend = backend
+
+    timed("parse", renderer.open)
+    twitch = renderer.twitch
+    restored = False
+    if renderer.compiled_cache:
+        # as mapcache.compiled, with the restore and save timed separately
+        start = timer()
+        directory = mapcache.cache_directory(twitch)
+        restored = mapcache.restore(twitch, directory)
+        times["cache_restore"] = timer() - start
+    timed("simple_faces", lambda: (twitch.simple_faces, twitch.render_vertices))
+    timed("patch_faces", lambda: twitch.patch_faces)
+    if renderer.compiled_cache and not restored:
+
+        def save():
+            try:
+                mapcache.save(twitch, directory)
+            except (IOError, OSError) as err:
+                log.warning("Unable to save compiled map to %s: %s", directory, err)
+
+        timed("cache_save", save)
+    # the compiled data is restored (or compiled) now
+    renderer.compiled_cache = False
+    timed("shaders", lambda: twitch.brushes)
+    # as Map.load, without the sky (its cube textures need a scenegraph context)
+    timed("lightmaps", renderer.load_geometry)
+
+    def textures():
+        order = renderer.texture_order(renderer.spawn_position())
+        renderer.loaded = True
+        renderer.load_textures(order)
+
+    timed("textures", textures)
+    return renderer, times
+
+
+def upload_map(renderer, mode):
+    """Upload the map's textures and geometry, returns seconds taken"""
+    from OpenGL.GL import glFinish
+
+    start = timer()
+    renderer.process_uploads()
+    render_frame(renderer, mode)
+    glFinish()
+    return timer() - start
+
+
+def render_frame(renderer, mode):
+    from OpenGL.GL import (
+        glClear,
+        glEnable,
+        glLoadMatrixf,
+        glMatrixMode,
+        glRotatef,
+        GL_COLOR_BUFFER_BIT,
+        GL_DEPTH_BUFFER_BIT,
+        GL_DEPTH_TEST,
+        GL_MODELVIEW,
+        GL_PROJECTION,
+    )
+
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    glEnable(GL_DEPTH_TEST)
+    glMatrixMode(GL_PROJECTION)
+    glLoadMatrixf(mode.projection)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadMatrixf(mode.modelview)
+    glRotatef(-90, 1.0, 0, 0)
+    renderer.Render(mode)
+
+
+def run(options):
+    """Run the benchmark for parsed options, returns the results"""
+    configure_platform(options.platform)
+    context = CONTEXTS[options.platform](options.width, options.height)
+    from OpenGL.GL import (
+        glGetString,
+        glFinish,
+        glViewport,
+        GL_VENDOR,
+        GL_RENDERER,
+        GL_VERSION,
+    )
+    from . import pk3, renderstats
+
+    glViewport(0, 0, options.width, options.height)
+    target = pk3.resolve_target(options.target, bsp_name=options.bsp)
+    start = timer()
+    renderer, load_times = load_map(target, options.renderer)
+
+    if options.path:
+        path = load_path(options.path)
+    else:
+        path = generated_path(renderer.twitch, options.frames)
+    if options.save_path:
+        save_path(options.save_path, path)
+    projection = perspective(
+        options.fov, options.width / float(options.height), 30, 50000
+    )
+    modes = [
+        BenchMode((x, y, z), view_matrix((x, y, z), yaw, pitch), projection)
+        for x, y, z, yaw, pitch in path
+    ]
+    load_times["upload"] = upload_map(renderer, modes[0])
+    load_times["total"] = timer() - start
+
+    renderer.stats = stats = renderstats.RenderStats()
+    frame_times = []
+    for mode in modes:
+        frame_start = timer()
+        render_frame(renderer, mode)
+        glFinish()
+        frame_times.append(timer() - frame_start)
+    stats.flush()
+    return {
+        "target": target,
+        "renderer": renderer.backend,
+        "platform": options.platform,
+        "gl": {
+            "vendor": glGetString(GL_VENDOR).decode("latin-1"),
+            "renderer": glGetString(GL_RENDERER).decode("latin-1"),
+            "version": glGetString(GL_VERSION).decode("latin-1"),
+        },
+        "size": [options.width, options.height],
+        "load": load_times,
+        "frames": len(frame_times),
+        "frame_time": percentiles(frame_times),
+        "stats": stats.summary(),
+    }
+
+
+def report(results):
+    print(
+        "%s (%s, %s)"
+        % (results["target"], results["renderer"], results["gl"]["renderer"])
+    )
+    for phase, seconds in results["load"].items():
+        print("  load %-14s %9.3fs" % (phase, seconds))
+    print("  frames %s" % (results["frames"],))
+    for key, value in results["frame_time"].items():
+        print("  frame %-13s %9.3fms" % (key, value))
+    for field in ("draw_calls", "triangles", "texture_binds", "gpu_time"):
+        if field in results["stats"]:
+            print("  mean %-14s %12.6g" % (field, results["stats"][field]["mean"]))
+
+
+def get_options():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmarks loading and rendering a Quake III Style map offscreen"
+    )
+    parser.add_argument("-b", "--bsp", default=None)
+    parser.add_argument(
+        "-r",
+        "--renderer",
+        help="Rendering backend to benchmark (default fixed, as twitch-viewer)",
+        # maprender.Map.BACKENDS, which can't be imported before configure_platform
+        choices=("fixed", "core"),
+        default="fixed",
+    )
+    parser.add_argument(
+        "-p",
+        "--platform",
+        help="Offscreen context to render into",
+        choices=sorted(CONTEXTS),
+        default="egl",
+    )
+    parser.add_argument(
+        "-f",
+        "--frames",
+        help="Number of frames in the generated camera path",
+        type=int,
+        default=300,
+    )
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument(
+        "--fov", help="Vertical field of view", type=float, default=60.0
+    )
+    parser.add_argument(
+        "--path",
+        help="Render the camera path recorded in this JSON file",
+        default=None,
+    )
+    parser.add_argument(
+        "--save-path",
+        help="Save the camera path rendered to this JSON file",
+        default=None,
+    )
+    parser.add_argument(
+        "--json",
+        help="Write the results to this JSON file ('-' for stdout)",
+        default=None,
+    )
+    parser.add_argument(
+        "target",
+        help="A .bsp (or .pk3) file or url to benchmark",
+    )
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    options = get_options().parse_args()
+    results = run(options)
+    if options.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        report(results)
+        if options.json:
+            with open(options.json, "w") as fh:
+                json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
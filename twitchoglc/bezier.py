@@ -211,3 +211,222 @@ def grid_texcoords( expanded ):
     tex_coords[:,:,1] = values 
     return tex_coords
     
+
+_patch_weight_cache = {}
+def patch_weights( divisions=10 ):
+    """Get cached (2*divisions*divisions, 9) weights for a 3x3 sub-patch
+    
+    Maps the 9 control points of a sub-patch to the divisions x divisions
+    output vertices.  The first divisions*divisions rows are the bezier 
+    weights used for positions in expand(), the second set of rows are the 
+    four-corner blend used for normals and texture coordinates in 
+    expand_blend().
+    """
+    if divisions not in _patch_weight_cache:
+        ws = weight_array( divisions )
+        # verts[j,i] = sum_l ws[j,l] sum_k ws[i,k] points[l,k]
+        position = einsum( 'jl,ik->jilk', ws, ws ).reshape( (divisions*divisions,9) )
+        blend = zeros( (divisions*divisions,3,3), dtype='f' )
+        corners = four_way_blend( divisions ).reshape( (divisions*divisions,4) )
+        for corner,(l,k) in enumerate( [(0,0),(2,0),(2,2),(0,2)] ):
+            blend[:,l,k] = corners[:,corner]
+        blend = blend.reshape( (divisions*divisions,9) )
+        _patch_weight_cache[divisions] = concatenate( (position,blend) ).astype( 'f' )
+    return _patch_weight_cache[divisions]
+
+def _local_ranges( counts ):
+    """For ranges of counts, return (owner,position-within-range) for each element"""
+    counts = asarray( counts, dtype='i' )
+    owner = repeat( arange( len(counts), dtype='i' ), counts )
+    local = arange( len(owner), dtype='i' ) - (cumsum( counts ) - counts)[owner]
+    return owner, local
+
+def _subpatches( starts, sizes ):
+    """Find the 3x3 sub-patches of each patch
+    
+    returns (patch, a, b, control_index) for each sub-patch where patch is 
+    the patch index, (a,b) the sub-patch position within the patch and 
+    control_index the K x 9 indices of its control points
+    """
+    M,N = sizes[:,0],sizes[:,1]
+    sub_m = maximum( (M-1)//2, 0 )
+    sub_n = maximum( (N-1)//2, 0 )
+    patch, local = _local_ranges( sub_m * sub_n )
+    a,b = local // sub_n[patch], local % sub_n[patch]
+    step = arange( 3, dtype='i' )
+    rows = (2*a)[:,newaxis,newaxis] + step[newaxis,:,newaxis]
+    cols = (2*b)[:,newaxis,newaxis] + step[newaxis,newaxis,:]
+    control_index = starts[patch][:,newaxis,newaxis] + rows*N[patch][:,newaxis,newaxis] + cols
+    return patch, a, b, control_index.reshape( (-1,9) )
+
+def _patch_layout( sizes, divisions ):
+    """Calculate final grid sizes and vertex offsets for each patch"""
+    final_m = maximum( (sizes[:,0]-1)//2, 0 ) * divisions
+    final_n = maximum( (sizes[:,1]-1)//2, 0 ) * divisions
+    vertex_counts = final_m * final_n
+    return final_m, final_n, cumsum( vertex_counts ) - vertex_counts
+
+def _as_patch_arrays( starts, sizes, divisions ):
+    starts = asarray( starts, dtype='i' )
+    sizes = asarray( sizes, dtype='i' ).reshape( (-1,2) )
+    divisions = asarray( divisions, dtype='i' )
+    if not divisions.shape:
+        divisions = divisions.repeat( len(sizes) )
+    return starts, sizes, divisions
+
+def adaptive_divisions( positions, starts, sizes, tolerance=4.0, max_segments=16 ):
+    """Choose divisions for each patch so the flattening error is < tolerance
+    
+    positions -- V x 3 array of control-point positions
+    starts, sizes -- as for expand_patches
+    tolerance -- maximum distance (in map units) between the curved surface
+        and the triangles used to render it
+    max_segments -- upper limit on segments for each sub-patch edge, should
+        be a power of two
+    
+    The number of segments for each 3x3 sub-patch is calculated from the 
+    second differences of its control points (the flattening error of a 
+    quadratic bezier with n segments is at most |P0-2P1+P2|/(4*n*n)) and 
+    rounded up to a power of two, so that patch_lod_indices can produce 
+    coarser levels from a subset of the vertices.  Each patch uses the 
+    largest value of its sub-patches so the sub-patch seams stay aligned.
+    Flat patches use 2 divisions (just the corners).
+    
+    returns per-patch divisions (segments + 1) array
+    """
+    starts, sizes, _ = _as_patch_arrays( starts, sizes, 0 )
+    patch, a, b, control_index = _subpatches( starts, sizes )
+    points = asarray( positions, dtype='f' )[control_index].reshape( (-1,3,3,3) )
+    along_m = points[:,0] - 2*points[:,1] + points[:,2]
+    along_n = points[:,:,0] - 2*points[:,:,1] + points[:,:,2]
+    deviation = (
+        sqrt( (along_m**2).sum(-1) ).max(-1) + 
+        sqrt( (along_n**2).sum(-1) ).max(-1)
+    )
+    segments = sqrt( deviation / (4.0*tolerance) )
+    segments = 2**ceil( log2( maximum( segments, 1.0 ) ) )
+    segments = minimum( segments, max_segments ).astype( 'i' )
+    result = ones( (len(sizes),), dtype='i' )
+    maximum.at( result, patch, segments )
+    return result + 1
+
+def expand_patch_vertices( controls, starts, sizes, divisions=10 ):
+    """Tessellate the vertices of many patches in a single pass
+    
+    controls -- V x D array of control-point data, the first 3 dimensions
+        are the position, the others are blended (normals, texcoords)
+    starts -- index into controls of the first control point of each patch
+    sizes -- (M,N) control-point grid size of each patch, control point 
+        m,n is at controls[start + m*N + n]
+    divisions -- number of divisions for each 3x3 sub-patch, either a 
+        single value or one value for each patch (see adaptive_divisions)
+    
+    Produces the same vertices as expand() and expand_blend() applied to 
+    each patch in turn, but all 3x3 sub-patches are stacked into a single 
+    array and evaluated with one matrix product against the cached 
+    patch_weights() (one product for each distinct divisions value).
+    
+    returns the vertex array, with each patch's grid following the last
+    """
+    controls = asarray( controls, dtype='f' )
+    starts, sizes, divisions = _as_patch_arrays( starts, sizes, divisions )
+    D = controls.shape[-1]
+    final_m, final_n, vertex_offsets = _patch_layout( sizes, divisions )
+    vertices = zeros( (int(sum( final_m * final_n )),D), dtype='f' )
+    
+    # stack the 3x3 control grids of every sub-patch
+    patch, a, b, control_index = _subpatches( starts, sizes )
+    sub_divisions = divisions[patch]
+    for division in unique( sub_divisions ):
+        selected = sub_divisions == division
+        group = patch[selected]
+        stacked = controls[control_index[selected].T]
+        
+        # one matrix product evaluates every sub-patch with both weightings
+        count = division*division
+        expanded = dot( 
+            patch_weights( division ), stacked.reshape( (9,-1) ) 
+        ).reshape( (2*count,len(group),D) )
+        combined = expanded[:count]
+        combined[:,:,3:] = expanded[count:,:,3:]
+        
+        # scatter each sub-patch into its block of its patch's final grid
+        j = repeat( arange( division, dtype='i' ), division )
+        i = tile( arange( division, dtype='i' ), division )
+        target = (
+            vertex_offsets[group] 
+            + ((a[selected]*division) + j[:,newaxis]) * final_n[group]
+            + (b[selected]*division) + i[:,newaxis]
+        )
+        vertices[target] = combined
+    return vertices
+
+def expand_patches( controls, starts, sizes, divisions=10 ):
+    """Tessellate many patches in a single pass
+    
+    Produces the same vertices and indices as expand(), expand_blend() 
+    and grid_indices() applied to each patch in turn, see 
+    expand_patch_vertices for the parameters.
+    
+    returns (vertices, indices, index_counts) where index_counts is the 
+    number of indices generated for each patch
+    """
+    vertices = expand_patch_vertices( controls, starts, sizes, divisions )
+    indices, _, index_counts = patch_lod_indices( sizes, divisions )
+    return vertices, indices, index_counts[0]
+
+def patch_lod_indices( sizes, divisions=10, levels=1 ):
+    """Create indices to render patches from expand_patches at several LODs
+    
+    sizes -- (M,N) control-point grid size of each patch
+    divisions -- divisions used to expand the patches
+    levels -- number of levels of detail to generate
+    
+    Level 0 generates 2 CCW triangles for each quad of each patch's grid 
+    (as grid_indices does), level L uses only every 2**L'th row and 
+    column of each sub-patch, so the coarser levels render the same 
+    vertex array with fewer triangles.  Where a patch's divisions do not 
+    allow a level (the segments are not divisible by 2**L) the patch's
+    coarsest available level is repeated.
+    
+    returns (indices, starts, counts) where indices holds all levels, 
+    level after level, and starts,counts are levels x patches arrays 
+    giving the range of indices for a given level and patch
+    """
+    _, sizes, divisions = _as_patch_arrays( 0, sizes, divisions )
+    sub_m = maximum( (sizes[:,0]-1)//2, 0 )
+    sub_n = maximum( (sizes[:,1]-1)//2, 0 )
+    final_m, final_n, vertex_offsets = _patch_layout( sizes, divisions )
+    segments = divisions - 1
+    results = []
+    counts = zeros( (levels,len(sizes)), dtype='i' )
+    stride = ones( (len(sizes),), dtype='i' )
+    for level in range( levels ):
+        if level:
+            doubled = stride*2
+            stride = where( (segments % doubled == 0) & (doubled <= segments), doubled, stride )
+        # rows/columns of the patch grid used at this level
+        per_block = segments // stride + 1
+        rows = sub_m * per_block
+        cols = sub_n * per_block
+        quad_n = maximum( cols-1, 0 )
+        quad_counts = maximum( rows-1, 0 ) * quad_n
+        patch, local = _local_ranges( quad_counts )
+        row, col = local // quad_n[patch], local % quad_n[patch]
+        per, step, width = per_block[patch], stride[patch], final_n[patch]
+        def grid_row( r ):
+            return ((r // per) * divisions[patch] + (r % per) * step) * width
+        def grid_col( c ):
+            return (c // per) * divisions[patch] + (c % per) * step
+        top, bottom = grid_row( row ), grid_row( row+1 )
+        left, right = grid_col( col ), grid_col( col+1 )
+        base = vertex_offsets[patch]
+        indices = empty( (len(patch),6), dtype='I' )
+        indices[:,0] = base + top + left
+        indices[:,1] = indices[:,4] = base + top + right
+        indices[:,2] = indices[:,3] = base + bottom + left
+        indices[:,5] = base + bottom + right
+        results.append( indices.ravel() )
+        counts[level] = quad_counts * 6
+    starts = cumsum( counts.ravel() ).reshape( counts.shape ) - counts
+    return concatenate( results ), starts, counts
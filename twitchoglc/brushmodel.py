@@ -51,6 +51,8 @@ class Brush( object ):
                     if name in self.DEFAULT_SURFACE_PARAMS:
                         setattr( self, name, param )
                 else:
+                    if definition[0] == 'cull' and definition[1]:
+                        self.cull = str( definition[1][0] ).lower()
                     self.commands.append( definition )
             else:
                 self.suites.append( definition )
@@ -2,7 +2,7 @@
 from __future__ import absolute_import
 import logging,numpy, sys
 log = logging.getLogger( __name__ )
-from . import brushmodel
+from . import brushmodel, corerender
 from OpenGL.GL import *
 from OpenGL.GL import shaders
 from OpenGL.arrays import vbo
@@ -102,5 +102,30 @@ class Lightmap( object ):
         glActiveTexture( GL_TEXTURE1 )
         if not self.texture:
             self.texture = texture.Texture(format=GL_RGB)
-            self.texture.store( 3, GL_RGB, 128,128, self.data )
+            height,width = self.data.shape[:2]
+            self.texture.store( 3, GL_RGB, width,height, self.data )
         self.texture()
+
+class MipmapTexture( object ):
+    """Plain texture uploaded from a texturecache.MipTexture's levels"""
+    texture = None
+    def __init__( self, id, image ):
+        self.id = id
+        self.image = image
+    def compile( self ):
+        self.texture = corerender.upload_levels( self.image.levels )
+        # the levels are on the GPU now, release the (mapped) data
+        self.image = None
+    def handle( self ):
+        """Get the GL texture name, uploading on first use"""
+        if not self.texture:
+            self.compile()
+        return self.texture
+    def render( self, visible=True, lit=False, mode=None ):
+        if not visible:
+            return None
+        if not self.texture:
+            self.compile()
+        glEnable( GL_TEXTURE_2D )
+        glBindTexture( GL_TEXTURE_2D, self.texture )
+        return 0
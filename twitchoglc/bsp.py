@@ -9,10 +9,30 @@ into structured data-arrays.  Uses the bezier module to tessellate
 patches into simple triangles (note: not triangle strips).
 """
 from __future__ import absolute_import
-import numpy, sys, logging, os, glob
+from __future__ import print_function
+import numpy, sys, logging, os
 from . import bezier
 from . import pk3
+from . import brushmodel
+from . import visibility
+from . import trace
+from . import lightgrid
+from . import entities
+from . import searchpath
+from . import shaderregistry
+from . import textureindex
+from . import texturecache
+from . import atlas
 from six.moves import zip
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+try:
+    from concurrent import futures
+except ImportError:
+    # python 2 without the futures backport, textures load serially
+    futures = None
 
 log = logging.getLogger( __name__ )
 i4 = '<i4'
@@ -120,6 +140,7 @@ LUMP_ORDER = [
     ('lightvols',LIGHTVOL_RECORD),
     ('visdata','iio'),
 ]
+LUMP_DTYPES = dict( LUMP_ORDER )
 
 def load_visdata( visdata ):
     header = numpy.dtype( VISDATA_RECORD_HEADER )
@@ -144,100 +165,340 @@ def load_visdata( visdata ):
         return None
     return result[0]
 
-def parse_bsp( array ):
-    """Parse a BSP structure for the array 
+HEADER_SIZE = 8 + 17*8
+
+def parse_header( header, size=None ):
+    """Validate a BSP header and return its lump directory
     
-    array -- numpy array with the data to parse...
+    header -- at least the first HEADER_SIZE bytes of the file
+    size -- total size of the file, if provided lumps are checked 
+        to fit within the file
     
-    returns {
-        <lump>: <lump_array>,
-        for lump,dtype in LUMP_ORDER
-    }
+    returns 17 x 2 array of (offset,length) for each lump in LUMP_ORDER
     """
-    array = array.view( 'c' )
-    magic = array[:4].tostring()
+    if isinstance( header, numpy.ndarray ):
+        header = header[:HEADER_SIZE].view( 'B' )
+    else:
+        header = numpy.frombuffer( header[:HEADER_SIZE], dtype='B' )
+    magic = header[:4].tobytes()
     if magic.startswith(b'PK'):
         raise RuntimeError("You are likely attempting to load a .pk3 file, Magic Number mismatch: %r"%(
             magic,
         ))
     assert magic == b'IBSP', magic 
-    alen = array.shape[-1]
-    iarray = array[:alen-(alen%4)].view( i4 )
+    if len(header) < HEADER_SIZE:
+        raise ValueError( 'Truncated BSP header: %s bytes'%( len(header), ))
+    iarray = header.view( i4 )
     version = iarray[1]
     assert version == 0x2e, version
-    direntries = iarray[2:2+17*2]
-    direntries = numpy.reshape( direntries, (17,2))
-    model = {}
-    for (lump,dtype),(offset,length) in zip( LUMP_ORDER, direntries ):
-        data = array[offset:offset+length]
+    direntries = numpy.reshape( iarray[2:2+17*2], (17,2))
+    if size is not None:
+        for (lump,dtype),(offset,length) in zip( LUMP_ORDER, direntries ):
+            if offset < 0 or length < 0 or offset+length > size:
+                raise ValueError( 'Lump %s (%s bytes at %s) extends outside the file of %s bytes'%(
+                    lump, length, offset, size,
+                ))
+    return direntries
+
+def read_header( filename ):
+    """Read only the header of filename 
+    
+    returns [(lump,offset,length),...] for each lump in LUMP_ORDER
+    """
+    with pk3.open_path( filename ) as fh:
+        header = fh.read( HEADER_SIZE )
+    direntries = parse_header( header, pk3.getsize( filename ) )
+    return [
+        (lump,int(offset),int(length))
+        for (lump,dtype),(offset,length) in zip( LUMP_ORDER, direntries )
+    ]
+
+class LumpDirectory( Mapping ):
+    """Lazily decoded mapping of lump name to lump array
+    
+    The header is validated on creation, each lump's dtype view is only 
+    created (or its load_<lump> hook run) the first time it is accessed.
+    """
+    def __init__( self, array ):
+        self.array = array.view( 'c' )
+        self.entries = dict([
+            (lump,(int(offset),int(length)))
+            for (lump,dtype),(offset,length) in zip( 
+                LUMP_ORDER, parse_header( self.array[:HEADER_SIZE], len(self.array) ) 
+            )
+        ])
+        self.decoded = {}
+    def __getitem__( self, lump ):
+        if lump not in self.decoded:
+            if lump not in self.entries:
+                raise KeyError( lump )
+            self.decoded[lump] = self.decode( lump )
+        return self.decoded[lump]
+    def __iter__( self ):
+        for lump,dtype in LUMP_ORDER:
+            yield lump
+    def __len__( self ):
+        return len(LUMP_ORDER)
+    def __contains__( self, lump ):
+        return lump in self.entries
+    def decode( self, lump ):
+        """Create the view (or run the loader) for the given lump"""
+        offset,length = self.entries[lump]
+        data = self.array[offset:offset+length]
         loader = globals().get( 'load_%s'%(lump,))
         if loader:
-            model[lump] = data = loader( data )
-        else:
-            dtype = numpy.dtype( dtype )
-            extra = len(data) % dtype.itemsize
-            if extra:
-                log.warn( 'Extra data in lump %s: %s bytes', lump, extra )
-                data = data[:-extra]
-            model[lump] = data = data.view( dtype )
-            log.debug( 'Loaded %s %s', data.shape[0], lump )
-    return model
+            return loader( data )
+        dtype = numpy.dtype( LUMP_DTYPES[lump] )
+        extra = len(data) % dtype.itemsize
+        if extra:
+            log.warn( 'Extra data in lump %s: %s bytes', lump, extra )
+            data = data[:-extra]
+        data = data.view( dtype )
+        log.debug( 'Loaded %s %s', data.shape[0], lump )
+        return data
+
+def parse_bsp( array ):
+    """Parse a BSP structure for the array 
+    
+    array -- numpy array with the data to parse...
+    
+    returns LumpDirectory mapping {
+        <lump>: <lump_array>,
+        for lump,dtype in LUMP_ORDER
+    } where the lumps are decoded on first access
+    """
+    return LumpDirectory( array )
+
+def simple_face_batches( faces, meshverts, lightmap_pages=None ):
+    """Build the index array and texture batches for simple faces (type 1 and 3)
+    
+    Faces are sorted by (texture,lm_index) so that each combination is 
+    rendered as a single contiguous range of the index array.
+    
+    lightmap_pages -- if provided, the lightmap atlas page for each 
+        lightmap, faces are then batched by (texture,page) instead
+    
+    returns (indices, texture_set, face_ids, starts, counts) where 
+    
+        indices -- uint32 array of vertex indices for the faces
+        texture_set -- [(lm_index,texture,stop),...] for each batch, with 
+            stop being the end of the batch in indices (lm_index is the 
+            atlas page when using lightmap_pages)
+        face_ids -- index into faces for each face in the sorted order
+        starts, counts -- range in indices for each face in sorted order
+    """
+    simple_types = numpy.logical_or( faces['type'] == 1, faces['type'] == 3)
+    face_ids = numpy.flatnonzero( simple_types )
+    # work on individual fields, taking whole records is much slower
+    textures = faces['texture'][face_ids]
+    lightmaps = faces['lm_index'][face_ids]
+    if lightmap_pages is not None:
+        valid = (lightmaps >= 0) & (lightmaps < len(lightmap_pages))
+        lightmaps = numpy.where( 
+            valid, numpy.asarray( lightmap_pages )[numpy.where( valid, lightmaps, 0 )], -1 
+        )
+    sortorder = numpy.lexsort( (lightmaps,textures) )
+    face_ids = face_ids[sortorder]
+    textures = textures[sortorder]
+    lightmaps = lightmaps[sortorder]
+    
+    counts = faces['n_meshverts'][face_ids]
+    # gather each face's meshverts and offset them by the face's first vertex
+    indices, owner = visibility.gather_ranges( meshverts, faces['meshvert'][face_ids], counts )
+    indices += faces['vertex'][face_ids][owner]
+    indices = indices.astype( numpy.uint32 )
+    ends = numpy.cumsum( counts )
+    starts = ends - counts
+    
+    if len(face_ids):
+        # the last face of each batch is where (texture,lm_index) changes
+        lasts = numpy.flatnonzero( 
+            (textures[1:] != textures[:-1]) | (lightmaps[1:] != lightmaps[:-1]) 
+        )
+        lasts = numpy.append( lasts, len(face_ids)-1 )
+    else:
+        lasts = numpy.zeros( (0,), 'i' )
+    texture_set = list(zip( 
+        lightmaps[lasts].tolist(), textures[lasts].tolist(), ends[lasts].tolist() 
+    ))
+    return indices, texture_set, face_ids, starts, counts
 
 class Twitch( object ):
     def __init__( self, filename, model, base_directory=None, brush_class=None ):
         self.model_name = os.path.splitext(os.path.basename( filename ))[0]
         self.filename = filename 
-        self.__dict__.update( model )
+        self.lumps = model
         self.base_directory = base_directory
         self.brush_class = brush_class
     
+    def __getattr__( self, key ):
+        """Decode lumps on first access"""
+        lumps = self.__dict__.get( 'lumps' )
+        if lumps is not None and key in lumps:
+            value = lumps[key]
+            setattr( self, key, value )
+            return value
+        raise AttributeError( key )
+    
     simple_indices = None
     texture_set = None
     @property
     def simple_faces( self ):
         """Create an index array for the indices to render faces of type 1 and 3"""
         if self.simple_indices is None:
-            faces = self.faces
-            # for type 1 and 3 we can simply create indices...
-            simple_types = numpy.logical_or( self.faces['type'] == 1, self.faces['type'] == 3)
-            simple_faces = numpy.compress( simple_types, self.faces )
-            # texture counts...
-            sortorder = numpy.lexsort( (simple_faces['lm_index'],simple_faces['texture'],) )
-            simple_faces = numpy.take( simple_faces, sortorder )
-            
-            self.texture_set = texture_set = []
-            
-            simple_index_count = numpy.sum( simple_faces['n_meshverts'] )
-            indices = numpy.zeros( (simple_index_count,), numpy.uint32 )
-            # ick, should be a fast way to do this...
-            starts = simple_faces['meshvert']
-            textures = simple_faces['texture']
-            lightmaps = simple_faces['lm_index']
-            stops = simple_faces['meshvert'] + simple_faces['n_meshverts']
-            start_indices = simple_faces['vertex']
-            current = 0
-            texture = None
-            lightmap = None
-            end = 0
-            for lm,tex,start,stop,index in zip(lightmaps,textures,starts,stops,start_indices):
-                if lm != lightmap or texture != tex:
-                    if lightmap or texture:
-                        texture_set.append( (lm,texture,end))
-                    if lm != lightmap:
-                        lightmap = lm 
-                    elif tex != texture:
-                        texture = tex 
-                end = current + (stop-start)
-                indices[current:end] = self.meshverts[start:stop] + index
-                current = end
-            if lightmap or texture:
-                texture_set.append( (lm,texture,end))
+            (
+                indices, self.texture_set, 
+                self.simple_face_ids, self.simple_face_starts, self.simple_face_counts,
+            ) = simple_face_batches( self.faces, self.meshverts, self.lightmap_tile_pages )
             self.simple_indices = indices
             # for type 2, we need to convert a control surface to a set of indices...
             log.debug( '%s texture/lightmap pairs used by simple geometry', len(self.texture_set, ))
         return self.simple_indices
+    
+    def simple_draw_ranges( self, face_mask=None ):
+        """Calculate the ranges of simple_faces needed to draw face_mask
+        
+        face_mask -- boolean array for each record in self.faces, if None
+            all faces are drawn
+        
+        returns [(lm_index,texture,starts,counts),...] for each batch in 
+        texture_set, where starts,counts are arrays of (merged) ranges 
+        in the simple_faces index array
+        """
+        self.simple_faces
+        stops = numpy.array( [stop for (lm,tex,stop) in self.texture_set], dtype='i' )
+        if face_mask is None:
+            starts = numpy.concatenate( ([0],stops[:-1]) ).astype( 'i' )
+            counts = stops - starts
+            batches = numpy.arange( len(stops) )
+        else:
+            selected = face_mask[self.simple_face_ids]
+            starts = self.simple_face_starts[selected]
+            counts = self.simple_face_counts[selected]
+            batches = numpy.searchsorted( stops, starts, side='right' )
+        starts, counts, batches = visibility.merge_ranges( starts, counts, batches )
+        bounds = numpy.searchsorted( batches, numpy.arange( len(stops)+1 ) )
+        return [
+            (lm,tex,starts[bounds[i]:bounds[i+1]],counts[bounds[i]:bounds[i+1]])
+            for i,(lm,tex,stop) in enumerate( self.texture_set )
+        ]
+    
+    # maximum size of the lightmap atlas pages (None for separate lightmaps)
+    lightmap_atlas_size = 2048
+    @property
+    def lightmap_tile_pages( self ):
+        """Atlas page for each lightmap (None when not using an atlas)"""
+        if not self.lightmap_atlas_size:
+            return None
+        size, per_row, n_pages = atlas.page_layout( 
+            len(self.lightmaps), atlas.LIGHTMAP_SIZE, self.lightmap_atlas_size,
+        )
+        return numpy.arange( len(self.lightmaps) ) // (per_row*per_row)
+    
+    _lightmap_atlas = None
+    @property
+    def lightmap_atlas( self ):
+        """Packed lightmaps (pages, tile_pages, tile_offsets) (see twitchoglc.atlas)"""
+        if self._lightmap_atlas is None:
+            self._lightmap_atlas = atlas.pack_tiles( 
+                self.lightmaps['texture'].view( 'B' ), self.lightmap_atlas_size,
+            )
+        return self._lightmap_atlas
+    
+    _render_vertices = None
+    @property
+    def render_vertices( self ):
+        """Vertices with lightmap texture coordinates addressing the atlas pages"""
+        if not self.lightmap_atlas_size:
+            return self.vertices
+        if self._render_vertices is None:
+            pages, tile_pages, tile_offsets = self.lightmap_atlas
+            self._render_vertices = atlas.remap_lightmap_texcoords(
+                self.vertices, self.faces, tile_pages, tile_offsets, pages.shape[1],
+            )
+        return self._render_vertices
+    
+    _face_centers = None
+    @property
+    def face_centers( self ):
+        """Centroid of each face's vertices (map coordinates)"""
+        if self._face_centers is None:
+            faces = self.faces
+            positions, owner = visibility.gather_ranges( 
+                self.vertices['position'], faces['vertex'], faces['n_vertices'],
+            )
+            totals = numpy.maximum( numpy.bincount( owner, minlength=len(faces) ), 1 )
+            self._face_centers = numpy.array( [
+                numpy.bincount( owner, positions[:,axis], minlength=len(faces) )/totals
+                for axis in range(3)
+            ], 'f' ).T
+        return self._face_centers
+    
+    _visibility = None
+    @property
+    def visibility( self ):
+        """PVS visibility culling for the map (see twitchoglc.visibility)"""
+        if self._visibility is None:
+            self._visibility = visibility.Visibility(
+                self.nodes, self.planes, self.leafs, self.leaffaces,
+                self.visdata, len(self.faces),
+            )
+        return self._visibility
+    
+    _tracer = None
+    @property
+    def tracer( self ):
+        """Point/ray/box collision traces for the map (see twitchoglc.trace)"""
+        if self._tracer is None:
+            # note: self.brushes is the shader brushes, not the lump
+            self._tracer = trace.Tracer(
+                self.nodes, self.planes, self.leafs, self.leafbrushes,
+                self.lumps['brushes'], self.brushsides, self.textures,
+            )
+        return self._tracer
+    
+    _entity_table = None
+    @property
+    def entity_table( self ):
+        """Parsed entities lump (see twitchoglc.entities)"""
+        if self._entity_table is None:
+            self._entity_table = entities.EntityTable.from_lump( self.entities )
+        return self._entity_table
+    
+    # size of the light grid cells, overridden by worldspawn "gridsize"
+    light_grid_size = lightgrid.DEFAULT_GRID_SIZE
+    _light_grid = None
+    @property
+    def light_grid( self ):
+        """Decoded lightvols light grid (see twitchoglc.lightgrid)"""
+        if self._light_grid is None:
+            world = self.models[0]
+            grid_size = entities.parse_vectors( 
+                [self.entity_table.worldspawn.get( 'gridsize' )] 
+            )[0]
+            if numpy.any( numpy.isnan( grid_size ) ):
+                grid_size = self.light_grid_size
+            self._light_grid = lightgrid.LightGrid(
+                self.lightvols, world['mins'], world['maxs'], grid_size,
+            )
+        return self._light_grid
+    
+    def sample_light( self, positions ):
+        """Sample the light grid at positions
+        
+        returns (ambient, directional, direction) N x 3 arrays
+        """
+        return self.light_grid.sample( positions )
+    
     patch_vertices = None
     patch_indices = None
+    # maximum tessellation error in map units (None for fixed 10 divisions)
+    patch_tolerance = 4.0
+    patch_max_segments = 16
+    # number of levels of detail to generate for patches
+    patch_lod_levels = 3
+    # distance at which patches start dropping levels of detail
+    patch_lod_distance = 1024.0
     @property
     def patch_faces( self ):
         """Create another pair of arrays for our patch faces
@@ -247,54 +508,89 @@ class Twitch( object ):
             if not len(patch_faces):
                 self.patch_indices = None
                 return None,None
+            self.patch_face_ids = numpy.flatnonzero( self.faces['type'] == 2 )
             
-            starts = patch_faces['vertex']
-            sizes = patch_faces['size']
-            
-            expanded_patches = []
-            expanded_indices = []
-            current_offset = 0
-            index_count = 0
-            for start,(x,y) in zip( starts, sizes ):
-                control_points = self.vertices[start: start+(x*y)]['position']
-                control_points = control_points.reshape( (x,y,3) )
-                
-                expanded = bezier.expand( control_points, final_size=8 )
-                expanded[:,:,3:6] = bezier.expand_blend( 
-                    self.vertices[start: start+(x*y)]['normal'].reshape(x,y,3) 
-                )
-                expanded[:,:,6:8] = bezier.expand_blend( 
-                    self.vertices[start: start+(x*y)]['texcoord_surface'].reshape(x,y,2) 
+            vertices = self.vertices
+            controls = numpy.concatenate( (
+                vertices['position'],
+                vertices['normal'],
+                vertices['texcoord_surface'],
+            ), axis=-1 )
+            starts, sizes = patch_faces['vertex'], patch_faces['size']
+            if self.patch_tolerance:
+                divisions = bezier.adaptive_divisions( 
+                    vertices['position'], starts, sizes, 
+                    tolerance=self.patch_tolerance, 
+                    max_segments=self.patch_max_segments,
                 )
-                
-                indices = bezier.grid_indices( expanded, current_offset )
-                
-                indices = indices.ravel()
-                expanded_indices.append( indices )
-                index_count += len(indices)
-                
-                expanded = expanded.reshape( (-1,expanded.shape[-1]) )
-                expanded_patches.append( expanded )
-                current_offset += expanded.shape[0] 
-            
-            final_indices = numpy.zeros( (index_count,), 'I' )
-            index_count = 0
-            for index in expanded_indices:
-                final_indices[index_count:(index_count+len(index))] = index 
-                index_count += len(index)
-            vertex_count = 0
-            final_vertices = numpy.zeros( (current_offset,8), 'f' )
-            for patch in expanded_patches:
-                final_vertices[vertex_count:(vertex_count+len(patch))] = patch 
-                vertex_count += len(patch)
+            else:
+                divisions = 10
+            final_vertices = bezier.expand_patch_vertices( controls, starts, sizes, divisions )
+            (
+                self.patch_lod_indices, self.patch_lod_starts, self.patch_lod_counts,
+            ) = bezier.patch_lod_indices( sizes, divisions, self.patch_lod_levels )
+            final_indices = self.patch_lod_indices[:numpy.sum( self.patch_lod_counts[0] )]
+            self.patch_face_starts = self.patch_lod_starts[0]
+            self.patch_face_counts = self.patch_lod_counts[0]
+            # bounding spheres of the control points (which contain the surface)
+            positions, owner = visibility.gather_ranges( 
+                vertices['position'], starts, sizes[:,0]*sizes[:,1],
+            )
+            totals = numpy.maximum( numpy.bincount( owner, minlength=len(starts) ), 1 )
+            self.patch_centers = numpy.array( [
+                numpy.bincount( owner, positions[:,axis], minlength=len(starts) )/totals
+                for axis in range(3)
+            ], 'f' ).T
+            distances = numpy.sqrt( numpy.sum( (positions - self.patch_centers[owner])**2, -1 ) )
+            self.patch_radii = numpy.zeros( (len(starts),), 'f' )
+            numpy.maximum.at( self.patch_radii, owner, distances )
+            log.debug( 
+                'Tessellated %s patches to %s vertices, divisions %s', 
+                len(starts), len(final_vertices), numpy.bincount( numpy.atleast_1d( divisions ) ),
+            )
             self.patch_vertices = final_vertices
             self.patch_indices = final_indices
         return self.patch_vertices,self.patch_indices
     
+    def patch_draw_ranges( self, face_mask=None, levels=None ):
+        """Calculate the ranges of patch_lod_indices needed to draw the patches
+        
+        face_mask -- boolean array for each record in self.faces, if None
+            all patches are drawn
+        levels -- level of detail to use for each patch (see patch_lod),
+            if None the full-detail level is used
+        
+        returns (starts, counts) arrays of (merged) ranges
+        """
+        patches = numpy.arange( len(self.patch_face_ids) )
+        if levels is None:
+            levels = numpy.zeros( patches.shape, 'i' )
+        counts = self.patch_lod_counts[levels,patches]
+        if face_mask is not None:
+            counts = numpy.where( face_mask[self.patch_face_ids], counts, 0 )
+        starts, counts, _ = visibility.merge_ranges( 
+            self.patch_lod_starts[levels,patches], counts,
+        )
+        return starts, counts
+    
+    def patch_lod( self, position ):
+        """Choose a level of detail for each patch by distance from position
+        
+        Patches within patch_lod_distance use full detail, each doubling of 
+        the distance after that drops one level.
+        
+        returns level array for use with patch_draw_ranges
+        """
+        distances = numpy.sqrt( numpy.sum( (self.patch_centers - position)**2, -1 ) ) - self.patch_radii
+        ratio = numpy.maximum( distances, 1.0 ) / self.patch_lod_distance
+        levels = numpy.ceil( numpy.log2( numpy.maximum( ratio, 1.0 ) ) )
+        return numpy.minimum( levels, self.patch_lod_levels - 1 ).astype( 'i' )
+    
     def load_texture_by_id( self, id, texture=None ):
         """Load a single texture by ID (index)
         
-        returns PIL Image instance or None if image is not found
+        returns PIL Image (texturecache.MipTexture with texture_cache) 
+        or Brush instance or None if image is not found
         """
         if id in (
             'textures/common/hintskip',
@@ -314,34 +610,59 @@ class Twitch( object ):
         img = None
         img = self.load_script( id, relative )
         if img is None:
-            img = self._load_image_file( relative )
+            img = self._load_plain_texture( relative )
         if not img:
             log.warn( "Unable to find Image #%s: %s", id, relative )
         return img 
     
-    def _load_image_file( self, relative ):
+    _search_path = None
+    @property
+    def search_path( self ):
+        """Layered search path of the map's pack and the other packs (see twitchoglc.searchpath)"""
+        if self._search_path is None:
+            self._search_path = searchpath.search_path(
+                searchpath.default_layers( self.base_directory )
+            )
+        return self._search_path
+    
+    _texture_index = None
+    @property
+    def texture_index( self ):
+        """Index of image files for resolving texture names (see twitchoglc.textureindex)"""
+        if self._texture_index is None:
+            self._texture_index = textureindex.TextureIndex( self.search_path )
+        return self._texture_index
+    
+    # decode plain textures to power-of-two mip chains cached in texturecache.CACHE_DIR
+    texture_cache = True
+    texture_max_size = texturecache.MAX_SIZE
+    def _find_image_file( self, relative ):
         if pk3.escape_path( relative ):
             raise IOError( """Texture: %s references an external file"""%( relative ))
-        extensions = ['', '.tga','.jpg','.png','.jpeg']
-        path = os.path.join( self.base_directory, relative )
-        directory,basename = os.path.split( path )
-        alt_path = os.path.join( directory, 'x_'+basename )
-        img = None
-        from_others = glob.glob(os.path.join(pk3.MAPS_DIR,'*',relative+'.???'))
-        for possible in [path,alt_path] + from_others:
-            for extension in extensions:
-                final = possible + extension
-                if os.path.exists( final ):
-                    from PIL import Image
-                    img = Image.open( final )
-                    x,y = img.size 
-                    if not self.is_pow2( x ) or not self.is_pow2( y ):
-                        log.warn( 'Non power-of-two Image %s: %sx%s', relative, x, y )
-                    log.debug( "Image #%s %s %s: %sx%s,", id, relative, img.mode, img.size[0], img.size[1] )
-                    img.info[ 'url' ] = final
-                    img.info[ 'filename' ] = final
-                    return img
-        return None
+        return self.texture_index.find( relative )
+    
+    def _load_plain_texture( self, relative ):
+        """Load a texture which has no script (see texture_cache)"""
+        if not self.texture_cache:
+            return self._load_image_file( relative )
+        final = self._find_image_file( relative )
+        if final is None:
+            return None
+        return texturecache.load_texture( final, self.texture_max_size )
+    
+    def _load_image_file( self, relative ):
+        final = self._find_image_file( relative )
+        if final is None:
+            return None
+        from PIL import Image
+        img = Image.open( pk3.open_path( final ) )
+        x,y = img.size 
+        if not self.is_pow2( x ) or not self.is_pow2( y ):
+            log.warn( 'Non power-of-two Image %s: %sx%s', relative, x, y )
+        log.debug( "Image %s %s: %sx%s,", relative, img.mode, img.size[0], img.size[1] )
+        img.info[ 'url' ] = final
+        img.info[ 'filename' ] = final
+        return img
     
     def load_script( self, id, name ):
         """Find a script by name, to create a non-default texture"""
@@ -350,20 +671,31 @@ class Twitch( object ):
             img = self.compile_script( id, self.brushes[id] )
         return img 
     
+    @property
+    def shader_registry( self ):
+        """Shader definitions of all the scripts in our search path (see twitchoglc.shaderregistry)"""
+        if pk3.escape_path( self.model_name ):
+            raise RuntimeError( 'Map name %s includes special shell characters, aborting'%(self.model_name,) )
+        return shaderregistry.shader_registry(
+            self.search_path, 'scripts/%s.shader'%(self.model_name,),
+        )
+    
     _shader_brushes = None
     @property
     def brushes( self ):
+        """{name: Brush} for the shaders in our own script and those our textures use"""
         if self._shader_brushes is None:
-            log.info( 'Parsing shader files' )
-            self._shader_brushes = {}
-            shader_path = os.path.join( 'scripts','%s.shader'%(self.model_name))
-            if pk3.escape_path( self.model_name ):
-                raise RuntimeError( 'Map name %s includes special shell characters, aborting'%(self.model_name,) )
-            for script_file in glob.glob( os.path.join( self.base_directory, shader_path )):
-                from . import shaderparser
-                for id,definition in shaderparser.load( script_file ).items():
-                    brush = self.brush_class( id, definition )
-                    self._shader_brushes[id] = brush
+            log.info( 'Loading shader definitions' )
+            registry = self.shader_registry
+            definitions = dict( registry.script_definitions( 'scripts/%s.shader'%(self.model_name,) ) )
+            for texture in self.textures:
+                found = registry.find( b''.join( texture['filename'] ).decode( 'utf-8' ) )
+                if found:
+                    definitions.setdefault( *found )
+            self._shader_brushes = dict([
+                (id,self.brush_class( id, definition ))
+                for id,definition in definitions.items()
+            ])
         return self._shader_brushes
     
     sky_brushes = None
@@ -382,7 +714,57 @@ class Twitch( object ):
             brush.load(self)
         return brush
     
-    def load_textures( self ):
+    # number of threads decoding textures (None for one per CPU, 0 for serial)
+    texture_workers = None
+    def _decoded_texture( self, id, texture ):
+        """Load texture id and force its image(s) to decode
+        
+        PIL only reads headers on open, decoding on first access, we
+        want that done in the (worker) thread calling us.
+        """
+        img = self.load_texture_by_id( id, texture )
+        if isinstance( img, brushmodel.Brush ):
+            images = list(img.images.values())
+        else:
+            images = [img]
+        for image in images:
+            if image is not None and hasattr( image, 'load' ):
+                image.load()
+        return img
+    
+    def iter_textures( self, workers=None, ids=None ):
+        """Load and decode all of our textures, yielding them as they finish
+        
+        workers -- number of decoding threads, defaults to texture_workers,
+            0 decodes serially in the calling thread (in ids order)
+        ids -- texture ids to load, in the order to start decoding them,
+            defaults to every texture in id order
+        
+        yields (id,PILImage or Brush or None) for each texture in ids 
+        (defined in the .bsp file), in completion order when using workers
+        """
+        if ids is None:
+            ids = range( len(self.textures) )
+        if workers is None:
+            workers = self.texture_workers
+        if workers is None:
+            workers = min( 8, os.cpu_count() or 1 ) if hasattr( os, 'cpu_count' ) else 0
+        if not workers or futures is None:
+            for id in ids:
+                yield id, self._decoded_texture( id, self.textures[id] )
+            return
+        # shared lazy state must be set up before the workers race for it
+        self.brushes
+        self.texture_index
+        with futures.ThreadPoolExecutor( workers ) as pool:
+            pending = dict([
+                (pool.submit( self._decoded_texture, id, self.textures[id] ),id)
+                for id in ids
+            ])
+            for future in futures.as_completed( pending ):
+                yield pending[future], future.result()
+    
+    def load_textures( self, workers=None ):
         """Load all of our textures
         
         Note: we do *not* keep a copy, the caller should do so 
@@ -390,16 +772,26 @@ class Twitch( object ):
         returns [(id,PILImage or None),...] for each texture defined in the 
         .bsp file
         """
-        loaded_textures = []
-        for id,texture in enumerate(self.textures):
-            loaded_textures.append( (id,self.load_texture_by_id( id, texture )) )
-        return loaded_textures
+        return sorted( self.iter_textures( workers ), key=lambda record: record[0] )
     
     def iter_lightmaps( self ):
         """Load all of our lightmaps"""
         for id,texture in enumerate(self.lightmaps):
             yield id,texture[0]
     
+    def iter_lightmap_pages( self ):
+        """Load our lightmaps as atlas pages (or separately without an atlas)
+        
+        yields (id,data) where id matches the lm_index of texture_set
+        """
+        if not self.lightmap_atlas_size:
+            for record in self.iter_lightmaps():
+                yield record
+            return
+        pages = self.lightmap_atlas[0]
+        for id in range( len(pages) ):
+            yield id, pages[id]
+    
     @staticmethod
     def is_pow2( size ):
         """Is this an even power of two size?"""
@@ -414,12 +806,17 @@ class Twitch( object ):
     
         
 def load( filename, base_directory=None, brush_class=None ):
-    if base_directory is None:
+    """Load the .bsp filename (a file or pk3 archive path, see pk3.PK3Archive)"""
+    if base_directory is None and pk3.is_archive_path( filename ):
+        archive, member = pk3.split_archive_path( filename )
+        member_base = os.path.dirname( os.path.dirname( member ) )
+        base_directory = pk3.join_path( archive, member_base ) if member_base else archive
+    elif base_directory is None:
         # TODO: this could, in theory, produce a directory traversal attack
         # if you unpacked your file next to something important and called 
         # parse without a root directory...
         base_directory = os.path.dirname( os.path.dirname( filename ) )
-    array = numpy.memmap( filename, dtype='c', mode='c' )
+    array = pk3.read_array( filename )
     return Twitch( filename, parse_bsp( array ), base_directory, brush_class=brush_class )
 
 def get_options():
@@ -428,21 +825,40 @@ def get_options():
         description='Attempts to parse bsp files and report their structure'
     )
     parser.add_argument(
-        'target',help='A .bsp (or .pk3) file to (unpack and) parse',
+        '--header',
+        help='Only read the header, reporting lump offsets and sizes',
+        default=False,
+        action='store_true',
+    )
+    parser.add_argument(
+        'target',help='A .bsp (or .pk3) file to parse',
     )
     return parser
 
+def report_header( filename ):
+    """Print the lump directory of filename"""
+    print( filename )
+    for lump,offset,length in read_header( filename ):
+        if 'load_%s'%(lump,) in globals():
+            # custom-format lump, no fixed record size
+            records = '-'
+        else:
+            records = length // numpy.dtype( LUMP_DTYPES[lump] ).itemsize
+        print( '  %-12s offset=%-10d size=%-10d records=%s'%( 
+            lump, offset, length, records,
+        ))
+
 def main():
-    logging.basicConfig( level=logging.DEBUG )
     parser = get_options()
     options = parser.parse_args()
+    logging.basicConfig( level=logging.WARNING if options.header else logging.DEBUG )
     target = options.target 
     base_directory = None
     if target.endswith( '.pk3' ):
-        from . import pk3 
-        key = pk3.key( target )
-        base_directory = pk3.unpack_directory( key )
-        target = pk3.unpack( target, base_directory )
+        target = pk3.find_bsp( target )
+    if options.header:
+        report_header( target )
+        return None
     twitch = load( target, base_directory )
     twitch.load_textures()
     return twitch
@@ -0,0 +1,383 @@
+"""Shader/vertex-array-object backend for maprender.Map
+
+The fixed-function path re-specifies every client-array pointer each
+frame and binds textures through the scenegraph nodes.  This backend
+instead records the vertex layouts of the world and patch geometry in
+vertex array objects once, when first rendered, and draws with a GLSL
+program which modulates the diffuse texture by the lightmap.  Each
+draw of the map's state-sorted draw list (see twitchoglc.drawlist) is
+submitted with a single glMultiDrawElements, or, where OpenGL 4.3 is
+available, all draws' ranges are written to one indirect buffer and
+each draw is a single glMultiDrawElementsIndirect.
+
+The shaders only use GLSL 1.30 with an explicit matrix uniform (no
+fixed-function state), so they run in core profiles and under software
+implementations such as Mesa llvmpipe/OSMesa.  Faces with packed
+textures (see twitchoglc.packedrender) are drawn with the pack's shader
+from their own vertex array object.
+"""
+from __future__ import absolute_import
+import logging, ctypes, numpy
+from OpenGL.GL import *
+from OpenGL.GL import shaders
+from OpenGL.arrays import vbo
+from . import brushmodel, texturecache
+log = logging.getLogger( __name__ )
+
+VERTEX_SHADER = '''#version 130
+uniform mat4 modelproj;
+in vec3 position;
+in vec2 texcoord;
+in vec2 lightmap_coord;
+out vec2 v_texcoord;
+out vec2 v_lightmap;
+void main() {
+    gl_Position = modelproj * vec4( position, 1.0 );
+    v_texcoord = texcoord;
+    v_lightmap = lightmap_coord;
+}
+'''
+FRAGMENT_SHADER = '''#version 130
+uniform sampler2D diffuse;
+uniform sampler2D lightmap;
+in vec2 v_texcoord;
+in vec2 v_lightmap;
+out vec4 colour;
+void main() {
+    colour = texture( diffuse, v_texcoord ) * texture( lightmap, v_lightmap );
+}
+'''
+PATCH_VERTEX_SHADER = '''#version 130
+uniform mat4 modelproj;
+in vec3 position;
+in vec3 normal;
+out float v_shade;
+void main() {
+    gl_Position = modelproj * vec4( position, 1.0 );
+    v_shade = 0.5 + 0.5 * abs( dot( normalize( normal ), vec3( 0.3, 0.4, 0.866 ) ) );
+}
+'''
+PATCH_FRAGMENT_SHADER = '''#version 130
+in float v_shade;
+out vec4 colour;
+void main() {
+    colour = vec4( v_shade, v_shade, v_shade, 1.0 );
+}
+'''
+# (attribute, components, byte offset) in bsp.VERTEX_RECORD
+WORLD_ATTRIBUTES = [
+    ('position',3,0),
+    ('texcoord',2,12),
+    ('lightmap_coord',2,20),
+]
+# (attribute, components, float offset) in bsp.Twitch.patch_faces vertices
+PATCH_ATTRIBUTES = [
+    ('position',3,0),
+    ('normal',3,3),
+]
+# DrawElementsIndirectCommand
+INDIRECT_RECORD = numpy.dtype([
+    ('count','<u4'),
+    ('instances','<u4'),
+    ('first','<u4'),
+    ('base_vertex','<i4'),
+    ('base_instance','<u4'),
+])
+
+def gl_version():
+    """(major,minor) version of the current context"""
+    try:
+        version = glGetString( GL_VERSION )
+        return tuple( [int( x ) for x in version.split( b' ' )[0].split( b'.' )[:2]] )
+    except (TypeError, ValueError, AttributeError, GLError):
+        return (0,0)
+
+def supports_indirect():
+    """Does the current context support glMultiDrawElementsIndirect (OpenGL 4.3)?"""
+    return gl_version() >= (4,3) and bool( glMultiDrawElementsIndirect )
+
+def compile_program( vertex, fragment ):
+    return shaders.compileProgram(
+        shaders.compileShader( vertex, GL_VERTEX_SHADER ),
+        shaders.compileShader( fragment, GL_FRAGMENT_SHADER ),
+    )
+
+def upload_texture( data, format=GL_RGB ):
+    """Create a linear-filtered texture from an H x W x C uint8 array"""
+    texture = glGenTextures( 1 )
+    glBindTexture( GL_TEXTURE_2D, texture )
+    glPixelStorei( GL_UNPACK_ALIGNMENT, 1 )
+    height, width = data.shape[:2]
+    glTexImage2D(
+        GL_TEXTURE_2D, 0, GL_RGBA8 if format == GL_RGBA else GL_RGB8, width, height, 0,
+        format, GL_UNSIGNED_BYTE, numpy.ascontiguousarray( data ),
+    )
+    glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR )
+    glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR )
+    glBindTexture( GL_TEXTURE_2D, 0 )
+    return texture
+
+def upload_levels( levels ):
+    """Create a mipmapped, repeating texture from RGBA levels (largest first)"""
+    texture = glGenTextures( 1 )
+    glBindTexture( GL_TEXTURE_2D, texture )
+    glPixelStorei( GL_UNPACK_ALIGNMENT, 1 )
+    for number,level in enumerate( levels ):
+        height, width = level.shape[:2]
+        glTexImage2D(
+            GL_TEXTURE_2D, number, GL_RGBA8, width, height, 0,
+            GL_RGBA, GL_UNSIGNED_BYTE, numpy.ascontiguousarray( level ),
+        )
+    glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR )
+    glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR )
+    glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT )
+    glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT )
+    return texture
+
+def script_image( brush ):
+    """Get the (PIL) image for the first image stage of a scripted brush"""
+    for suite in brush.suites:
+        for command in suite:
+            if command[0] in ('map','clampMap') and brush.images.get( command[1][0] ):
+                return brush.images[command[1][0]]
+    return None
+
+class CoreRenderer( object ):
+    """Draws a loaded maprender.Map with shaders and vertex array objects
+
+    Must be uploaded (upload) with a valid context before use.
+    """
+    program = None
+    patch_program = None
+    # whether to use glMultiDrawElementsIndirect where available
+    use_indirect = True
+    indirect = None
+    batches = ()
+    _batch_source = None
+    packed_array = None
+    _packed_source = None
+    def __init__( self, map ):
+        self.map = map
+    def upload( self ):
+        """Compile the programs, build the vertex array objects and textures"""
+        map = self.map
+        self.program = compile_program( VERTEX_SHADER, FRAGMENT_SHADER )
+        glUseProgram( self.program )
+        glUniform1i( glGetUniformLocation( self.program, 'diffuse' ), 0 )
+        glUniform1i( glGetUniformLocation( self.program, 'lightmap' ), 1 )
+        glUseProgram( 0 )
+        self.modelproj = glGetUniformLocation( self.program, 'modelproj' )
+        self.world_array = self.vertex_array(
+            self.program, map.simple_vertices, map.simple_indices,
+            map.simple_vertices.itemsize, WORLD_ATTRIBUTES,
+        )
+        if map.patch_indices is not None:
+            self.patch_program = compile_program( PATCH_VERTEX_SHADER, PATCH_FRAGMENT_SHADER )
+            self.patch_modelproj = glGetUniformLocation( self.patch_program, 'modelproj' )
+            itemsize = map.patch_vertices.itemsize
+            self.patch_array = self.vertex_array(
+                self.patch_program, map.patch_vertices, map.patch_indices,
+                itemsize * map.patch_vertices.shape[-1],
+                [(name,size,offset*itemsize) for name,size,offset in PATCH_ATTRIBUTES],
+            )
+        self.white = upload_texture( numpy.full( (1,1,3), 255, 'B' ) )
+        self.lightmaps = dict([
+            (id,upload_texture( lightmap.data ))
+            for id,lightmap in map.lightmaps.items()
+        ])
+        self.textures = dict([
+            (id,self.texture_handle( texture ))
+            for id,texture in map.textures.items()
+        ])
+        if self.use_indirect and supports_indirect():
+            self.indirect = vbo.VBO(
+                numpy.zeros( (1,), INDIRECT_RECORD ), target=GL_DRAW_INDIRECT_BUFFER,
+            )
+        log.info(
+            'Core renderer uploaded %s textures, %s lightmaps, %s',
+            len(self.textures), len(self.lightmaps),
+            'indirect draws' if self.indirect is not None else 'multi-draws',
+        )
+
+    def packed_vertex_array( self ):
+        """Build the vertex array object for the map's (uploaded) texture pack"""
+        map = self.map
+        # the pack's enable() records its attribute pointers in the array
+        array = glGenVertexArrays( 1 )
+        glBindVertexArray( array )
+        map.packed_textures.enable( map.simple_vertices, map.texture_data )
+        map.simple_indices.bind()
+        glBindVertexArray( 0 )
+        glUseProgram( 0 )
+        map.simple_vertices.unbind()
+        map.simple_indices.unbind()
+        self._packed_source = map.packed_textures
+        return array
+
+    def vertex_array( self, program, vertices, indices, stride, attributes ):
+        """Record the attribute pointers and index buffer for program in a new VAO"""
+        array = glGenVertexArrays( 1 )
+        glBindVertexArray( array )
+        vertices.bind()
+        for name,size,offset in attributes:
+            location = glGetAttribLocation( program, name )
+            if location >= 0:
+                glEnableVertexAttribArray( location )
+                glVertexAttribPointer(
+                    location, size, GL_FLOAT, GL_FALSE, stride, vertices+offset,
+                )
+        indices.bind()
+        glBindVertexArray( 0 )
+        vertices.unbind()
+        indices.unbind()
+        return array
+
+    def texture_handle( self, texture ):
+        """Get the GL texture name for a maprender texture (None for nodraw)
+
+        MipmapTexture provides its name, the images of scenegraph
+        ImageTextures and of scripted brushes' first stage are uploaded
+        directly (so no scenegraph render mode is needed).
+        """
+        if texture is None or getattr( texture, 'nodraw', None ):
+            return None
+        if hasattr( texture, 'handle' ):
+            return texture.handle()
+        if isinstance( texture, brushmodel.Brush ):
+            image = script_image( texture )
+        else:
+            image = getattr( texture, 'image', None )
+        if image is None:
+            return self.white
+        return upload_levels( texturecache.MipTexture.from_image( image ).levels )
+
+    def texture_name( self, id ):
+        """Get the GL name for map texture id, uploading textures loaded since upload"""
+        if id is None:
+            return self.white
+        if id not in self.textures:
+            self.textures[id] = self.texture_handle( self.map.textures.get( id ) )
+        return self.textures[id]
+
+    def update_batches( self ):
+        """Resolve the map's state-sorted draws to GL names, refilling the indirect buffer"""
+        map = self.map
+        batches = []
+        for (cull,lightmap,id),starts,counts in map.draws:
+            batches.append( [
+                self.lightmaps.get( lightmap, self.white ),
+                self.texture_name( id ),
+                cull, int( numpy.sum( counts ) ), starts, counts,
+            ] )
+        if self.indirect is not None:
+            total = sum( [len(batch[-1]) for batch in batches] )
+            commands = numpy.zeros( (max( total, 1 ),), INDIRECT_RECORD )
+            offset = 0
+            for batch in batches:
+                starts, counts = batch[-2:]
+                commands['count'][offset:offset+len(counts)] = counts
+                commands['first'][offset:offset+len(counts)] = starts
+                # the indirect draw needs (byte offset, draw count) instead of ranges
+                batch[-2:] = [offset * INDIRECT_RECORD.itemsize, len(counts)]
+                offset += len(counts)
+            commands['instances'] = 1
+            self.indirect.set_array( commands )
+        self.batches = batches
+        self._batch_source = map.draws
+
+    def draw_batch( self, indices, first, second ):
+        """Draw one batch's ranges of the bound vertex array's indices"""
+        if self.indirect is not None:
+            glMultiDrawElementsIndirect(
+                GL_TRIANGLES, GL_UNSIGNED_INT, ctypes.c_void_p( first ), second, 0,
+            )
+            if self.map.stats is not None:
+                self.map.stats.count( 'draw_calls' )
+                self.map.stats.count( 'triangles', indices // 3 )
+        else:
+            self.map.draw_ranges( self.map.simple_indices, first, second )
+
+    def render( self, mode, modelproj ):
+        """Draw the map's current batches
+
+        modelproj -- model-projection matrix in map coordinates
+        """
+        map = self.map
+        stats = map.stats
+        if self.program is None:
+            self.upload()
+        if map.draws is not self._batch_source:
+            self.update_batches()
+        if map.packed_batches and map.packed_textures is not self._packed_source:
+            # the pack arrives after the textures when loading progressively
+            self.packed_array = None
+            if map.packed_textures.program is not None:
+                self.packed_array = self.packed_vertex_array()
+        cull = map.set_cull( 'front', 'none' )
+        if map.packed_batches and self.packed_array is not None:
+            if stats is not None:
+                stats.phase( 'packed' )
+            glUseProgram( map.packed_textures.program )
+            map.packed_textures.set_modelproj( modelproj )
+            glBindVertexArray( self.packed_array )
+            current_lightmap = None
+            for lightmap,group,starts,counts in map.packed_batches:
+                if not len(counts):
+                    continue
+                lightmap = self.lightmaps.get( lightmap, self.white )
+                if lightmap != current_lightmap:
+                    glActiveTexture( GL_TEXTURE1 )
+                    glBindTexture( GL_TEXTURE_2D, lightmap )
+                    current_lightmap = lightmap
+                    if stats is not None:
+                        stats.count( 'lightmap_binds' )
+                map.packed_textures.bind( group )
+                if stats is not None:
+                    stats.count( 'texture_binds' )
+                map.draw_ranges( map.simple_indices, starts, counts )
+            glBindTexture( map.packed_textures.target, 0 )
+        if stats is not None:
+            stats.phase( 'world' )
+        glUseProgram( self.program )
+        glUniformMatrix4fv( self.modelproj, 1, GL_FALSE, modelproj )
+        glBindVertexArray( self.world_array )
+        if self.indirect is not None:
+            self.indirect.bind()
+        try:
+            current_lightmap = current_texture = None
+            for lightmap,texture,batch_cull,indices,first,second in self.batches:
+                if lightmap != current_lightmap:
+                    glActiveTexture( GL_TEXTURE1 )
+                    glBindTexture( GL_TEXTURE_2D, lightmap )
+                    current_lightmap = lightmap
+                    if stats is not None:
+                        stats.count( 'lightmap_binds' )
+                if texture != current_texture:
+                    glActiveTexture( GL_TEXTURE0 )
+                    glBindTexture( GL_TEXTURE_2D, texture )
+                    current_texture = texture
+                    if stats is not None:
+                        stats.count( 'texture_binds' )
+                new_cull = map.set_cull( batch_cull, cull )
+                if stats is not None and new_cull != cull:
+                    stats.count( 'cull_changes' )
+                cull = new_cull
+                self.draw_batch( indices, first, second )
+        finally:
+            if self.indirect is not None:
+                self.indirect.unbind()
+        if self.patch_program is not None and len(map.patch_ranges[1]):
+            if stats is not None:
+                stats.phase( 'patches' )
+            cull = map.set_cull( 'none', cull )
+            glUseProgram( self.patch_program )
+            glUniformMatrix4fv( self.patch_modelproj, 1, GL_FALSE, modelproj )
+            glBindVertexArray( self.patch_array )
+            map.draw_ranges( map.patch_indices, *map.patch_ranges )
+        map.set_cull( 'none', cull )
+        glBindVertexArray( 0 )
+        glActiveTexture( GL_TEXTURE1 )
+        glBindTexture( GL_TEXTURE_2D, 0 )
+        glActiveTexture( GL_TEXTURE0 )
+        glBindTexture( GL_TEXTURE_2D, 0 )
+        glUseProgram( 0 )
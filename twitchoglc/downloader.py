@@ -1,17 +1,28 @@
-"""Utility to pull a pk3 file from the internet and unpack it for viewing"""
+"""Utility to pull a pk3 file from the internet for viewing"""
 import requests
 import os, shutil, logging, glob
 from six.moves import urllib_parse
-from . import pk3
+from . import pk3, searchpath
 log = logging.getLogger(__name__)
 
-def pull_pk3(url, force=False, resources=False):
+def pull_pk3(url, force=False, resources=False, unpack=False):
+    """Download url into the cache (if not already there)
+
+    unpack -- extract the archive, otherwise the map is read in place
+
+    returns path (archive path unless unpacked) of the bsp file
+    """
     key = pk3.key(url)
     directory = pk3.unpack_directory(key)
+    source = os.path.join(directory,'source-file')
+    if resources:
+        # gives the pack priority over map packs in the search path
+        open(os.path.join(directory, searchpath.RESOURCES_MARKER), 'w').close()
     bsps = sorted(glob.glob(os.path.join(directory,'maps/*.bsp')))
     textures = sorted(glob.glob(os.path.join(directory,'textures/*')))
+    if not (force or unpack or bsps or textures) and os.path.exists(source):
+        return pk3.find_bsp(source, resources=resources)
     if force or (not resources and (not bsps)) or (resources and not textures):
-        source = os.path.join(directory,'source-file')
         url_file = os.path.join(directory,'.url')
         if force or not os.path.exists(source):
             log.info("Downloading target pk3: %r", url)
@@ -27,6 +38,8 @@ def pull_pk3(url, force=False, resources=False):
                         fh.write(chunk)
                 with open(url_file,'w') as fh:
                     fh.write(url)
+                if not unpack:
+                    return pk3.find_bsp(download_file, resources=resources)
                 return pk3.unpack(download_file, directory, resources=resources)
             except Exception as err:
                 log.error("Failure downloading, removing the cache directory: %s",err) 
@@ -44,7 +57,7 @@ def pull_pk3(url, force=False, resources=False):
 def get_options():
     import argparse 
     parser = argparse.ArgumentParser(
-        description='Download PK3 files from the internet and unpack locally'
+        description='Download PK3 files from the internet into the local cache'
     )
     parser.add_argument(
         '-f','--force',
@@ -58,6 +71,12 @@ def get_options():
         default=False,
         action='store_true',
     )
+    parser.add_argument(
+        '-u','--unpack',
+        help='Unpack the downloaded archive rather than reading it in place',
+        default=False,
+        action='store_true',
+    )
     parser.add_argument(
         'url',help='The http/https url to download to the local cache',
     )
@@ -66,5 +85,5 @@ def get_options():
 def main():
     logging.basicConfig(level=logging.DEBUG)
     options = get_options().parse_args()
-    bsp = pull_pk3(options.url,force=options.force, resources=options.resources)
+    bsp = pull_pk3(options.url,force=options.force, resources=options.resources, unpack=options.unpack)
     log.info("Downloaded to %s", bsp)
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""Render-state sorted draw lists for a map's simple faces
+
+Twitch.texture_set orders the simple faces by (lightmap,texture), which
+doesn't account for the cull mode of scripted textures, for textures
+which are never drawn, or for batches which would be drawn with the
+same GL state.  A DrawList is compiled once after the textures are
+loaded, grouping the batches into draws by their render state
+(cull, lightmap, texture) and ordering the draws to minimize the number
+of state switches.  When the visible faces change the draws' ranges are
+gathered (merging adjacent ranges) and flattened into a list of
+(operation, value) commands, with redundant state changes removed,
+which the render loop replays every frame.
+"""
+from __future__ import absolute_import
+import itertools
+import numpy
+from .visibility import merge_ranges
+
+# DISABLE (restore the state set by a texture's render) isn't emitted by
+# commands, the renderer adds it for textures which need it
+CULL, LIGHTMAP, TEXTURE, DRAW, DISABLE = range( 5 )
+STATE_OPERATIONS = (CULL, LIGHTMAP, TEXTURE)
+
+def count_changes( states ):
+    """Count the state switches needed to draw states in order"""
+    changes = 0
+    for previous, state in zip( states[:-1], states[1:] ):
+        changes += sum( [a != b for a,b in zip( previous, state )] )
+    return changes
+
+def sort_key( value ):
+    # None (keep the current state) sorts before everything else
+    return (value is not None, value)
+
+def sort_states( states ):
+    """Order (unique) states to minimize the number of state switches
+
+    Tries each priority of the state's fields (e.g. cull then lightmap
+    then texture) keeping the order with the fewest switches.
+    """
+    states = list( states )
+    if not states:
+        return states
+    best = None
+    for priority in itertools.permutations( range( len(states[0]) ) ):
+        ordered = sorted(
+            states, key=lambda state: [sort_key( state[i] ) for i in priority],
+        )
+        changes = count_changes( ordered )
+        if best is None or changes < best[0]:
+            best = (changes, ordered)
+    return best[1]
+
+class DrawList( object ):
+    """Batches of Twitch.simple_draw_ranges grouped and sorted by render state
+
+    states -- (cull, lightmap, texture) of each draw in draw order, a
+        None lightmap or texture leaves the current one bound
+    draws -- {(lightmap,texture id): draw index} for each drawn batch
+    """
+    def __init__( self, batch_states ):
+        """Compile the draws for batch_states
+
+        batch_states -- {(lightmap,texture id): state} for each batch,
+            state None for batches which are not drawn
+        """
+        self.states = sort_states( set( [
+            state for state in batch_states.values() if state is not None
+        ] ) )
+        index = dict( [(state,draw) for draw,state in enumerate( self.states )] )
+        self.draws = dict( [
+            (key, index[state])
+            for key,state in batch_states.items()
+            if state is not None
+        ] )
+
+    def ranges( self, batches ):
+        """Gather the visible ranges of each draw
+
+        batches -- [(lightmap,texture,starts,counts),...] as from
+            Twitch.simple_draw_ranges
+
+        returns [(state,starts,counts),...] for the draws with visible
+        ranges, in draw order
+        """
+        groups = {}
+        for lightmap,texture,starts,counts in batches:
+            draw = self.draws.get( (lightmap,texture) )
+            if draw is not None and len(counts):
+                groups.setdefault( draw, [] ).append( (starts,counts) )
+        result = []
+        for draw in sorted( groups ):
+            parts = groups[draw]
+            if len(parts) == 1:
+                starts, counts = parts[0]
+            else:
+                starts = numpy.concatenate( [starts for starts,counts in parts] )
+                counts = numpy.concatenate( [counts for starts,counts in parts] )
+                sort = numpy.argsort( starts, kind='stable' )
+                starts, counts, _ = merge_ranges( starts[sort], counts[sort] )
+            result.append( (self.states[draw], starts, counts) )
+        return result
+
+    @staticmethod
+    def commands( draws, initial=(None,None,None) ):
+        """Flatten draws into [(operation,value),...] for replay
+
+        draws -- [(state,starts,counts),...] as from ranges
+        initial -- state already set when the commands are replayed
+
+        State changes are only emitted where the value differs from the
+        current one, DRAW commands have (starts,counts) as their value.
+        """
+        current = list( initial )
+        commands = []
+        for state,starts,counts in draws:
+            for field,(operation,value) in enumerate( zip( STATE_OPERATIONS, state ) ):
+                if value is not None and value != current[field]:
+                    commands.append( (operation,value) )
+                    current[field] = value
+            commands.append( (DRAW,(starts,counts)) )
+        return commands
@@ -0,0 +1,149 @@
+"""Parsing and querying of the entities lump
+
+The entities lump is a text block of entity definitions, each a set of
+"key" "value" pairs between braces, e.g.:
+
+    {
+    "classname" "info_player_deathmatch"
+    "origin" "-100 0 24"
+    "angle" "90"
+    }
+
+The lump is parsed once into an EntityTable, which keeps the entities
+as dictionaries along with indexes by classname and targetname and
+arrays of origins and angles for vectorized spatial queries.
+"""
+from __future__ import absolute_import
+import re, logging
+import numpy
+log = logging.getLogger( __name__ )
+
+ENTITY = re.compile( r'\{([^{}]*)\}' )
+KEY_VALUE = re.compile( r'"([^"]*)"\s+"([^"]*)"' )
+# classnames which mark places the player can start, in order of preference
+SPAWN_CLASSES = [
+    'info_player_start',
+    'info_player_deathmatch',
+    'team_CTF_redspawn',
+    'team_CTF_bluespawn',
+    'team_CTF_redplayer',
+    'team_CTF_blueplayer',
+]
+
+def parse_entities( text ):
+    """Parse entities text into a list of {key:value} dictionaries"""
+    if not isinstance( text, str ):
+        text = text.decode( 'latin-1' )
+    return [
+        dict( KEY_VALUE.findall( body ) )
+        for body in ENTITY.findall( text )
+    ]
+
+def parse_vectors( values, size=3 ):
+    """Parse space-separated vector strings to an N x size float array
+
+    Missing or malformed values are nan
+    """
+    result = numpy.full( (len(values),size), numpy.nan, dtype='f' )
+    for i,value in enumerate( values ):
+        if value:
+            try:
+                vector = [float(x) for x in value.split()]
+            except ValueError:
+                continue
+            if len(vector) == size:
+                result[i] = vector
+    return result
+
+def _index( entities, key ):
+    """Create {value:index array} for the entities having key"""
+    index = {}
+    for i,entity in enumerate( entities ):
+        value = entity.get( key )
+        if value is not None:
+            index.setdefault( value, [] ).append( i )
+    return dict([
+        (value,numpy.array( indices, dtype='i' ))
+        for value,indices in index.items()
+    ])
+
+class EntityTable( object ):
+    """Parsed entities with indexes for querying
+
+    entities -- list of {key:value} dictionaries
+    classnames -- {classname: index array}
+    targetnames -- {targetname: index array}
+    origins -- N x 3 array of origins (nan if the entity has none)
+    angles -- N array of yaw angles in degrees (0 if the entity has none)
+    """
+    def __init__( self, entities ):
+        self.entities = entities
+        self.classnames = _index( entities, 'classname' )
+        self.targetnames = _index( entities, 'targetname' )
+        self.origins = parse_vectors( [entity.get( 'origin' ) for entity in entities] )
+        self.has_origin = ~numpy.any( numpy.isnan( self.origins ), -1 )
+        self.angles = numpy.nan_to_num(
+            parse_vectors( [entity.get( 'angle' ) for entity in entities], 1 )[:,0]
+        )
+
+    @classmethod
+    def from_lump( cls, lump ):
+        """Parse the (numpy 'c' array) entities lump"""
+        return cls( parse_entities( numpy.asarray( lump ).tobytes().rstrip( b'\0' ) ) )
+
+    def __len__( self ):
+        return len(self.entities)
+    def __getitem__( self, index ):
+        return self.entities[index]
+    def __iter__( self ):
+        return iter( self.entities )
+
+    @property
+    def worldspawn( self ):
+        """The worldspawn entity's keys (empty if there is none)"""
+        for index in self.classnames.get( 'worldspawn', () ):
+            return self.entities[index]
+        return {}
+
+    def find( self, classname=None, targetname=None ):
+        """Find indices of entities with the given classname and/or targetname"""
+        selected = numpy.arange( len(self.entities), dtype='i' )
+        if classname is not None:
+            selected = self.classnames.get( classname, selected[:0] )
+        if targetname is not None:
+            selected = numpy.intersect1d(
+                selected, self.targetnames.get( targetname, selected[:0] ),
+            )
+        return selected
+
+    def in_box( self, mins, maxs, classname=None ):
+        """Find indices of entities with origins inside the (mins,maxs) box"""
+        selected = self.find( classname )
+        origins = self.origins[selected]
+        inside = numpy.all(
+            (origins >= numpy.asarray( mins, 'f' )) & (origins <= numpy.asarray( maxs, 'f' )),
+            -1,
+        )
+        return selected[inside]
+
+    def nearest( self, position, classname=None ):
+        """Find the index of the entity with origin nearest position (None if none)"""
+        selected = self.find( classname )
+        selected = selected[self.has_origin[selected]]
+        if not len(selected):
+            return None
+        distance = numpy.sum( (self.origins[selected] - numpy.asarray( position, 'f' ))**2, -1 )
+        return int(selected[numpy.argmin( distance )])
+
+    def spawn_points( self ):
+        """Indices of the entities the player can start from, in order of preference"""
+        indices = [self.classnames.get( name, () ) for name in SPAWN_CLASSES]
+        indices = numpy.concatenate( [numpy.asarray( x, dtype='i' ) for x in indices] )
+        return indices[self.has_origin[indices]]
+
+    def spawn_point( self ):
+        """Index of the preferred spawn point (None if the map has none)"""
+        indices = self.spawn_points()
+        if not len(indices):
+            return None
+        return int(indices[0])
@@ -0,0 +1,113 @@
+"""Light grid (lightvols lump) sampling
+
+The lightvols lump is a regular 3D grid of light samples covering the
+bounds of the world model, each with an ambient colour, a directed
+colour and the (spherical) direction the directed light comes from.
+The renderer uses it to light things which don't have lightmaps, such
+as entities and dynamic objects.
+
+Sampling follows the Quake III renderer: positions are trilinearly
+interpolated between the 8 surrounding grid points, ignoring points
+without any light (those inside solid geometry).
+"""
+from __future__ import absolute_import
+import numpy, logging
+log = logging.getLogger( __name__ )
+
+DEFAULT_GRID_SIZE = (64,64,128)
+# the 8 corners of a grid cell
+CORNERS = numpy.array( [
+    (x,y,z) for z in (0,1) for y in (0,1) for x in (0,1)
+], dtype='i' )
+
+def decode_directions( dir ):
+    """Convert packed (longitude,latitude) bytes to unit vectors"""
+    angles = numpy.asarray( dir ).astype( 'B' ).astype( 'f' ) * (2*numpy.pi/256.)
+    lng, lat = angles[...,0], angles[...,1]
+    return numpy.stack( (
+        numpy.cos( lat ) * numpy.sin( lng ),
+        numpy.sin( lat ) * numpy.sin( lng ),
+        numpy.cos( lng ),
+    ), axis=-1 ).astype( 'f' )
+
+class LightGrid( object ):
+    """Decoded light grid for a map
+
+    ambient, directional -- N x 3 colours for each grid point (0.0 to 1.0)
+    direction -- N x 3 unit vectors toward the directional light
+    """
+    def __init__( self, lightvols, mins, maxs, grid_size=DEFAULT_GRID_SIZE ):
+        """Initialize from the lightvols lump and the world model's bounds"""
+        self.grid_size = numpy.asarray( grid_size, dtype='f' )
+        self.origin = self.grid_size * numpy.ceil( numpy.asarray( mins, 'f' ) / self.grid_size )
+        top = self.grid_size * numpy.floor( numpy.asarray( maxs, 'f' ) / self.grid_size )
+        self.dims = ((top - self.origin) / self.grid_size + 1).astype( 'i' )
+        expected = int(numpy.prod( self.dims ))
+        if len(lightvols) != expected:
+            log.warning(
+                'Light grid has %s points, expected %s for %s grid',
+                len(lightvols), expected, self.dims,
+            )
+            lightvols = lightvols[:expected]
+        # the lump declares signed bytes, the colours are unsigned
+        self.ambient = lightvols['ambient'].astype( 'B' ).astype( 'f' ) / 255.
+        self.directional = lightvols['directional'].astype( 'B' ).astype( 'f' ) / 255.
+        self.direction = decode_directions( lightvols['dir'] )
+        # points inside solid geometry get no light and are skipped
+        self.lit = numpy.any( self.ambient > 0, -1 ) | numpy.any( self.directional > 0, -1 )
+        if len(lightvols) < expected:
+            # pad missing points as unlit
+            missing = expected - len(lightvols)
+            self.ambient = numpy.concatenate( (self.ambient, numpy.zeros( (missing,3), 'f' )) )
+            self.directional = numpy.concatenate( (self.directional, numpy.zeros( (missing,3), 'f' )) )
+            self.direction = numpy.concatenate( (self.direction, numpy.zeros( (missing,3), 'f' )) )
+            self.lit = numpy.concatenate( (self.lit, numpy.zeros( (missing,), '?' )) )
+
+    def cells( self, positions ):
+        """Find the (clamped) grid coordinates of the cell containing each position
+
+        returns (cells, fractions) N x 3 arrays, with fractions the position
+        within the cell
+        """
+        positions = numpy.asarray( positions, dtype='f' ).reshape( (-1,3) )
+        grid = (positions - self.origin) / self.grid_size
+        cells = numpy.floor( grid )
+        fractions = grid - cells
+        # outside the grid we use the nearest edge
+        low = cells < 0
+        high = cells >= self.dims - 1
+        cells = numpy.clip( cells, 0, self.dims - 1 ).astype( 'i' )
+        fractions[low | high] = 0
+        return cells, fractions.astype( 'f' )
+
+    def indices( self, cells ):
+        """Convert N x 3 grid coordinates to indices into the grid arrays"""
+        cells = numpy.clip( cells, 0, self.dims - 1 )
+        return cells[...,0] + self.dims[0] * (cells[...,1] + self.dims[1] * cells[...,2])
+
+    def sample( self, positions ):
+        """Trilinearly interpolate the light at each position
+
+        positions -- N x 3 array of world positions
+
+        returns (ambient, directional, direction) N x 3 arrays, positions
+        with no lit grid points nearby get no light and a zero direction
+        """
+        cells, fractions = self.cells( positions )
+        # N x 8 corner indices and weights
+        indices = self.indices( cells[:,numpy.newaxis,:] + CORNERS )
+        weights = numpy.prod(
+            numpy.where( CORNERS, fractions[:,numpy.newaxis,:], 1 - fractions[:,numpy.newaxis,:] ),
+            axis=-1,
+        )
+        weights = weights * self.lit[indices]
+        total = numpy.sum( weights, -1 )
+        valid = total > 0
+        weights[valid] /= total[valid,numpy.newaxis]
+        ambient = numpy.einsum( 'ij,ijk->ik', weights, self.ambient[indices] )
+        directional = numpy.einsum( 'ij,ijk->ik', weights, self.directional[indices] )
+        direction = numpy.einsum( 'ij,ijk->ik', weights, self.direction[indices] )
+        length = numpy.sqrt( numpy.sum( direction**2, -1 ) )
+        nonzero = length > 0
+        direction[nonzero] /= length[nonzero,numpy.newaxis]
+        return ambient, directional, direction
@@ -0,0 +1,161 @@
+"""On-disk cache of the derived (compiled) data for a map
+
+Building the simple-face index buffer, tessellating patches and
+producing the culling tables is repeated work on every load of an
+unchanged .bsp file.  The compiled data is stored as one .npy file
+per array plus a json manifest, keyed by the sha1 of the .bsp content
+and FORMAT_VERSION, in a directory next to the .bsp (in the pk3 unpack
+directory for downloaded maps) or, for maps read in place from a pk3,
+next to the archive.  Warm loads memory-map the .npy files, so the
+arrays can be handed directly to vbo.VBO.
+"""
+from __future__ import absolute_import
+import os, re, json, hashlib, logging, shutil, tempfile
+import numpy
+from . import visibility
+from . import pk3
+log = logging.getLogger( __name__ )
+
+FORMAT_VERSION = 2
+# Twitch attributes stored as arrays
+SIMPLE_ARRAYS = [
+    'simple_indices',
+    'simple_face_ids',
+    'simple_face_starts',
+    'simple_face_counts',
+]
+PATCH_ARRAYS = [
+    'patch_vertices',
+    'patch_lod_indices',
+    'patch_lod_starts',
+    'patch_lod_counts',
+    'patch_face_ids',
+    'patch_centers',
+    'patch_radii',
+]
+VISIBILITY_ARRAYS = [
+    'face_leaves',
+    'face_ids',
+]
+# Twitch attributes which change the compiled result
+SETTINGS = [
+    'patch_tolerance',
+    'patch_max_segments',
+    'patch_lod_levels',
+    'lightmap_atlas_size',
+]
+
+def content_hash( filename, blocksize=1024*1024 ):
+    """Calculate sha1 hex digest of the content of filename"""
+    digest = hashlib.sha1()
+    with pk3.open_path( filename ) as fh:
+        block = fh.read( blocksize )
+        while block:
+            digest.update( block )
+            block = fh.read( blocksize )
+    return digest.hexdigest()
+
+def cache_directory( twitch, hash=None ):
+    """Calculate the compiled-data directory for the twitch's .bsp file"""
+    if hash is None:
+        hash = content_hash( twitch.filename )
+    return os.path.join(
+        os.path.dirname( pk3.local_file( twitch.filename ) ),
+        'compiled',
+        '%s-%s-v%s'%( twitch.model_name, hash, FORMAT_VERSION ),
+    )
+
+def remove_stale( parent, model_name, keep ):
+    """Remove compiled data for other versions of the named map"""
+    pattern = re.compile( r'^%s-[0-9a-f]{40}-v\d+$'%( re.escape( model_name ), ) )
+    for name in os.listdir( parent ):
+        path = os.path.join( parent, name )
+        if pattern.match( name ) and path != keep:
+            log.info( 'Removing stale compiled map %s', path )
+            shutil.rmtree( path, ignore_errors=True )
+
+def settings( twitch ):
+    """Get the twitch settings which affect the compiled data"""
+    return dict([ (key,getattr( twitch, key )) for key in SETTINGS ])
+
+def save( twitch, directory ):
+    """Compile twitch's derived data and store it in directory"""
+    twitch.simple_faces
+    vertices,indices = twitch.patch_faces
+    vis = twitch.visibility
+    manifest = {
+        'format': FORMAT_VERSION,
+        'settings': settings( twitch ),
+        'texture_set': [[int(x) for x in batch] for batch in twitch.texture_set],
+        'patches': indices is not None,
+    }
+    parent = os.path.dirname( directory )
+    if not os.path.exists( parent ):
+        os.makedirs( parent )
+    # write to a temporary directory so readers never see a partial cache
+    working = tempfile.mkdtemp( prefix='.compiling', dir=parent )
+    try:
+        arrays = [(name,getattr( twitch, name )) for name in SIMPLE_ARRAYS]
+        if manifest['patches']:
+            arrays.extend( [(name,getattr( twitch, name )) for name in PATCH_ARRAYS] )
+        arrays.extend( [(name,getattr( vis, name )) for name in VISIBILITY_ARRAYS] )
+        for name,array in arrays:
+            numpy.save( os.path.join( working, name+'.npy' ), numpy.ascontiguousarray( array ) )
+        with open( os.path.join( working, 'manifest.json' ), 'w' ) as fh:
+            json.dump( manifest, fh )
+        if os.path.exists( directory ):
+            shutil.rmtree( directory )
+        os.rename( working, directory )
+    except Exception:
+        shutil.rmtree( working, ignore_errors=True )
+        raise
+    remove_stale( parent, twitch.model_name, keep=directory )
+    log.info( 'Saved compiled map to %s', directory )
+    return directory
+
+def restore( twitch, directory ):
+    """Restore compiled data from directory into twitch
+
+    returns True if the cache was valid and has been loaded
+    """
+    manifest_file = os.path.join( directory, 'manifest.json' )
+    if not os.path.exists( manifest_file ):
+        return False
+    with open( manifest_file ) as fh:
+        manifest = json.load( fh )
+    if manifest.get( 'format' ) != FORMAT_VERSION or manifest.get( 'settings' ) != settings( twitch ):
+        return False
+    def load( name ):
+        return numpy.load( os.path.join( directory, name+'.npy' ), mmap_mode='r' )
+    for name in SIMPLE_ARRAYS:
+        setattr( twitch, name, load( name ) )
+    twitch.texture_set = [tuple( batch ) for batch in manifest['texture_set']]
+    if manifest['patches']:
+        for name in PATCH_ARRAYS:
+            setattr( twitch, name, load( name ) )
+        twitch.patch_indices = twitch.patch_lod_indices[:numpy.sum( twitch.patch_lod_counts[0] )]
+        twitch.patch_face_starts = twitch.patch_lod_starts[0]
+        twitch.patch_face_counts = twitch.patch_lod_counts[0]
+    twitch._visibility = visibility.Visibility(
+        twitch.nodes, twitch.planes, twitch.leafs, twitch.leaffaces,
+        twitch.visdata, len(twitch.faces),
+        face_leaves = load( 'face_leaves' ), face_ids = load( 'face_ids' ),
+    )
+    log.info( 'Loaded compiled map from %s', directory )
+    return True
+
+def compiled( twitch ):
+    """Restore twitch's compiled data from the cache, or compile and save it
+
+    Failure to write the cache (e.g. read-only map directory) is logged
+    and otherwise ignored.
+
+    returns twitch
+    """
+    directory = cache_directory( twitch )
+    if not restore( twitch, directory ):
+        try:
+            save( twitch, directory )
+        except (IOError,OSError) as err:
+            log.warning( 'Unable to save compiled map to %s: %s', directory, err )
+    return twitch
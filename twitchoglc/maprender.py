@@ -1,45 +1,217 @@
 """Low-level renderer for Q3 style BSP maps"""
 from __future__ import absolute_import
 from __future__ import print_function
-import logging,numpy, sys,traceback
+import logging,numpy, sys,traceback,ctypes,collections
 log = logging.getLogger( __name__ )
-from . import bsp,brushviewer
+from . import bsp,brushviewer,mapcache,visibility,atlas,packedrender,texturecache,corerender,drawlist
+from .renderstats import timer
 from OpenGL.GL import *
 from OpenGL.arrays import vbo
 from OpenGLContext.scenegraph import imagetexture
 from OpenGLContext import texture
 
+def camera_position( mode ):
+    """Get the camera position for mode in map (z-up) coordinates
+    
+    The viewer rotates the map -90 degrees around x to convert 
+    from the Q3 z-up coordinate system to OpenGL's y-up one.
+    """
+    x,y,z = mode.viewPlatform.position[:3]
+    return numpy.array( (x,-z,y), 'f' )
+
+# row-vector matrix for the viewer's glRotatef( -90, 1,0,0 )
+MAP_TO_GL = numpy.array([
+    [1,0,0,0],
+    [0,0,-1,0],
+    [0,1,0,0],
+    [0,0,0,1],
+],'f')
+def map_modelproj( mode ):
+    """Get the model-projection matrix for mode in map coordinates"""
+    return numpy.dot( MAP_TO_GL, mode.modelproj )
+
+# texture id of the placeholder drawn for plain textures still loading
+PENDING = -1
+
 class Map( object ):
     """Map object which loads and renders Q3 map"""
     loaded = False
+    # whether to use the visdata PVS to cull faces
+    cull_pvs = True
+    # whether to cull faces outside the view frustum
+    cull_frustum = True
+    # whether frustum culling walks the BSP tree or tests all leaves at once
+    hierarchical_frustum = True
+    # whether to choose patch levels of detail by distance from the camera
+    patch_lod = True
+    face_mask = None
+    draw_batches = None
+    # state-sorted draws (see twitchoglc.drawlist), compiled after load
+    draw_list = None
+    draws = None
+    draw_commands = ()
+    # number of each drawlist operation in draw_commands
+    command_counts = None
+    # optional renderstats.RenderStats recording each frame
+    stats = None
+    patch_levels = None
+    patch_ranges = None
+    # whether to pack plain diffuse textures into texture arrays/atlases
+    pack_textures = True
+    texture_pack = None
+    packed_textures = None
+    packed_batches = ()
+    # whether to use the on-disk compiled map cache
+    compiled_cache = True
+    # height of the camera above a spawn point's origin
+    view_height = 26
+    # rendering backend, 'fixed' (fixed-function client arrays) or 'core'
+    # (shaders and vertex array objects, see twitchoglc.corerender)
+    backend = 'fixed'
+    BACKENDS = ('fixed','core')
+    core_renderer = None
+    twitch = None
+    # seconds per frame to spend running queued uploads while loading
+    upload_budget = 0.004
+    # whether to load the sky (sky rendering needs a scenegraph context)
+    load_sky = True
+    # texture ids still loading and the ids of scripted textures (once known)
+    pending = ()
+    script_ids = None
     def __init__( self, filename ):
         self.filename = filename 
-    def load( self ):
+        # (function,args) queued by the loading thread (see process_uploads)
+        self.uploads = collections.deque()
+    def open( self ):
+        """Open the BSP file (lumps are decoded as they are used)"""
+        if self.twitch is None:
+            self.twitch = bsp.load( self.filename, brush_class=brushviewer.Brush )
+        return self.twitch
+    def spawn_point( self ):
+        """Find a camera position and orientation at the map's spawn point
+        
+        returns ((x,y,z), (0,1,0,radians)) in OpenGL (y-up) coordinates 
+        suitable for the view platform, or None if there is no spawn point
+        """
+        table = self.open().entity_table
+        index = table.spawn_point()
+        if index is None:
+            return None
+        x,y,z = table.origins[index]
+        # Q3 yaw 0 is along +x, the view platform looks down -z (Q3 +y)
+        return (x,z+self.view_height,-y), (0,1,0,numpy.radians( table.angles[index]-90 ))
+    def load( self, refresh=None ):
+        """Load the map in stages, geometry first then textures by priority
+        
+        The geometry and lightmaps are loaded before the map is marked 
+        loaded (drawable), the textures are then decoded (in worker 
+        threads) in texture_order from the spawn point and queued, along 
+        with the texture pack and sky, for the rendering thread to upload 
+        (see process_uploads).  Faces with plain textures which have not 
+        arrived yet are drawn with a white placeholder, those with 
+        scripted textures (which may be nodraw, sky or blended) are not 
+        drawn until their script is loaded.
+        
+        refresh -- optional callable, called whenever there is something 
+            new to draw, e.g. to trigger a redraw when loading in a thread
+        """
         log.info("Starting BSP load of %s", self.filename)
-        self.twitch = bsp.load( self.filename, brush_class=brushviewer.Brush )
-        self.simple_vertices = vbo.VBO( self.twitch.vertices )
+        self.load_geometry()
+        order = self.texture_order( self.spawn_position() )
+        self.loaded = True
+        if refresh is not None:
+            refresh()
+        self.load_textures( order, refresh )
+        if self.load_sky:
+            self.queue_upload( self.install_sky, self.find_sky() )
+        if refresh is not None:
+            refresh()
+        log.info( 'Finished loading %s', self.filename )
+    def spawn_position( self ):
+        """Get the spawn point's camera position in map coordinates (or None)"""
+        spawn = self.spawn_point()
+        if spawn is None:
+            return None
+        x,y,z = spawn[0]
+        return numpy.array( (x,-z,y), 'f' )
+    def load_geometry( self ):
+        """Load the geometry and lightmaps (the first load stage)"""
+        self.open()
+        if self.compiled_cache:
+            mapcache.compiled( self.twitch )
+        self.simple_vertices = vbo.VBO( self.twitch.render_vertices )
         self.simple_indices = vbo.VBO( self.twitch.simple_faces, target=GL_ELEMENT_ARRAY_BUFFER )
         vertices,indices = self.twitch.patch_faces
         if indices is not None:
             self.patch_vertices = vbo.VBO( vertices )
-            self.patch_indices = vbo.VBO( indices, target=GL_ELEMENT_ARRAY_BUFFER )
+            # all levels of detail, we draw ranges of it
+            self.patch_indices = vbo.VBO( self.twitch.patch_lod_indices, target=GL_ELEMENT_ARRAY_BUFFER )
         else:
             self.patch_indices = None
         # Construct a big lightmap data-set...
-        self.textures = {}
-        for id,image in self.twitch.load_textures():
+        self.lightmaps = {}
+        for id,data in self.twitch.iter_lightmap_pages():
+            self.lightmaps[id] = brushviewer.Lightmap( id, data )
+        self.textures = {PENDING: brushviewer.MipmapTexture( 
+            PENDING, texturecache.MipTexture( numpy.full( (4,), 255, 'B' ), 1, 1 ),
+        )}
+        self.pending = set( range( len(self.twitch.textures) ) )
+    def texture_order( self, position ):
+        """Order the texture ids to load those most likely to be seen first
+        
+        Textures of faces potentially visible from position come first, 
+        then the rest, each ordered by the distance of their nearest face 
+        from position, textures without faces (e.g. model skins) are last.
+        
+        position -- map coordinates of the camera, None for id order
+        """
+        twitch = self.twitch
+        ids = list( range( len(twitch.textures) ) )
+        faces = twitch.faces
+        if position is None or not len(faces):
+            return ids
+        vis = twitch.visibility
+        hidden = ~vis.face_mask( vis.cluster( position ) )
+        distances = numpy.sum( (twitch.face_centers - position)**2, -1 )
+        order = numpy.lexsort( (distances, hidden) )
+        used, first = numpy.unique( faces['texture'][order], return_index=True )
+        result = [int(id) for id in used[numpy.argsort( first )] if 0 <= id < len(ids)]
+        seen = set( result )
+        return result + [id for id in ids if id not in seen]
+    def load_textures( self, order, refresh=None ):
+        """Decode the textures in order, queueing them for upload (second load stage)"""
+        # scripts must wait for their brush, until we know which those are draw nothing
+        self.queue_upload( self.install_scripts, set( self.twitch.brushes ) )
+        plain_images = {}
+        # textures are decoded in worker threads, we queue them as they arrive
+        for id,image in self.twitch.iter_textures( ids=order ):
+            texture = None
             if image is None:
                 pass
             elif isinstance( image, brushviewer.Brush ):
-                self.textures[id] = image
+                texture = image
                 image.compile_textures()
+            elif isinstance( image, texturecache.MipTexture ):
+                if self.pack_textures:
+                    # the pack only needs the top level
+                    plain_images[id] = atlas.image_array( image )
+                texture = brushviewer.MipmapTexture( id, image )
             else:
                 texture = imagetexture.ImageTexture()
                 texture.setImage( image ) # we don't want to trigger redraws, so skip that...
-                self.textures[id] = texture 
-        self.lightmaps = {}
-        for id,data in self.twitch.iter_lightmaps():
-            self.lightmaps[id] = brushviewer.Lightmap( id, data )
+                if self.pack_textures:
+                    plain_images[id] = atlas.image_array( image )
+            self.queue_upload( self.install_texture, id, texture )
+            if refresh is not None:
+                refresh()
+        if plain_images:
+            self.queue_upload( 
+                self.install_texture_pack, 
+                atlas.TexturePack( len(self.twitch.textures), plain_images ), 
+                plain_images,
+            )
+    def find_sky( self ):
+        """Load the textures of the first usable sky (if any)"""
         self.skies = self.twitch.find_sky()
         if self.skies:
             for sky in self.skies:
@@ -50,10 +222,76 @@ class Map( object ):
                 except Exception as err:
                     log.warn( 'Unable to load textures for sky %s: %s', sky.id, traceback.format_exc() )
                 else:
-                    self.sky = sky
-                    break
-        self.loaded = True
+                    return sky
+        return None
+    
+    def queue_upload( self, function, *args ):
+        """Queue function(*args) to be run by the rendering thread (any thread)"""
+        self.uploads.append( (function, args) )
+    def process_uploads( self, budget=None ):
+        """Run queued uploads, must be called with the map's context current
+        
+        budget -- seconds after which to stop (the running upload is 
+            finished, so at least one is run), None to run them all
+        
+        returns the number of uploads run
+        """
+        start = timer()
+        count = 0
+        while self.uploads:
+            function, args = self.uploads.popleft()
+            function( *args )
+            count += 1
+            if budget is not None and timer() - start >= budget:
+                break
+        return count
+    def install_scripts( self, script_ids ):
+        """Record the texture ids which are scripted brushes"""
+        self.script_ids = script_ids
+        self.draw_list = None
+        self.draw_batches = None
+    def install_texture( self, id, texture ):
+        """Make a loaded texture (None if not found) available for drawing"""
+        self.pending.discard( id )
+        if texture is not None:
+            self.textures[id] = texture
+            if hasattr( texture, 'handle' ):
+                texture.handle()
+        # the draw states and ranges change with the texture
+        self.draw_list = None
+        self.draw_batches = None
+    def install_texture_pack( self, pack, plain_images ):
+        # kept in case we have to repack as atlases on first render
+        self.plain_images = plain_images
+        self.set_texture_pack( pack )
+    def install_sky( self, sky ):
+        self.sky = sky
     sky = None
+    def set_texture_pack( self, pack ):
+        """Use an atlas.TexturePack to draw faces with plain textures"""
+        self.texture_pack = pack
+        self.packed_textures = packedrender.PackedTextures( pack )
+        self.texture_data = vbo.VBO( pack.vertex_data( self.twitch.render_vertices, self.twitch.faces ) )
+        # force the batches to be regrouped
+        self.draw_batches = None
+    def upload_texture_pack( self ):
+        """Upload the texture pack on first render, when we have a context
+        
+        Falls back to atlas pages without texture arrays, and to the
+        per-texture fixed-function path if the shader is not supported.
+        """
+        try:
+            if self.texture_pack.use_arrays and not packedrender.supports_arrays():
+                log.info( 'No texture array support, packing textures as atlases' )
+                self.set_texture_pack( 
+                    atlas.TexturePack( len(self.twitch.textures), self.plain_images, use_arrays=False ) 
+                )
+            self.packed_textures.upload()
+        except Exception:
+            log.warning( 'Unable to use packed textures: %s', traceback.format_exc() )
+            self.texture_pack = self.packed_textures = None
+            self.draw_batches = None
+        self.plain_images = None
     def set_cull( self, newmode,current ):
         if newmode == 'disable':
             newmode = 'none'
@@ -70,14 +308,234 @@ class Map( object ):
         else:
             glDisable( GL_CULL_FACE )
         return newmode
+    
+    def frame_face_mask( self, mode ):
+        """Calculate the mask of faces to draw for this frame
+        
+        Combines the PVS for the camera's cluster with the leaves inside 
+        the view frustum.
+        
+        returns boolean array for each face or None to draw everything
+        """
+        vis = self.twitch.visibility
+        stats = self.stats
+        mask = None
+        if self.cull_pvs:
+            mask = vis.face_mask( vis.cluster( camera_position( mode ) ) )
+        if stats is not None:
+            stats.count( 'faces', len(self.twitch.faces) )
+            if mask is not None:
+                stats.count( 'pvs_culled', len(mask) - numpy.count_nonzero( mask ) )
+        if self.cull_frustum:
+            planes = visibility.frustum_planes( map_modelproj( mode ) )
+            leaves = vis.frustum_leaves( planes, hierarchical=self.hierarchical_frustum )
+            in_frustum = vis.leaf_face_mask( leaves )
+            if stats is not None:
+                culled = ~in_frustum if mask is None else (mask & ~in_frustum)
+                stats.count( 'frustum_culled', numpy.count_nonzero( culled ) )
+            mask = in_frustum if mask is None else (mask & in_frustum)
+        return mask
+    
+    def batch_state( self, lightmap, id ):
+        """Get the (cull,lightmap,texture) render state for a texture_set batch
+        
+        Plain textures still loading are drawn with the PENDING placeholder, 
+        scripted ones (and all, until the scripts are known) are not drawn.
+        
+        returns None if the batch is not drawn
+        """
+        texture = self.textures.get( id )
+        if id in self.pending:
+            if self.script_ids is None or id in self.script_ids:
+                return None
+            texture, id = self.textures[PENDING], PENDING
+        if getattr( texture, 'nodraw', None ):
+            return None
+        cull = texture.cull if isinstance( texture, brushviewer.Brush ) else 'front'
+        return (
+            cull,
+            lightmap if self.lightmaps.get( lightmap ) else None,
+            id if texture else None,
+        )
+    def compile_draw_list( self ):
+        """Group and sort the texture_set batches by render state"""
+        self.twitch.simple_faces
+        self.draw_list = drawlist.DrawList( dict([
+            ((lightmap,id), self.batch_state( lightmap, id ))
+            for lightmap,id,stop in self.twitch.texture_set
+        ]))
+        log.info( 
+            'Compiled %s draws for %s batches', 
+            len(self.draw_list.states), len(self.twitch.texture_set),
+        )
+    def replay_commands( self, draws ):
+        """Flatten draws into commands with the lightmaps and textures to bind
+        
+        Scripted brushes are disabled (DISABLE) when the texture changes
+        and after the last draw, so their render state doesn't leak into
+        the following batches.
+        """
+        commands = []
+        bound = None
+        for operation,value in drawlist.DrawList.commands( draws, ('front',None,None) ):
+            if operation == drawlist.LIGHTMAP:
+                value = self.lightmaps[value]
+            elif operation == drawlist.TEXTURE:
+                value = self.textures[value]
+                if isinstance( bound, brushviewer.Brush ):
+                    commands.append( (drawlist.DISABLE,bound) )
+                bound = value
+            commands.append( (operation,value) )
+        if isinstance( bound, brushviewer.Brush ):
+            commands.append( (drawlist.DISABLE,bound) )
+        return commands
+    
+    def update_culling( self, mode ):
+        """Update the draw ranges for the current camera
         
+        The ranges are only recalculated when the set of visible faces or 
+        the patch levels of detail change.
+        """
+        if self.draw_list is None:
+            self.compile_draw_list()
+        mask = self.frame_face_mask( mode )
+        changed = self.draw_batches is None or not numpy.array_equal( mask, self.face_mask )
+        if changed:
+            self.face_mask = mask
+            self.draw_batches = self.twitch.simple_draw_ranges( mask )
+            if self.texture_pack is not None:
+                self.packed_batches, self.draw_batches = atlas.merge_batches(
+                    self.draw_batches, self.texture_pack.texture_group,
+                )
+            else:
+                self.packed_batches = ()
+            self.draws = self.draw_list.ranges( self.draw_batches )
+            self.draw_commands = self.replay_commands( self.draws )
+            self.command_counts = numpy.bincount( 
+                numpy.array( [operation for operation,value in self.draw_commands], 'i' ), 
+                minlength=5,
+            )
+        if self.patch_indices is not None:
+            levels = None
+            if self.patch_lod:
+                levels = self.twitch.patch_lod( camera_position( mode ) )
+            if changed or self.patch_ranges is None or not numpy.array_equal( levels, self.patch_levels ):
+                self.patch_levels = levels
+                self.patch_ranges = self.twitch.patch_draw_ranges( mask, levels )
+    
+    def draw_ranges( self, indices, starts, counts ):
+        """Draw triangles for (start,count) ranges of bound index buffer indices"""
+        if self.stats is not None and len(counts):
+            self.stats.draw( counts )
+        if len(counts) == 1:
+            glDrawElements( 
+                GL_TRIANGLES, 
+                int(counts[0]), 
+                GL_UNSIGNED_INT, 
+                indices+(int(starts[0])*indices.itemsize)
+            )
+        elif len(counts):
+            offsets = (ctypes.c_void_p * len(starts))( 
+                *(numpy.asarray( starts, 'l' )*indices.itemsize).tolist() 
+            )
+            glMultiDrawElements( 
+                GL_TRIANGLES, 
+                numpy.asarray( counts, 'i' ), 
+                GL_UNSIGNED_INT, 
+                offsets, 
+                len(counts),
+            )
+    
+    def render_packed( self, mode ):
+        """Draw the faces with packed textures, a draw per (lightmap,group)"""
+        packed = self.packed_textures
+        packed.enable( self.simple_vertices, self.texture_data )
+        # the fixed-function matrices, which the (core) shader can't see
+        packed.set_modelproj( numpy.dot(
+            glGetFloatv( GL_MODELVIEW_MATRIX ), glGetFloatv( GL_PROJECTION_MATRIX ),
+        ) )
+        try:
+            self.simple_indices.bind()
+            current_lightmap = None
+            for lightmap,group,starts,counts in self.packed_batches:
+                if not len(counts):
+                    continue
+                lightmap = self.lightmaps.get( lightmap )
+                if lightmap and lightmap != current_lightmap:
+                    lightmap.render(
+                        visible=mode.visible,
+                        lit = False,
+                        mode = mode,
+                    )
+                    current_lightmap = lightmap
+                    if self.stats is not None:
+                        self.stats.count( 'lightmap_binds' )
+                packed.bind( group )
+                if self.stats is not None:
+                    self.stats.count( 'texture_binds' )
+                self.draw_ranges( self.simple_indices, starts, counts )
+        finally:
+            self.simple_indices.unbind()
+            self.simple_vertices.unbind()
+            packed.disable()
+    
+    def render_core( self, mode ):
+        """Render with the corerender backend
+        
+        returns False (after switching to the fixed-function backend) if 
+        the backend cannot be used with this context
+        """
+        if self.core_renderer is None:
+            try:
+                renderer = corerender.CoreRenderer( self )
+                renderer.upload()
+            except Exception:
+                log.warning( 'Unable to use core renderer: %s', traceback.format_exc() )
+                self.backend = 'fixed'
+                return False
+            self.core_renderer = renderer
+        if self.sky:
+            if self.stats is not None:
+                self.stats.phase( 'sky' )
+            self.sky.render_sky( mode )
+        self.core_renderer.render( mode, map_modelproj( mode ) )
+        return True
+    
     def Render( self, mode = None):
+        """Render the geometry for the scene, recording its stats if enabled"""
+        stats = self.stats
+        if stats is None:
+            return self.render_frame( mode )
+        stats.begin_frame()
+        try:
+            return self.render_frame( mode )
+        finally:
+            stats.end_frame()
+    
+    def render_frame( self, mode ):
         """Render the geometry for the scene."""
+        stats = self.stats
+        if self.uploads:
+            if stats is not None:
+                stats.phase( 'uploads' )
+                stats.count( 'uploads', self.process_uploads( self.upload_budget ) )
+            else:
+                self.process_uploads( self.upload_budget )
+        if self.packed_textures is not None and self.packed_textures.program is None:
+            self.upload_texture_pack()
+        if mode.visible or self.draw_batches is None:
+            if stats is not None:
+                stats.phase( 'culling' )
+            self.update_culling( mode )
+        if self.backend == 'core' and self.render_core( mode ):
+            return
         #glEnable(GL_LIGHTING)
         glDisable(GL_LIGHTING)
         glEnable( GL_COLOR_MATERIAL )
         
         if self.sky:
+            if stats is not None:
+                stats.phase( 'sky' )
             self.sky.render_sky( mode )
         glActiveTexture( GL_TEXTURE0 )
         glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
@@ -90,6 +548,16 @@ class Map( object ):
         glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_MODULATE)
 
         cull = self.set_cull( 'front', 'none' )
+        if self.packed_batches:
+            if stats is not None:
+                stats.phase( 'packed' )
+            self.render_packed( mode )
+        if stats is not None:
+            stats.phase( 'world' )
+            counts = self.command_counts
+            stats.count( 'texture_binds', counts[drawlist.TEXTURE] )
+            stats.count( 'lightmap_binds', counts[drawlist.LIGHTMAP] )
+            stats.count( 'cull_changes', counts[drawlist.CULL] )
         self.simple_vertices.bind()
         try:
             glEnableClientState( GL_VERTEX_ARRAY )
@@ -126,55 +594,37 @@ class Map( object ):
                 self.simple_vertices + 40,
             )
             self.simple_indices.bind()
-            current = 0
             
-            current_lightmap = None
-            current_texture = None
             try:
-                for lightmap,id,stop in self.twitch.texture_set:
-                    texture = self.textures.get( id )
-                    lightmap = self.lightmaps.get( id )
-                    if not getattr(texture,'nodraw',None):
-                        if lightmap and lightmap != current_lightmap:
-                            lightmap.render(
-                                visible=mode.visible,
-                                lit = False,
-                                mode = mode,
-                            )
-                        if texture and texture != current_texture:
-                            if isinstance( texture, brushviewer.Brush ):
-                                # scripted brush can have lots and lots of details...
-                                glActiveTexture( GL_TEXTURE0 )
-                                cull = self.set_cull( texture.surface_params['cull'], cull )
-                                texture.render(
-                                    visible = mode.visible,
-                                    lit = False,
-                                    mode = mode,
-                                )
-                            elif texture:
-                                cull = self.set_cull( 'front', cull )
-                                glActiveTexture( GL_TEXTURE0 )
-                                texture.render(
-                                    visible = mode.visible,
-                                    lit = False,
-                                    mode = mode,
-                                )
-                        glDrawElements( 
-                            GL_TRIANGLES, 
-                            int(stop)-current, 
-                            GL_UNSIGNED_INT, 
-                            self.simple_indices+(current*self.simple_indices.itemsize)
+                for operation,value in self.draw_commands:
+                    if operation == drawlist.DRAW:
+                        self.draw_ranges( self.simple_indices, *value )
+                    elif operation == drawlist.TEXTURE:
+                        glActiveTexture( GL_TEXTURE0 )
+                        value.render(
+                            visible = mode.visible,
+                            lit = False,
+                            mode = mode,
                         )
-                        if isinstance( texture, brushviewer.Brush ):
-                            # scripted brush can have lots and lots of details...
-                            texture.disable()
-                    current = int(stop)
+                    elif operation == drawlist.LIGHTMAP:
+                        value.render(
+                            visible = mode.visible,
+                            lit = False,
+                            mode = mode,
+                        )
+                    elif operation == drawlist.DISABLE:
+                        # scripted brush can have lots and lots of details...
+                        value.disable()
+                    else:
+                        cull = self.set_cull( value, cull )
             finally:
                 self.simple_indices.unbind()
         finally:
             self.simple_vertices.unbind()
             glDisableClientState( GL_COLOR_ARRAY )
-        if self.patch_indices is not None:
+        if self.patch_indices is not None and len(self.patch_ranges[1]):
+            if stats is not None:
+                stats.phase( 'patches' )
             glEnable( GL_LIGHTING )
             #glEnable( GL_CULL_FACE )
             try:
@@ -201,12 +651,7 @@ class Map( object ):
                 )
                 try:
                     self.patch_indices.bind()
-                    glDrawElements( 
-                        GL_TRIANGLES, 
-                        len(self.patch_indices), 
-                        GL_UNSIGNED_INT, 
-                        self.patch_indices, 
-                    )
+                    self.draw_ranges( self.patch_indices, *self.patch_ranges )
                 finally:
                     self.patch_indices.unbind()
             finally:
@@ -0,0 +1,162 @@
+"""OpenGL side of the packed diffuse textures (see twitchoglc.atlas)
+
+Uploads a TexturePack's groups as texture arrays (or atlas pages) and
+provides the shader which draws packed world geometry, sampling the
+face's layer/rectangle of the bound group and modulating by the
+lightmap.  Only uses core OpenGL 3.0 entry points and GLSL 1.30 (with
+an explicit matrix uniform, see set_modelproj) so that it runs in core
+profiles and under software GL implementations such as OSMesa/llvmpipe.
+"""
+from __future__ import absolute_import
+import logging, numpy
+from OpenGL.GL import *
+from OpenGL.GL import shaders
+log = logging.getLogger( __name__ )
+
+VERTEX_SHADER = '''#version 130
+uniform mat4 modelproj;
+in vec3 position;
+in vec2 texcoord;
+in vec2 lightmap_coord;
+in float texture_layer;
+in vec4 texture_rect;
+out vec2 v_texcoord;
+out vec2 v_lightmap;
+flat out float v_layer;
+flat out vec4 v_rect;
+void main() {
+    gl_Position = modelproj * vec4( position, 1.0 );
+    v_texcoord = texcoord;
+    v_lightmap = lightmap_coord;
+    v_layer = texture_layer;
+    v_rect = texture_rect;
+}
+'''
+FRAGMENT_SHADER = '''#version 130
+uniform %(sampler)s diffuse;
+uniform sampler2D lightmap;
+in vec2 v_texcoord;
+in vec2 v_lightmap;
+flat in float v_layer;
+flat in vec4 v_rect;
+out vec4 fragment;
+void main() {
+    // wrap into the texture's rectangle, using the unwrapped gradients
+    // so mip selection doesn't jump at the wrap
+    vec2 scaled = v_texcoord * v_rect.zw;
+    // stay half a texel inside the rectangle to avoid bleeding in atlases
+    vec2 inset = 0.5 / vec2( textureSize( diffuse, 0 ).xy );
+    vec2 uv = v_rect.xy + clamp( fract( v_texcoord ) * v_rect.zw, inset, v_rect.zw - inset );
+    vec4 colour = textureGrad( diffuse, %(coord)s, dFdx( scaled ), dFdy( scaled ) );
+    fragment = colour * texture( lightmap, v_lightmap );
+}
+'''
+ATTRIBUTES = ['position','texcoord','lightmap_coord','texture_layer','texture_rect']
+
+def supports_arrays():
+    """Does the current context support texture arrays (OpenGL 3.0)?"""
+    try:
+        version = glGetString( GL_VERSION )
+        major = int( version.split( b'.' )[0] )
+    except (TypeError, ValueError, AttributeError, GLError):
+        return False
+    return major >= 3 and bool( glTexImage3D ) and bool( glGenerateMipmap )
+
+class PackedTextures( object ):
+    """GL textures and shader for a TexturePack
+
+    Must be uploaded (upload) with a valid context before use.
+    """
+    program = None
+    textures = None
+    def __init__( self, pack ):
+        self.pack = pack
+        self.target = GL_TEXTURE_2D_ARRAY if pack.use_arrays else GL_TEXTURE_2D
+    def upload( self ):
+        """Create the GL textures (with mipmaps) and compile the shader"""
+        self.textures = numpy.atleast_1d( glGenTextures( max( 1, len(self.pack.groups) ) ) )
+        for texture,group in zip( self.textures, self.pack.groups ):
+            layers, height, width = group.shape[:3]
+            glBindTexture( self.target, texture )
+            glPixelStorei( GL_UNPACK_ALIGNMENT, 1 )
+            if self.pack.use_arrays:
+                glTexImage3D(
+                    self.target, 0, GL_RGBA8, width, height, layers, 0,
+                    GL_RGBA, GL_UNSIGNED_BYTE, group,
+                )
+            else:
+                glTexImage2D(
+                    self.target, 0, GL_RGBA8, width, height, 0,
+                    GL_RGBA, GL_UNSIGNED_BYTE, group[0],
+                )
+            glTexParameteri( self.target, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR )
+            glTexParameteri( self.target, GL_TEXTURE_MAG_FILTER, GL_LINEAR )
+            glGenerateMipmap( self.target )
+        glBindTexture( self.target, 0 )
+        self.program = shaders.compileProgram(
+            shaders.compileShader( VERTEX_SHADER, GL_VERTEX_SHADER ),
+            shaders.compileShader( FRAGMENT_SHADER%{
+                'sampler': 'sampler2DArray' if self.pack.use_arrays else 'sampler2D',
+                'coord': 'vec3( uv, v_layer )' if self.pack.use_arrays else 'uv',
+            }, GL_FRAGMENT_SHADER ),
+        )
+        self.locations = dict([
+            (name,glGetAttribLocation( self.program, name ))
+            for name in ATTRIBUTES
+        ])
+        self.modelproj = glGetUniformLocation( self.program, 'modelproj' )
+        glUseProgram( self.program )
+        glUniform1i( glGetUniformLocation( self.program, 'diffuse' ), 0 )
+        glUniform1i( glGetUniformLocation( self.program, 'lightmap' ), 1 )
+        glUseProgram( 0 )
+        log.info(
+            'Uploaded %s packed texture %s',
+            len(self.pack.groups), 'arrays' if self.pack.use_arrays else 'atlas pages',
+        )
+    def enable( self, vertices, texture_data ):
+        """Start drawing with the shader
+
+        vertices -- bound-able VBO of bsp.VERTEX_RECORD
+        texture_data -- bound-able VBO of TexturePack.vertex_data
+        """
+        glUseProgram( self.program )
+        locations = self.locations
+        stride = vertices.itemsize
+        vertices.bind()
+        for name,size,offset in (
+            ('position',3,0),
+            ('texcoord',2,12),
+            ('lightmap_coord',2,20),
+        ):
+            if locations[name] >= 0:
+                glEnableVertexAttribArray( locations[name] )
+                glVertexAttribPointer(
+                    locations[name], size, GL_FLOAT, GL_FALSE, stride, vertices+offset,
+                )
+        texture_data.bind()
+        stride = texture_data.itemsize * 5
+        for name,size,offset in (
+            ('texture_layer',1,0),
+            ('texture_rect',4,texture_data.itemsize),
+        ):
+            if locations[name] >= 0:
+                glEnableVertexAttribArray( locations[name] )
+                glVertexAttribPointer(
+                    locations[name], size, GL_FLOAT, GL_FALSE, stride, texture_data+offset,
+                )
+        texture_data.unbind()
+    def set_modelproj( self, modelproj ):
+        """Set the (row-vector) model-projection matrix, the shader must be in use"""
+        glUniformMatrix4fv( self.modelproj, 1, GL_FALSE, modelproj )
+    def bind( self, group ):
+        """Bind the texture for group to texture unit 0"""
+        glActiveTexture( GL_TEXTURE0 )
+        glBindTexture( self.target, self.textures[group] )
+    def disable( self ):
+        """Finish drawing with the shader"""
+        for location in self.locations.values():
+            if location >= 0:
+                glDisableVertexAttribArray( location )
+        glActiveTexture( GL_TEXTURE0 )
+        glBindTexture( self.target, 0 )
+        glUseProgram( 0 )
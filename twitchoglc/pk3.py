@@ -5,6 +5,14 @@ pk3 files generally look like this:
     maps/X.bsp
     textures/*/*.tga
     levelshots/*.jpg
+
+Rather than unpacking, archives can be read in place through
+PK3Archive, which indexes the zip's central directory once and serves
+members as zero-copy slices of the memory-mapped archive (for stored
+members) or streamed inflates (for deflated ones).  Members are named
+with archive paths such as ``/path/x.pk3!/maps/x.bsp``, nested pk3s as
+``/path/x.zip!/x.pk3!/maps/x.bsp``; the *_path functions accept either
+archive paths or regular filesystem paths.
 """
 from __future__ import absolute_import
 from fnmatch import fnmatch
@@ -13,7 +21,10 @@ try:
     unicode
 except NameError:
     unicode = str
-import os, zipfile, tempfile, hashlib
+import os, io, glob, mmap, struct, zipfile, tempfile, hashlib, threading, logging
+import numpy
+
+log = logging.getLogger(__name__)
 
 MAPS_DIR = os.path.expanduser("~/.cache/twitch/maps")
 
@@ -80,6 +91,16 @@ def unpack(pk3, directory, no_recurse=False, resources=False, bsp_name=None):
         bsp = None
         for pk3 in pk3s:
             return unpack(pk3, directory, no_recurse=True, resources=resources)
+    bsps = choose_bsp(bsps, resources=resources, bsp_name=bsp_name)
+    zip.extractall(directory)
+    return bsps[0] if bsps else None
+
+
+def choose_bsp(bsps, resources=False, bsp_name=None):
+    """Select the bsp to load from the bsps found in a pk3
+
+    returns [bsp] or [] (for resources packs without any bsp)
+    """
     if (not resources) and not bsps:
         raise IOError("""Did not find any .bsp files in the .pk3 file""")
     elif (not resources) and len(bsps) > 1:
@@ -100,5 +121,315 @@ def unpack(pk3, directory, no_recurse=False, resources=False, bsp_name=None):
                 """Found %s .bsp files, specify the bsp_name to load from the pk3 file: \n\t%s"""
                 % (len(bsps), available_bsps())
             )
-    zip.extractall(directory)
+    return bsps[:1]
+
+
+ARCHIVE_SEPARATOR = "!/"
+ARCHIVE_EXTENSIONS = (".pk3", ".zip")
+# signature, version, flags, method, time, date, crc, sizes, name and extra lengths
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+class BufferFile(io.RawIOBase):
+    """Read-only seekable file over a buffer (e.g. a slice of an mmap)"""
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast("B")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        if offset < 0:
+            raise ValueError("Negative seek position %s" % (offset,))
+        self.position = offset
+        return self.position
+
+    def readinto(self, target):
+        chunk = self.buffer[self.position : self.position + len(target)]
+        target[: len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def read(self, size=-1):
+        end = len(self.buffer) if size is None or size < 0 else self.position + size
+        chunk = self.buffer[self.position : end].tobytes()
+        self.position += len(chunk)
+        return chunk
+
+
+class PK3Archive(object):
+    """Read-only view of a pk3 (zip) archive without unpacking it
+
+    path -- the archive path of the archive itself
+    source -- (filename, mtime, size) of the filesystem file holding it
+    entries -- {lower-cased member name: ZipInfo} for the file members
+    """
+
+    def __init__(self, buffer, path, source):
+        self.buffer = memoryview(buffer).cast("B")
+        self.path = path
+        self.source = source
+        self.zip = zipfile.ZipFile(BufferFile(self.buffer), mode="r")
+        self.entries = dict(
+            [
+                (info.filename.lower(), info)
+                for info in scan_for_escape_paths(self.zip)
+                if not info.filename.endswith("/")
+            ]
+        )
+
+    @classmethod
+    def from_file(cls, filename):
+        """Memory-map filename and index its central directory"""
+        filename = os.path.abspath(filename)
+        with open(filename, "rb") as fh:
+            stat = os.fstat(fh.fileno())
+            buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, filename, (filename, stat.st_mtime, stat.st_size))
+
+    def stale(self):
+        """Has the file holding the archive changed since it was indexed?"""
+        filename, mtime, size = self.source
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return True
+        return (stat.st_mtime, stat.st_size) != (mtime, size)
+
+    def __contains__(self, name):
+        return name.lower() in self.entries
+
+    def names(self):
+        """The (original case) names of the file members"""
+        return [info.filename for info in self.entries.values()]
+
+    def info(self, name):
+        """Get the ZipInfo for name (case-insensitive)"""
+        try:
+            return self.entries[name.lower()]
+        except KeyError:
+            raise IOError("No member %r in %s" % (name, self.path))
+
+    def member_path(self, name):
+        """Archive path of the member name"""
+        return self.path + ARCHIVE_SEPARATOR + name
+
+    def stored_slice(self, name):
+        """Zero-copy slice of the data of a stored (uncompressed) member
+
+        returns memoryview or None if the member is compressed
+        """
+        info = self.info(name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+        header = LOCAL_HEADER.unpack_from(self.buffer, info.header_offset)
+        if header[0] != b"PK\x03\x04":
+            raise IOError("Bad local header for %r in %s" % (name, self.path))
+        start = info.header_offset + LOCAL_HEADER.size + header[-2] + header[-1]
+        return self.buffer[start : start + info.file_size]
+
+    def open(self, name):
+        """Open the member name as a (seekable) binary file
+
+        Stored members are read from the mapped archive, deflated members
+        are inflated as they are read.
+        """
+        data = self.stored_slice(name)
+        if data is not None:
+            return BufferFile(data)
+        return self.zip.open(self.info(name))
+
+    def read(self, name):
+        """Read the whole content of the member name (bytes or buffer)"""
+        data = self.stored_slice(name)
+        if data is not None:
+            return data
+        return self.zip.read(self.info(name))
+
+    def array(self, name, dtype="c"):
+        """Get the member name as a numpy array, zero-copy for stored members"""
+        return numpy.frombuffer(self.read(name), dtype=dtype)
+
+    def nested(self, name):
+        """Open the archive member name as an archive"""
+        return PK3Archive(self.read(name), self.member_path(name), self.source)
+
+    def nested_archives(self):
+        """Names of the members which are themselves archives"""
+        return sorted(
+            [
+                info.filename
+                for info in self.entries.values()
+                if os.path.splitext(info.filename)[1].lower() in ARCHIVE_EXTENSIONS
+            ]
+        )
+
+
+_archives = {}
+_archive_lock = threading.RLock()
+
+
+def is_archive_path(path):
+    """Does path name a member of an archive?"""
+    return ARCHIVE_SEPARATOR in path
+
+
+def split_archive_path(path):
+    """Split an archive path into (archive path, member name)"""
+    archive_path, member = path.rsplit(ARCHIVE_SEPARATOR, 1)
+    if escape_path(member):
+        raise IOError("Archive path %r references a file outside the archive" % (path,))
+    return archive_path, member
+
+
+def local_file(path):
+    """The filesystem file holding path (the outermost archive for archive paths)"""
+    return os.path.abspath(path.split(ARCHIVE_SEPARATOR, 1)[0])
+
+
+def archive(path):
+    """Get the shared PK3Archive for the (archive) path, reindexing if stale"""
+    if not is_archive_path(path):
+        path = os.path.abspath(path)
+    with _archive_lock:
+        current = _archives.get(path)
+        if current is not None and not current.stale():
+            return current
+        if is_archive_path(path):
+            parent, member = split_archive_path(path)
+            current = archive(parent).nested(member)
+        else:
+            current = PK3Archive.from_file(path)
+        _archives[path] = current
+        return current
+
+
+def is_archive(path):
+    """Is path an archive (rather than a directory or other file)?"""
+    if is_archive_path(path):
+        return os.path.splitext(path)[1].lower() in ARCHIVE_EXTENSIONS
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
+
+
+def join_path(base, relative):
+    """Join relative onto base, a directory or an archive"""
+    if is_archive(base):
+        return base + ARCHIVE_SEPARATOR + relative
+    return os.path.join(base, relative)
+
+
+def open_path(path):
+    """Open path (archive member or file) for binary reading"""
+    if is_archive_path(path):
+        parent, member = split_archive_path(path)
+        return archive(parent).open(member)
+    return open(path, "rb")
+
+
+def read_array(path, dtype="c"):
+    """Get path as a numpy array without copying where possible
+
+    Regular files are memory-mapped copy-on-write, archive members are
+    slices of the mapped archive if stored, otherwise inflated.
+    """
+    if is_archive_path(path):
+        parent, member = split_archive_path(path)
+        return archive(parent).array(member, dtype)
+    return numpy.memmap(path, dtype=dtype, mode="c")
+
+
+def getsize(path):
+    """Size of path (archive member or file) in bytes"""
+    if is_archive_path(path):
+        parent, member = split_archive_path(path)
+        return archive(parent).info(member).file_size
+    return os.path.getsize(path)
+
+
+def stamp_path(path):
+    """Modification stamp of path (archive member or file)
+
+    Files give [mtime, size], members the stamp of the file holding the
+    archive plus the member's crc and size.
+    """
+    if is_archive_path(path):
+        parent, member = split_archive_path(path)
+        current = archive(parent)
+        info = current.info(member)
+        return list(current.source[1:]) + [info.CRC, info.file_size]
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def glob_path(pattern):
+    """Glob pattern, matching members (case-insensitively) if it names an archive"""
+    if is_archive_path(pattern):
+        parent, member = split_archive_path(pattern)
+        try:
+            current = archive(parent)
+        except (IOError, OSError, zipfile.BadZipfile):
+            return []
+        member = member.lower()
+        return sorted(
+            [
+                current.member_path(name)
+                for name in current.names()
+                if fnmatch(name.lower(), member)
+            ]
+        )
+    return glob.glob(pattern)
+
+
+def find_bsp(pk3, resources=False, bsp_name=None):
+    """Find the .bsp to load from pk3 without unpacking it
+
+    Searches the archive and any archives nested within it.
+
+    returns archive path of the bsp file (None for resource packs without one)
+    """
+    bsps = []
+    pending = [archive(pk3)]
+    while pending:
+        current = pending.pop(0)
+        for name in sorted(current.names()):
+            if os.path.splitext(name)[1].lower() == ".bsp":
+                bsps.append(current.member_path(name))
+        for name in current.nested_archives():
+            pending.append(archive(current.member_path(name)))
+    bsps = choose_bsp(bsps, resources=resources, bsp_name=bsp_name)
     return bsps[0] if bsps else None
+
+
+def resolve_target(target, bsp_name=None, extract=False):
+    """Resolve a command-line map target to the bsp file to load
+
+    target -- url (downloaded into the cache), .pk3/.zip file (read in
+        place, or unpacked into the cache with extract) or .bsp file
+
+    returns path (archive path unless unpacked) of the bsp file
+    """
+    if target.startswith("http://") or target.startswith("https://"):
+        from . import downloader
+
+        return downloader.pull_pk3(target, unpack=extract)
+    elif os.path.isfile(target) and (
+        target.lower().endswith(".pk3") or target.lower().endswith(".zip")
+    ):
+        if extract:
+            directory = unpack_directory(key(os.path.basename(target)))
+            log.info("Unpacking PK3 to %s", directory)
+            return unpack(target, directory, bsp_name=bsp_name)
+        return find_bsp(target, bsp_name=bsp_name)
+    return target
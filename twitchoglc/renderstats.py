@@ -0,0 +1,234 @@
+"""Per-frame render statistics and timing
+
+A RenderStats assigned to maprender.Map.stats is told about each frame
+the map renders: the number of draw calls, triangles, texture and
+lightmap binds, cull-state changes, the faces removed by each culling
+stage, the CPU time spent in each phase of the frame and (where timer
+queries are available) the GPU time of the frame, including the
+uploads run while the map is loading.  Recent frames are kept for
+summaries (summary, overlay_lines) and every frame can be written to a
+stream as CSV rows or JSON lines for offline analysis.
+
+GPU times are read from the timer queries a few frames later, when the
+results are available, so frames are only complete (and streamed) once
+their GPU time has been read.
+"""
+from __future__ import absolute_import
+import time, json, collections, logging
+import numpy
+from OpenGL.GL import *
+log = logging.getLogger( __name__ )
+
+timer = getattr( time, 'perf_counter', time.time )
+
+COUNTERS = [
+    'draw_calls',
+    'triangles',
+    'texture_binds',
+    'lightmap_binds',
+    'cull_changes',
+    'faces',
+    'pvs_culled',
+    'frustum_culled',
+    'uploads',
+]
+PHASES = [
+    'uploads',
+    'culling',
+    'sky',
+    'packed',
+    'world',
+    'patches',
+]
+FIELDS = ['frame','start','cpu_time','gpu_time'] + COUNTERS + ['%s_time'%( phase, ) for phase in PHASES]
+
+class FrameStats( object ):
+    """Counters and timings for a single frame
+
+    counters -- {name: count} for COUNTERS
+    times -- {phase: CPU seconds} for PHASES
+    gpu_time -- GPU seconds for the frame (None if not measured)
+    """
+    gpu_time = None
+    cpu_time = 0.0
+    def __init__( self, frame, start ):
+        self.frame = frame
+        self.start = start
+        self.counters = dict( [(name,0) for name in COUNTERS] )
+        self.times = dict( [(phase,0.0) for phase in PHASES] )
+    def as_dict( self ):
+        """Flatten to {field: value} for FIELDS"""
+        record = {
+            'frame': self.frame,
+            'start': self.start,
+            'cpu_time': self.cpu_time,
+            'gpu_time': self.gpu_time,
+        }
+        record.update( self.counters )
+        for phase,value in self.times.items():
+            record['%s_time'%( phase, )] = value
+        return record
+
+def supports_timer_queries():
+    """Does the current context support GL_TIME_ELAPSED queries (OpenGL 3.3)?"""
+    try:
+        version = glGetString( GL_VERSION )
+        major, minor = [int( x ) for x in version.split( b' ' )[0].split( b'.' )[:2]]
+    except (TypeError, ValueError, AttributeError, GLError):
+        return False
+    return (major, minor) >= (3,3) and bool( glGetQueryObjectui64v )
+
+class RenderStats( object ):
+    """Collects FrameStats for the frames of a maprender.Map
+
+    frames -- the most recent complete FrameStats (up to history)
+    current -- FrameStats being recorded (None between frames)
+    stream -- optional file to which each complete frame is written,
+        as format 'csv' rows or 'json' lines
+    """
+    # number of complete frames kept for summaries
+    history = 300
+    # whether to measure GPU time with timer queries when available
+    gpu_timing = True
+    current = None
+    _phase = None
+    _queries = None
+    def __init__( self, stream=None, format='json' ):
+        if format not in ('csv','json'):
+            raise ValueError( 'Unknown render statistics format %r'%( format, ) )
+        self.stream = stream
+        self.format = format
+        self.frames = collections.deque( maxlen=self.history )
+        self.count_frames = 0
+        self.pending = []
+        if stream is not None and format == 'csv':
+            stream.write( ','.join( FIELDS ) + '\n' )
+
+    def begin_frame( self ):
+        """Start recording a frame (requires a current context for GPU timing)"""
+        self.collect_queries()
+        self.current = FrameStats( self.count_frames, time.time() )
+        self.count_frames += 1
+        self._frame_start = timer()
+        self._phase = None
+        self._query = None
+        if self.gpu_timing:
+            if self._queries is None:
+                self._queries = [] if supports_timer_queries() else False
+            if self._queries is not False:
+                self._query = self._queries.pop() if self._queries else int( glGenQueries( 1 ) )
+                glBeginQuery( GL_TIME_ELAPSED, self._query )
+
+    def phase( self, name ):
+        """End the current phase (if any) and start timing phase name"""
+        now = timer()
+        if self._phase is not None:
+            self.current.times[self._phase[0]] += now - self._phase[1]
+        self._phase = (name, now) if name else None
+
+    def count( self, name, value=1 ):
+        """Add value to the current frame's counter name"""
+        self.current.counters[name] += int( value )
+
+    def draw( self, counts ):
+        """Count a draw call of the (start,count) ranges with counts"""
+        counters = self.current.counters
+        counters['draw_calls'] += 1
+        counters['triangles'] += int( numpy.sum( counts ) ) // 3
+
+    def end_frame( self ):
+        """Finish recording the current frame"""
+        self.phase( None )
+        frame = self.current
+        frame.cpu_time = timer() - self._frame_start
+        self.current = None
+        if self._query is not None:
+            glEndQuery( GL_TIME_ELAPSED )
+            self.pending.append( (frame, self._query) )
+        else:
+            self.complete( frame )
+
+    def collect_queries( self ):
+        """Read the GPU times of frames whose queries have finished"""
+        while self.pending:
+            frame, query = self.pending[0]
+            if not glGetQueryObjectiv( query, GL_QUERY_RESULT_AVAILABLE ):
+                break
+            frame.gpu_time = glGetQueryObjectui64v( query, GL_QUERY_RESULT ) / 1e9
+            self.pending.pop( 0 )
+            self._queries.append( query )
+            self.complete( frame )
+
+    def flush( self ):
+        """Wait for the outstanding GPU times, completing all recorded frames"""
+        for frame, query in self.pending:
+            frame.gpu_time = glGetQueryObjectui64v( query, GL_QUERY_RESULT ) / 1e9
+            self._queries.append( query )
+            self.complete( frame )
+        self.pending = []
+        if self.stream is not None:
+            self.stream.flush()
+
+    def close( self ):
+        """Close the stream, completing frames still waiting for their GPU times
+
+        Doesn't need a context (e.g. after the window is gone), the
+        waiting frames are written without GPU times.
+        """
+        for frame, query in self.pending:
+            self.complete( frame )
+        self.pending = []
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def complete( self, frame ):
+        self.frames.append( frame )
+        if self.stream is not None:
+            record = frame.as_dict()
+            if self.format == 'csv':
+                self.stream.write( ','.join( [
+                    '' if record[field] is None else str( record[field] )
+                    for field in FIELDS
+                ] ) + '\n' )
+            else:
+                self.stream.write( json.dumps( record ) + '\n' )
+
+    def summary( self ):
+        """Summarize the recent frames
+
+        returns {field: {'mean':x,'p50':x,'p95':x,'max':x}} for the
+        numeric FIELDS measured in the recent frames
+        """
+        records = [frame.as_dict() for frame in self.frames]
+        result = {}
+        for field in FIELDS[2:]:
+            values = numpy.array( [
+                record[field] for record in records if record[field] is not None
+            ], 'd' )
+            if not len(values):
+                continue
+            result[field] = {
+                'mean': float( numpy.mean( values ) ),
+                'p50': float( numpy.percentile( values, 50 ) ),
+                'p95': float( numpy.percentile( values, 95 ) ),
+                'max': float( numpy.max( values ) ),
+            }
+        return result
+
+    def overlay_lines( self ):
+        """Lines of text describing the latest complete frame"""
+        if not self.frames:
+            return ['No frames']
+        frame = self.frames[-1]
+        counters = frame.counters
+        gpu = '-' if frame.gpu_time is None else '%.2fms'%( frame.gpu_time*1000, )
+        return [
+            'frame %s cpu %.2fms gpu %s'%( frame.frame, frame.cpu_time*1000, gpu ),
+            'draws %(draw_calls)s triangles %(triangles)s uploads %(uploads)s'%counters,
+            'binds texture %(texture_binds)s lightmap %(lightmap_binds)s cull %(cull_changes)s'%counters,
+            'faces %(faces)s culled pvs %(pvs_culled)s frustum %(frustum_culled)s'%counters,
+            ' '.join( [
+                '%s %.2fms'%( phase, frame.times[phase]*1000 ) for phase in PHASES
+            ] ),
+        ]
@@ -0,0 +1,292 @@
+"""Quake-style layered search path over pack directories and archives
+
+Files named by the map (textures, shader scripts...) are resolved
+against an ordered list of layers, each an unpacked pack directory or
+a pk3/zip archive (read in place, see pk3.PK3Archive).  Layers earlier
+in the list take priority, the default order (default_layers) is:
+
+    * the map's own pack
+    * resource packs (twitch-downloader --resources)
+    * base packs, the pk3s of the directories in $TWITCH_BASE_PATH
+      (e.g. a baseq3 directory) with later paks overriding earlier
+      ones as in Quake III
+    * the other packs in pk3.MAPS_DIR
+
+The layers are merged into a single {lower-cased relative name: entry}
+index, so a lookup is a dictionary access regardless of the number of
+packs.  Only the top-level files and the INDEXED_DIRECTORIES trees of a
+directory layer are listed, so a large game directory's unrelated
+trees aren't walked.  The merged index, and the file listing of each
+layer, are saved in INDEX_DIR along with the modification stamps of
+the layers, so later startups reuse them without walking directories
+or reading archives unless a layer has changed.
+"""
+from __future__ import absolute_import
+import os, glob, json, hashlib, logging, tempfile, threading, time
+from fnmatch import fnmatch
+from . import pk3
+log = logging.getLogger( __name__ )
+
+INDEX_DIR = os.path.join( os.path.dirname( pk3.MAPS_DIR ), 'index' )
+INDEX_VERSION = 2
+# top-level directories of a pack holding files we look up, a layer 
+# directory (e.g. baseq3) may hold much else which we don't walk
+INDEXED_DIRECTORIES = ('textures','env','models','gfx','sprites','scripts','maps')
+BASE_PATH_ENVIRONMENT = 'TWITCH_BASE_PATH'
+# created in a MAPS_DIR pack directory downloaded as resources
+RESOURCES_MARKER = '.resources'
+SOURCE_FILE = 'source-file'
+
+def normalize( relative ):
+    """Normalize a relative name for lookup"""
+    return relative.replace( '\\', '/' ).lower()
+
+def is_current( layer, stamp ):
+    """Is the stamp recorded for layer still valid?
+
+    Directory layers are checked from the layer itself down, so a 
+    changed layer is found without looking at its subdirectories.
+    """
+    if isinstance( stamp, dict ):
+        directories = [os.curdir] + [
+            directory for directory in stamp if directory != os.curdir
+        ]
+        for directory in directories:
+            try:
+                if os.stat( os.path.join( layer, directory ) ).st_mtime != stamp.get( directory ):
+                    return False
+            except OSError:
+                return False
+        return True
+    try:
+        filename, mtime, size = stamp
+        current = os.stat( filename )
+    except (OSError, TypeError, ValueError):
+        return False
+    return (current.st_mtime, current.st_size) == (mtime, size)
+
+def scan_directory( layer ):
+    """List the files of directory layer and below its INDEXED_DIRECTORIES
+
+    returns (stamp, [(relative,path),...]) where stamp is the mtime of
+    each directory listed, by relative name (os.curdir for the layer)
+    """
+    stamp = {os.curdir: os.stat( layer ).st_mtime}
+    files = []
+    for name in os.listdir( layer ):
+        path = os.path.join( layer, name )
+        if not os.path.isdir( path ):
+            files.append( (name, path) )
+            continue
+        if name.lower() not in INDEXED_DIRECTORIES:
+            continue
+        for directory, subdirectories, filenames in os.walk( path ):
+            relative_directory = os.path.relpath( directory, layer )
+            try:
+                stamp[relative_directory] = os.stat( directory ).st_mtime
+            except OSError:
+                continue
+            for filename in filenames:
+                relative = os.path.normpath( os.path.join( relative_directory, filename ) )
+                files.append( (relative, os.path.join( directory, filename )) )
+    return stamp, files
+
+def scan_archive( layer ):
+    """List the members of archive layer and of the archives nested in it
+
+    returns (stamp, [(relative,archive path),...])
+    """
+    archive = pk3.archive( layer )
+    files = []
+    pending = [archive]
+    while pending:
+        current = pending.pop(0)
+        for name in current.names():
+            files.append( (name, current.member_path( name )) )
+        for name in current.nested_archives():
+            pending.append( pk3.archive( current.member_path( name ) ) )
+    return list( archive.source ), files
+
+def _cache_file( cache_directory, kind, key ):
+    return os.path.join(
+        cache_directory,
+        '%s-%s.json'%( kind, hashlib.sha1( key.encode( 'utf-8' ) ).hexdigest() ),
+    )
+
+def _read_cache( filename ):
+    try:
+        with open( filename ) as fh:
+            data = json.load( fh )
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get( 'version' ) != INDEX_VERSION:
+        return None
+    return data
+
+def _write_cache( filename, data ):
+    data['version'] = INDEX_VERSION
+    directory = os.path.dirname( filename )
+    try:
+        if not os.path.exists( directory ):
+            os.makedirs( directory )
+        handle, working = tempfile.mkstemp( dir=directory, suffix='.json' )
+        with os.fdopen( handle, 'w' ) as fh:
+            json.dump( data, fh )
+        os.rename( working, filename )
+    except (IOError, OSError) as err:
+        log.warning( 'Unable to save search path index %s: %s', filename, err )
+
+def layer_listing( layer, cache_directory=INDEX_DIR ):
+    """Get (stamp, files) for layer, from the saved listing if still current"""
+    cache_file = None
+    if cache_directory:
+        cache_file = _cache_file( cache_directory, 'layer', layer )
+        cached = _read_cache( cache_file )
+        if cached and cached['layer'] == layer and is_current( layer, cached['stamp'] ):
+            return cached['stamp'], [tuple(record) for record in cached['files']]
+    start = time.time()
+    if os.path.isdir( layer ):
+        stamp, files = scan_directory( layer )
+    else:
+        stamp, files = scan_archive( layer )
+    log.info( 'Indexed %s files of %s in %0.3fs', len(files), layer, time.time()-start )
+    if cache_file:
+        _write_cache( cache_file, {'layer':layer,'stamp':stamp,'files':files} )
+    return stamp, files
+
+class SearchPath( object ):
+    """Ordered layers merged into a single index
+
+    layers -- directories and archive paths, highest priority first
+    stamps -- modification stamp of each layer when indexed
+    files -- {normalized relative name: (layer number, path)} taking
+        each name from the highest-priority layer providing it
+    """
+    def __init__( self, layers, stamps, files ):
+        self.layers = layers
+        self.stamps = stamps
+        self.files = files
+
+    @classmethod
+    def build( cls, layers, cache_directory=INDEX_DIR ):
+        """Merge the listings of layers (see layer_listing)"""
+        stamps = []
+        files = {}
+        for number,layer in enumerate( layers ):
+            try:
+                stamp, listing = layer_listing( layer, cache_directory )
+            except (IOError, OSError) as err:
+                log.warning( 'Unable to index search path layer %s: %s', layer, err )
+                stamp, listing = None, []
+            stamps.append( stamp )
+            for relative, path in listing:
+                files.setdefault( normalize( relative ), (number,path) )
+        return cls( layers, stamps, files )
+
+    @classmethod
+    def load( cls, layers, cache_directory=INDEX_DIR ):
+        """Load the saved merged index for layers, rebuilding it if any layer changed"""
+        if not cache_directory:
+            return cls.build( layers, None )
+        cache_file = _cache_file( cache_directory, 'path', json.dumps( layers ) )
+        cached = _read_cache( cache_file )
+        if cached and cached['layers'] == layers:
+            search = cls(
+                layers, cached['stamps'],
+                dict([ (name,tuple(entry)) for name,entry in cached['files'].items() ]),
+            )
+            if not search.stale():
+                return search
+        search = cls.build( layers, cache_directory )
+        _write_cache( cache_file, {
+            'layers': layers, 'stamps': search.stamps, 'files': search.files,
+        })
+        return search
+
+    def stale( self ):
+        """Has any layer changed since it was indexed?"""
+        for layer, stamp in zip( self.layers, self.stamps ):
+            if stamp is not None and not is_current( layer, stamp ):
+                return True
+        return False
+
+    def __contains__( self, relative ):
+        return normalize( relative ) in self.files
+
+    def find( self, relative ):
+        """Find the path providing relative (None if no layer has it)"""
+        entry = self.files.get( normalize( relative ) )
+        return entry[1] if entry else None
+
+    def glob( self, pattern ):
+        """Find the paths whose relative names match pattern (case-insensitive)
+
+        returns [(relative,path),...] sorted by relative name
+        """
+        pattern = normalize( pattern )
+        return sorted([
+            (relative, path)
+            for relative,(layer,path) in self.files.items()
+            if fnmatch( relative, pattern )
+        ])
+
+def pack_layers( directory ):
+    """Layers for a MAPS_DIR pack: its unpack directory, then its downloaded archive"""
+    return [directory, os.path.join( directory, SOURCE_FILE )]
+
+def base_layers( base_path=None ):
+    """Layers for the base packs in the directories of base_path
+
+    base_path -- os.pathsep separated directories, defaults to
+        $TWITCH_BASE_PATH
+
+    Within a directory the pk3s override each other in reverse name
+    order (pak8 over pak0) and all override the loose files.
+    """
+    if base_path is None:
+        base_path = os.environ.get( BASE_PATH_ENVIRONMENT, '' )
+    layers = []
+    for directory in filter( None, base_path.split( os.pathsep ) ):
+        paks = [
+            path for path in glob.glob( os.path.join( directory, '*' ) )
+            if os.path.splitext( path )[1].lower() == '.pk3'
+        ]
+        layers.extend( sorted( paks, key=lambda path: os.path.basename( path ).lower(), reverse=True ) )
+        layers.append( directory )
+    return layers
+
+def default_layers( base_directory, others=None ):
+    """Get the search path layers for a map with pack base_directory
+
+    base_directory -- directory or archive (path) holding the map
+    others -- layers after base_directory, defaults to the resource
+        packs, the base packs, then the other packs in pk3.MAPS_DIR
+    """
+    if others is None:
+        resources, maps = [], []
+        for directory in sorted( glob.glob( os.path.join( pk3.MAPS_DIR, '*' ) ) ):
+            if os.path.exists( os.path.join( directory, RESOURCES_MARKER ) ):
+                resources.extend( pack_layers( directory ) )
+            else:
+                maps.extend( pack_layers( directory ) )
+        others = resources + base_layers() + maps
+    layers = []
+    for layer in [base_directory] + list( others ):
+        if not pk3.is_archive_path( layer ):
+            layer = os.path.abspath( layer )
+            if not (os.path.isdir( layer ) or pk3.is_archive( layer )):
+                continue
+        if layer not in layers:
+            layers.append( layer )
+    return layers
+
+_search_paths = {}
+_lock = threading.Lock()
+def search_path( layers, cache_directory=INDEX_DIR ):
+    """Get the shared SearchPath for layers, reindexing changed layers"""
+    key = tuple( layers )
+    with _lock:
+        search = _search_paths.get( key )
+        if search is None or search.stale():
+            search = _search_paths[key] = SearchPath.load( list( layers ), cache_directory )
+        return search
@@ -0,0 +1,143 @@
+"""Hand-written parser for shader scripts
+
+Produces the same productions as the simpleparse grammar in
+twitchoglc.shaderparser, but works directly on the text with a few
+compiled regular expressions (one match per name/number/whitespace run)
+rather than building a tag tree and dispatching over it, which is much
+faster on large script collections.
+
+The parser follows the grammar's exact semantics, including its quirks:
+
+    * command parameters run to the end of the line, but a vector's
+      trailing whitespace may include newlines, so the command
+      continues on the next line after a vector
+    * a production which does not parse completely ends the file,
+      the productions before it are kept
+    * numbers are converted with int() falling back to float(), so
+      literals such as 0x10 or '.' raise ValueError
+"""
+from __future__ import absolute_import
+import re
+
+NAME = r'[-a-zA-Z][-_./a-zA-Z0-9]*'
+# simpleparse.common.numbers: hex / float / int, all with sign := [-+]+
+NUMBER = (
+    r'[-+]*0[xX][0-9a-fA-F]+'
+    r'|[-+]*(?:[0-9]+\.[0-9]*|\.[0-9]*)(?:[eE][-+]*[0-9]+)?'
+    r'|[-+]*[0-9]+'
+)
+# [ \011-\015]+ / slashslash_comment (to and including the newline, or EOF)
+TS = re.compile( r'(?:[ \t-\r]+|//[^\n]*(?:\n|\Z))*' )
+NAME_TS_SIMPLE = re.compile( r'(%s)[ \t]*'%( NAME, ) )
+NAME_TS = re.compile( r'(%s)'%( NAME, ) )
+# ref / number / vector / name, each followed by ts_simple
+PARAMETER = re.compile(
+    r'(?:(\$%s)|(%s)|(\()|(%s))[ \t]*'%( NAME, NUMBER, NAME )
+)
+VECTOR_NUMBER = re.compile( r'(%s)'%( NUMBER, ) )
+REF, NUMBER_GROUP, VECTOR, NAME_GROUP = 1, 2, 3, 4
+
+class ParseFailure( Exception ):
+    """The production being parsed does not match the grammar"""
+
+def number( text, errors ):
+    """Convert as ParseProcessor.number, recording failures in errors"""
+    try:
+        return int( text )
+    except ValueError:
+        try:
+            return float( text )
+        except ValueError as err:
+            errors.append( err )
+            return text
+
+def parse_vector( content, position, errors ):
+    """Parse a vector starting after the '(' at position
+
+    returns (numbers, position after the vector's trailing ts)
+    """
+    values = []
+    position = TS.match( content, position ).end()
+    while True:
+        match = VECTOR_NUMBER.match( content, position )
+        if match is None:
+            break
+        values.append( number( match.group( 1 ), errors ) )
+        position = TS.match( content, match.end() ).end()
+    if content[position:position+1] != ')':
+        raise ParseFailure( position )
+    return values, TS.match( content, position+1 ).end()
+
+def parse_command( content, match, errors ):
+    """Parse the parameters of the command whose name (and ts_simple) is match
+
+    returns ((name,params), position after the command)
+    """
+    params = []
+    position = match.end()
+    parameter = PARAMETER.match
+    while True:
+        current = parameter( content, position )
+        if current is None:
+            break
+        group = current.lastindex
+        if group == NAME_GROUP or group == REF:
+            params.append( current.group( group ) )
+            position = current.end()
+        elif group == NUMBER_GROUP:
+            params.append( number( current.group( group ), errors ) )
+            position = current.end()
+        else:
+            try:
+                values, position = parse_vector( content, current.end(), errors )
+            except ParseFailure:
+                break
+            params.append( values )
+            # the vector's ts consumed any newline, the ts_simple may follow
+            while position < len(content) and content[position] in ' \t':
+                position += 1
+    return (match.group( 1 ), params), position
+
+def parse_suite( content, position, errors ):
+    """Parse a suite starting with the '{' at position
+
+    returns (items, position after the suite's trailing ts)
+    """
+    items = []
+    position = TS.match( content, position+1 ).end()
+    while True:
+        match = NAME_TS_SIMPLE.match( content, position )
+        if match is not None:
+            command, position = parse_command( content, match, errors )
+            items.append( command )
+        elif content[position:position+1] == '{':
+            suite, position = parse_suite( content, position, errors )
+            items.append( suite )
+        else:
+            break
+        position = TS.match( content, position ).end()
+    if content[position:position+1] != '}':
+        raise ParseFailure( position )
+    return items, TS.match( content, position+1 ).end()
+
+def parse( content ):
+    """Parse shader script text into {name: suite} productions"""
+    productions = {}
+    position = TS.match( content, 0 ).end()
+    while True:
+        match = NAME_TS.match( content, position )
+        if match is None:
+            break
+        start = TS.match( content, match.end() ).end()
+        if content[start:start+1] != '{':
+            break
+        errors = []
+        try:
+            suite, end = parse_suite( content, start, errors )
+        except ParseFailure:
+            break
+        if errors:
+            raise errors[0]
+        productions[match.group( 1 )] = suite
+        position = TS.match( content, end ).end()
+    return productions
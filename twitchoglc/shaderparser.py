@@ -1,9 +1,18 @@
 #! /usr/bin/env python
 from __future__ import absolute_import
 from __future__ import print_function
+import os, sys, glob, logging, multiprocessing
+try:
+    from concurrent import futures
+except ImportError:
+    # python 2 without the futures backport, scripts parse serially
+    futures = None
 from simpleparse.parser import Parser
 from simpleparse.common import chartypes, comments, numbers, strings
 from simpleparse.dispatchprocessor import *
+from . import pk3
+from . import shaderlexer
+log = logging.getLogger( __name__ )
 
 grammar = r'''
 file            := ts,production+
@@ -24,26 +33,25 @@ def buildParser( declaration = grammar ):
     """Build a new VRMLParser object"""
     return ScriptParser( declaration, "file" )
 
-def test_parser( ):
-    parser = buildParser()
-    for should_match,production in [
-        ('//this\n//that', 'ts' ),
-        ('''//**********************************************************************//
+# (text, production) pairs which the grammar must match completely
+PARSER_CASES = [
+    ('//this\n//that', 'ts' ),
+    ('''//**********************************************************************//
 ''', 'ts'),
-        ('my/name/there', 'name'),
-        ('{ this and that 23.0 }', 'suite' ),
-        ('textures/focal/alpha_100', 'name' ),
-        ('rgbGen','name'),
-        ('{}', 'suite' ),
-        ('1.0', 'number'),
-        ('''	// Secondary texture ONLY
+    ('my/name/there', 'name'),
+    ('{ this and that 23.0 }', 'suite' ),
+    ('textures/focal/alpha_100', 'name' ),
+    ('rgbGen','name'),
+    ('{}', 'suite' ),
+    ('1.0', 'number'),
+    ('''	// Secondary texture ONLY
 ''', 'ts' ),
-        ('''textures/focal/alpha_100 {} ''', 'production' ),
-        ('''textures/focal/alpha_100
+    ('''textures/focal/alpha_100 {} ''', 'production' ),
+    ('''textures/focal/alpha_100
 {}''', 'production' ),
-        ('''textures/focal/alpha_100	// Secondary texture ONLY
+    ('''textures/focal/alpha_100	// Secondary texture ONLY
 {}''', 'production' ),
-        ('''textures/focal/alpha_100	// Secondary texture ONLY
+    ('''textures/focal/alpha_100	// Secondary texture ONLY
 {
 	qer_editorimage textures/focal/alpha_100.tga
 	q3map_alphaMod volume
@@ -53,7 +61,7 @@ def test_parser( ):
 	surfaceparm trans
 	qer_trans 0.7
 }''', 'production'),
-        ('''textures/focal/skyportal
+    ('''textures/focal/skyportal
 {
 	qer_editorimage textures/focal/sky_edit.jpg
 
@@ -80,8 +88,11 @@ def test_parser( ):
 	}
 }
 ''', 'production'),
-        
-    ]:
+]
+
+def test_parser( ):
+    parser = buildParser()
+    for should_match,production in PARSER_CASES:
         result = parser.parse( should_match, production )
         assert result[-1] == len(should_match), (should_match, production, result)
 
@@ -119,18 +130,124 @@ class ParseProcessor( DispatchProcessor ):
         (tag,start,stop,children) = match
         return dispatchList( self, children, buffer )
 
-def load( filename ):
-    content = open( filename ).read()
-    parser = buildParser()
-    processor = ParseProcessor()
+# parser used by default, 'lexer' (twitchoglc.shaderlexer) or 'simpleparse'
+PARSER = os.environ.get( 'TWITCH_SHADER_PARSER', 'lexer' )
+_parser = None
+def parse( content, parser=None ):
+    """Parse shader script text into {name: suite} productions
+    
+    parser -- 'lexer' or 'simpleparse', defaults to PARSER
     
-    parsed = parser.parse( content, production='file')
+    The grammar is only compiled on first use.
+    """
+    global _parser
+    parser = parser or PARSER
+    if parser == 'lexer':
+        return shaderlexer.parse( content )
+    elif parser != 'simpleparse':
+        raise ValueError( 'Unknown shader parser %r'%( parser, ) )
+    if _parser is None:
+        _parser = buildParser()
+    processor = ParseProcessor()
+    parsed = _parser.parse( content, production='file')
     processor( parsed, content )
     return processor.productions
+
+def load( filename, parser=None ):
+    """Parse the shader script filename (a file or pk3 archive path)"""
+    with pk3.open_path( filename ) as fh:
+        content = fh.read()
+    # normalise as text-mode reading did
+    content = content.decode( 'latin-1' ).replace( '\r\n', '\n' )
+    return parse( content, parser )
+
+# fewer changed files than this are parsed in-process, as starting the
+# worker processes costs more than it saves
+PARALLEL_MINIMUM = 8
+
+def _load_safely( filename, parser ):
+    """Load filename, returning (productions, error message)"""
+    try:
+        return load( filename, parser ), None
+    except Exception as err:
+        return {}, '%s: %s'%( err.__class__.__name__, err )
+
+def parse_files( paths, processes=None, parser=None ):
+    """Parse the shader scripts paths, in a process pool if there are enough
+    
+    processes -- number of worker processes, None for one per CPU, 0 (or 1)
+        to parse in this process
+    
+    returns [(productions, error message or None),...] in paths order
+    """
+    paths = list( paths )
+    # workers don't see changes to PARSER made at runtime
+    parser = parser or PARSER
+    if processes is None:
+        processes = (os.cpu_count() if hasattr( os, 'cpu_count' ) else None) or 1
+    if futures is None or processes < 2 or len(paths) < PARALLEL_MINIMUM:
+        return [_load_safely( path, parser ) for path in paths]
+    named = {}
+    if sys.version_info >= (3,7):
+        # we're called from the viewer's loading thread, forking while other
+        # threads hold locks (logging, pk3's archive cache) can deadlock the
+        # workers, so start fresh interpreters instead
+        named['mp_context'] = multiprocessing.get_context( 'spawn' )
+    try:
+        with futures.ProcessPoolExecutor( processes, **named ) as pool:
+            chunksize = max( 1, len(paths) // (4 * processes) )
+            return list( pool.map( _load_safely, paths, [parser]*len(paths), chunksize=chunksize ) )
+    except (OSError, futures.process.BrokenProcessPool) as err:
+        log.warning( 'Unable to parse shader scripts in worker processes, parsing serially: %s', err )
+        return [_load_safely( path, parser ) for path in paths]
+
+def merge_productions( productions ):
+    """Merge productions dictionaries, the first to define a shader wins
+    
+    Shader names are matched case-insensitively, this is the precedence
+    shaderregistry (and thus Twitch.brushes) uses, with the scripts in 
+    priority order.
+    
+    returns {name: suite}
+    """
+    merged = {}
+    for definitions in productions:
+        for name, suite in definitions.items():
+            merged.setdefault( name.lower(), (name, suite) )
+    return dict( merged.values() )
+
+def script_paths( paths ):
+    """Expand archives and pack directories in paths to their scripts/*.shader"""
+    result = []
+    for path in paths:
+        if os.path.isdir( path ):
+            result.extend( sorted( glob.glob( os.path.join( path, 'scripts', '*.shader' ) ) ) )
+        elif pk3.is_archive( path ):
+            result.extend( pk3.glob_path( pk3.join_path( path, 'scripts/*.shader' ) ) )
+        else:
+            result.append( path )
+    return result
+
+def load_many( paths, processes=None, parser=None ):
+    """Parse and merge many shader scripts (e.g. whole pack libraries)
+    
+    paths -- shader scripts, pk3 archives or pack directories in priority
+        order, a shader defined more than once comes from the first 
+        script defining it (see merge_productions)
+    processes -- see parse_files
+    
+    returns {name: suite}
+    """
+    scripts = script_paths( paths )
+    results = parse_files( scripts, processes, parser )
+    for path, (productions, error) in zip( scripts, results ):
+        if error:
+            log.warning( 'Unable to parse shader script %s: %s', path, error )
+    return merge_productions( [productions for productions, error in results] )
         
 def main( ):
     import sys 
-    productions = load( sys.argv[1] )
+    productions = load_many( sys.argv[1:] )
     def print_suite( suite, indent=1 ):
         print(' '*max((indent-1,0)),'{')
         for component in suite:
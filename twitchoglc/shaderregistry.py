@@ -0,0 +1,162 @@
+"""Registry of the shader scripts available in a search path
+
+Shaders are defined in scripts/*.shader files, a map's shaders may come
+from its own scripts/<map>.shader or from any shared script in its own
+or another pack (e.g. the base game's scripts).  The registry parses
+every script in the search path once, keeping a {name: definition}
+index.  Parsed productions are saved in CACHE_DIR along with the
+modification stamp of each script, so later loads only parse scripts
+which have changed.
+
+Where several scripts define the same shader the map's own script
+wins, then scripts in higher-priority search path layers, then the
+first script in name order, so the result doesn't depend on file
+system ordering.
+
+Each script's productions are cached in their own file, keyed by the
+script's path, so the scripts shared by many maps (e.g. the base game's)
+are parsed once rather than once for each map's search path.
+"""
+from __future__ import absolute_import
+import os, json, hashlib, logging, tempfile, time
+from . import pk3
+from . import shaderparser
+log = logging.getLogger( __name__ )
+
+CACHE_DIR = os.path.join( os.path.dirname( pk3.MAPS_DIR ), 'shaders' )
+FORMAT_VERSION = 2
+SCRIPT_PATTERN = 'scripts/*.shader'
+
+def restore( suite ):
+    """Convert a json-decoded suite back to parser output (commands are tuples)"""
+    result = []
+    for item in suite:
+        if item and not isinstance( item[0], list ):
+            result.append( (item[0], item[1]) )
+        else:
+            result.append( restore( item ) )
+    return result
+
+class ShaderRegistry( object ):
+    """Shader definitions from all the scripts in a searchpath.SearchPath
+
+    scripts -- [(relative,path),...] of the scripts in priority order
+    productions -- {path: {name: suite}} for each script
+    definitions -- {lower-cased name: (name, suite, path)}
+    """
+    # worker processes for parsing modified scripts (see shaderparser.parse_files)
+    processes = None
+    def __init__( self, search, first=None, cache_directory=CACHE_DIR ):
+        """Parse (or restore) the scripts in search
+
+        first -- relative name of the script which takes priority, e.g.
+            scripts/<map>.shader
+        """
+        self.search = search
+        scripts = [
+            (search.files[relative][0], relative, path)
+            for relative,path in search.glob( SCRIPT_PATTERN )
+        ]
+        if first:
+            first = first.lower()
+            scripts = [
+                (relative != first, layer, relative, path)
+                for layer,relative,path in scripts
+            ]
+        scripts.sort()
+        self.scripts = [record[-2:] for record in scripts]
+        self.productions = self.load_productions( cache_directory )
+        self.definitions = {}
+        for relative,path in self.scripts:
+            for name, suite in self.productions.get( path, {} ).items():
+                self.definitions.setdefault( name.lower(), (name, suite, path) )
+
+    def load_productions( self, cache_directory ):
+        """Get the productions of each script, from the cache when unchanged"""
+        productions = {}
+        stamps = {}
+        modified = []
+        start = time.time()
+        for relative,path in self.scripts:
+            try:
+                stamp = pk3.stamp_path( path )
+            except (IOError, OSError) as err:
+                log.warning( 'Unable to read shader script %s: %s', path, err )
+                continue
+            record = self.load_cached( cache_directory, path ) if cache_directory else None
+            if record and record['path'] == path and record['stamp'] == stamp:
+                productions[path] = dict([
+                    (name, restore( suite ))
+                    for name, suite in record['productions'].items()
+                ])
+            else:
+                stamps[path] = stamp
+                modified.append( path )
+        # parse the new and modified scripts in parallel
+        for path,(parsed,error) in zip( modified, shaderparser.parse_files( modified, self.processes ) ):
+            if error:
+                log.warning( 'Unable to parse shader script %s: %s', path, error )
+            productions[path] = parsed
+            if cache_directory:
+                self.save( self.cache_file( cache_directory, path ), {
+                    'path': path, 'stamp': stamps[path], 'productions': parsed,
+                } )
+        log.info(
+            'Loaded %s shader scripts in %0.3fs (%s parsed)',
+            len(productions), time.time()-start, len(modified),
+        )
+        return productions
+
+    @staticmethod
+    def cache_file( cache_directory, path ):
+        """Cache file holding the productions of the script path"""
+        return os.path.join(
+            cache_directory,
+            '%s-v%s.json'%(
+                hashlib.sha1( path.encode( 'utf-8' ) ).hexdigest(), FORMAT_VERSION,
+            ),
+        )
+
+    @classmethod
+    def load_cached( cls, cache_directory, path ):
+        """Load the cached record for the script path, None if not cached"""
+        try:
+            with open( cls.cache_file( cache_directory, path ) ) as fh:
+                return json.load( fh )
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def save( cache_file, record ):
+        directory = os.path.dirname( cache_file )
+        try:
+            if not os.path.exists( directory ):
+                os.makedirs( directory )
+            handle, working = tempfile.mkstemp( dir=directory, suffix='.json' )
+            with os.fdopen( handle, 'w' ) as fh:
+                json.dump( record, fh )
+            os.rename( working, cache_file )
+        except (IOError, OSError) as err:
+            log.warning( 'Unable to save parsed shaders %s: %s', cache_file, err )
+
+    def __contains__( self, name ):
+        return name.lower() in self.definitions
+
+    def find( self, name ):
+        """Get (name, suite) for the shader name (case-insensitive), or None"""
+        record = self.definitions.get( name.lower() )
+        return record[:2] if record else None
+
+    def script_definitions( self, relative ):
+        """Get {name: suite} defined by the script relative (e.g. scripts/x.shader)"""
+        path = self.search.find( relative )
+        return self.productions.get( path, {} ) if path else {}
+
+_registries = {}
+def shader_registry( search, first=None ):
+    """Get the shared ShaderRegistry for search (rebuilt if search was reindexed)"""
+    key = (tuple( search.layers ), first)
+    registry = _registries.get( key )
+    if registry is None or registry.search is not search:
+        registry = _registries[key] = ShaderRegistry( search, first )
+    return registry
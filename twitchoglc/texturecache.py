@@ -0,0 +1,141 @@
+"""On-disk cache of decoded, GPU-ready textures
+
+Decoding the .jpg/.tga textures (particularly hi-res packs) and
+resampling them to power-of-two sizes is repeated work on every launch.
+Instead each source image is decoded once to RGBA, resized to a power of
+two (rounding up, as Quake III does, up to a maximum size) and reduced
+to a complete mip chain, which is stored as a single .npy blob in
+CACHE_DIR keyed by the sha1 of the source file's content.  Warm loads
+memory-map the blob and hand its levels directly to glTexImage2D.
+
+Levels are stored top row first, each level immediately after the
+previous one, so the layout is implied by the (power-of-two) size,
+which we get from the source's header without decoding it.
+"""
+from __future__ import absolute_import
+import os, io, hashlib, logging, tempfile
+import numpy
+from . import pk3
+log = logging.getLogger( __name__ )
+
+CACHE_DIR = os.path.join( os.path.dirname( pk3.MAPS_DIR ), 'textures' )
+FORMAT_VERSION = 1
+MAX_SIZE = 2048
+
+def pow2_size( size, max_size=MAX_SIZE ):
+    """Round size up to a power of two, no larger than max_size"""
+    result = 1
+    while result < size and result < max_size:
+        result *= 2
+    return result
+
+def mip_sizes( width, height ):
+    """(width,height) of each mip level down to 1x1"""
+    sizes = [(width,height)]
+    while width > 1 or height > 1:
+        width, height = max( 1, width//2 ), max( 1, height//2 )
+        sizes.append( (width,height) )
+    return sizes
+
+def downsample( level ):
+    """Box-filter an H x W x C uint8 level to the next mip level"""
+    height, width = level.shape[:2]
+    total = level.astype( 'H' )
+    divisor = 1
+    if height > 1:
+        total = total[0::2] + total[1::2]
+        divisor *= 2
+    if width > 1:
+        total = total[:,0::2] + total[:,1::2]
+        divisor *= 2
+    return ((total + divisor//2) // divisor).astype( 'B' )
+
+class MipTexture( object ):
+    """Power-of-two RGBA texture with its full mip chain
+
+    data -- flat uint8 array holding all levels (possibly memory-mapped)
+    levels -- H x W x 4 views into data, largest first
+    info -- as for PIL images, url/filename of the source image
+    """
+    mode = 'RGBA'
+    def __init__( self, data, width, height, info=None ):
+        self.data = data
+        self.width, self.height = width, height
+        self.levels = []
+        offset = 0
+        for level_width, level_height in mip_sizes( width, height ):
+            count = level_width * level_height * 4
+            self.levels.append(
+                data[offset:offset+count].reshape( (level_height,level_width,4) )
+            )
+            offset += count
+        self.info = info or {}
+    @property
+    def size( self ):
+        return (self.width, self.height)
+
+    @classmethod
+    def from_image( cls, image, max_size=MAX_SIZE ):
+        """Decode PIL image, resampling to a power of two and building the mipmaps"""
+        from PIL import Image
+        if image.mode != 'RGBA':
+            image = image.convert( 'RGBA' )
+        width, height = [pow2_size( x, max_size ) for x in image.size]
+        if (width,height) != image.size:
+            image = image.resize( (width,height), Image.BICUBIC )
+        level = numpy.asarray( image, dtype='B' )
+        levels = [level.reshape( (-1,) )]
+        while level.shape[0] > 1 or level.shape[1] > 1:
+            level = downsample( level )
+            levels.append( level.reshape( (-1,) ) )
+        return cls( numpy.concatenate( levels ), width, height )
+
+def data_size( width, height ):
+    """Bytes of the blob for a width x height texture"""
+    return sum( [w*h*4 for w,h in mip_sizes( width, height )] )
+
+def cache_file( hash, max_size=MAX_SIZE, cache_directory=CACHE_DIR ):
+    return os.path.join(
+        cache_directory, hash[:2],
+        '%s-%s-v%s.npy'%( hash, max_size, FORMAT_VERSION ),
+    )
+
+def save( texture, filename ):
+    """Write texture's blob to filename atomically"""
+    directory = os.path.dirname( filename )
+    try:
+        if not os.path.exists( directory ):
+            os.makedirs( directory )
+        handle, working = tempfile.mkstemp( dir=directory, suffix='.npy' )
+        with os.fdopen( handle, 'wb' ) as fh:
+            numpy.save( fh, numpy.ascontiguousarray( texture.data ) )
+        os.rename( working, filename )
+    except (IOError, OSError) as err:
+        log.warning( 'Unable to cache decoded texture %s: %s', filename, err )
+
+def load_texture( path, max_size=MAX_SIZE, cache_directory=CACHE_DIR ):
+    """Load the image file path (file or archive path) as a MipTexture
+
+    Uses the cached blob for the file's content if available, otherwise
+    decodes the file and caches the result.
+    """
+    from PIL import Image
+    with pk3.open_path( path ) as fh:
+        content = fh.read()
+    image = Image.open( io.BytesIO( content ) )
+    width, height = [pow2_size( x, max_size ) for x in image.size]
+    filename = cache_file( hashlib.sha1( content ).hexdigest(), max_size, cache_directory )
+    info = {'url':path, 'filename':path}
+    if os.path.exists( filename ):
+        try:
+            data = numpy.load( filename, mmap_mode='r' )
+        except (IOError, OSError, ValueError) as err:
+            log.warning( 'Unable to read cached texture %s: %s', filename, err )
+        else:
+            if data.dtype == numpy.uint8 and data.shape == (data_size( width, height ),):
+                return MipTexture( data, width, height, info )
+            log.warning( 'Cached texture %s does not match %s, rebuilding', filename, path )
+    texture = MipTexture.from_image( image, max_size )
+    texture.info = info
+    save( texture, filename )
+    return texture
@@ -0,0 +1,84 @@
+"""Index of the image files available to resolve texture names
+
+Textures are referenced by extension-less (or wrong-extension) relative
+paths such as textures/base_wall/concrete, which may be satisfied by a
+.tga/.jpg/.png file in the map's own unpack directory, a hi-res x_
+variant next to it, or a file in any other pack (e.g. the core
+resources from twitch-downloader --resources).
+
+Rather than probing the filesystem for every candidate of every texture
+the layered search path (see twitchoglc.searchpath) provides a merged
+index of the files of all the packs, from which we build a dict from
+lower-cased path stem to the image files available.
+"""
+from __future__ import absolute_import
+import os, logging
+from . import searchpath
+log = logging.getLogger( __name__ )
+
+# in order of preference when several files share a stem
+IMAGE_EXTENSIONS = ['.tga','.jpg','.png','.jpeg']
+HIRES_PREFIX = 'x_'
+
+def split_stem( relative ):
+    """Normalize relative to a (lower-cased stem, image extension) pair
+
+    Extensions which are not image extensions are left on the stem.
+    """
+    relative = relative.replace( '\\', '/' ).lower()
+    stem, extension = os.path.splitext( relative )
+    if extension in IMAGE_EXTENSIONS:
+        return stem, extension
+    return relative, ''
+
+class TextureIndex( object ):
+    """Resolve texture names against a SearchPath
+
+    stems -- {stem: [(layer,hires,extension,path),...]} for the image 
+        files in the search path
+    """
+    def __init__( self, search ):
+        self.search = search
+        self.stems = {}
+        for relative,(layer,path) in search.files.items():
+            stem, extension = split_stem( relative )
+            if not extension:
+                continue
+            self.stems.setdefault( stem, [] ).append( (layer,False,extension,path) )
+            head,tail = os.path.split( stem )
+            if tail.startswith( HIRES_PREFIX ):
+                plain = '/'.join( filter( None, (head,tail[len(HIRES_PREFIX):]) ) )
+                self.stems.setdefault( plain, [] ).append( (layer,True,extension,path) )
+    def find( self, relative ):
+        """Find the image file for the relative texture name
+
+        The highest-priority layer having any candidate wins, within a 
+        layer plain files are preferred to x_ variants, then files with 
+        the requested extension, then IMAGE_EXTENSIONS order.
+
+        returns path or None
+        """
+        stem, extension = split_stem( relative )
+        candidates = self.stems.get( stem )
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key = lambda record: (
+                record[0],
+                record[1],
+                record[2] != extension,
+                IMAGE_EXTENSIONS.index( record[2] ),
+            ),
+        )[3]
+
+def texture_index( base_directory, others=None ):
+    """Get a TextureIndex for a map's base_directory
+
+    base_directory -- directory or archive (path) holding the map
+    others -- directories or archives to search after base_directory,
+        see searchpath.default_layers
+    """
+    return TextureIndex(
+        searchpath.search_path( searchpath.default_layers( base_directory, others ) )
+    )
@@ -0,0 +1,310 @@
+"""Collision traces (points, rays and swept boxes) against BSP brushes
+
+Follows the approach of the Quake III collision code: the BSP tree
+(nodes/planes/leafs) is walked to find the leaves a trace passes through,
+the leafbrushes lump gives the brushes in those leaves, and each brush
+is a convex volume bounded by the planes of its brushsides.  A box is
+swept by pushing each plane out by the box's extent along the plane's
+normal, so a ray is just a trace with a zero-sized box.
+
+All of the traversal is done for batches of traces at once, a tree
+level at a time, so that large numbers of traces (line-of-sight tables,
+navigation precalculation) do not need per-trace Python code.
+"""
+from __future__ import absolute_import
+import numpy, logging
+from .visibility import gather_ranges
+log = logging.getLogger( __name__ )
+
+CONTENTS_SOLID = 1
+CONTENTS_PLAYERCLIP = 0x10000
+CONTENTS_BODY = 0x2000000
+MASK_ALL = -1
+MASK_SOLID = CONTENTS_SOLID
+MASK_PLAYERSOLID = CONTENTS_SOLID|CONTENTS_PLAYERCLIP|CONTENTS_BODY
+# distance traces stop short of surfaces, so the end is never inside a brush
+SURFACE_CLIP_EPSILON = 0.125
+
+TRACE_RECORD = numpy.dtype( [
+    ('fraction','f4'),
+    ('end','f4',3),
+    ('plane','i4'),
+    ('normal','f4',3),
+    ('contents','i4'),
+    ('brush','i4'),
+    ('start_solid','?'),
+    ('all_solid','?'),
+] )
+
+def point_leaves( nodes, planes, points ):
+    """Walk the BSP tree to find the leaf containing each of points
+
+    Vectorized version of visibility.find_leaf, all points step down
+    one level of the tree at a time.
+
+    returns array of indices into the leafs array
+    """
+    points = numpy.asarray( points, dtype='f' ).reshape( (-1,3) )
+    index = numpy.zeros( (len(points),), dtype='i' )
+    if not len(nodes):
+        return index
+    active = numpy.arange( len(points) )
+    while len(active):
+        node = nodes[index[active]]
+        plane = planes[node['plane']]
+        distance = numpy.sum( plane['normal'] * points[active], -1 ) - plane['distance']
+        index[active] = numpy.where(
+            distance >= 0, node['children'][:,0], node['children'][:,1],
+        )
+        active = active[index[active] >= 0]
+    return -(index+1)
+
+def _half_interval( offset, slope, lo, hi ):
+    """Restrict [lo,hi] to the t where offset + slope*t >= 0
+
+    returns (lo, hi, non_empty)
+    """
+    with numpy.errstate( divide='ignore', invalid='ignore' ):
+        cross = -offset / slope
+    lo = numpy.where( slope > 0, numpy.maximum( lo, cross ), lo )
+    hi = numpy.where( slope < 0, numpy.minimum( hi, cross ), hi )
+    return lo, hi, (lo <= hi) & ~((slope == 0) & (offset < 0))
+
+def sweep_leaves( nodes, planes, starts, ends, extents ):
+    """Find the leaves touched by swept boxes
+
+    starts, ends -- N x 3 box centres at the start and end of the sweep
+    extents -- N x 3 box half-sizes
+
+    Each (trace,node) pair carries the fraction range of the trace which
+    is inside the node, which is split at each node's plane, so a trace
+    only visits the leaves along its path.
+
+    returns (traces, leaves) arrays of (trace index, leaf index) pairs
+    """
+    count = len(starts)
+    if not len(nodes):
+        return numpy.arange( count ), numpy.zeros( (count,), dtype='i' )
+    trace = numpy.arange( count )
+    node = numpy.zeros( (count,), dtype='i' )
+    lo = numpy.zeros( (count,), dtype='f' )
+    hi = numpy.ones( (count,), dtype='f' )
+    traces, leaves = [], []
+    while len(trace):
+        records = nodes[node]
+        plane = planes[records['plane']]
+        normal = plane['normal']
+        start_distance = numpy.sum( normal*starts[trace], -1 ) - plane['distance']
+        slope = (numpy.sum( normal*ends[trace], -1 ) - plane['distance']) - start_distance
+        offset = numpy.sum( numpy.abs( normal )*extents[trace], -1 ) + SURFACE_CLIP_EPSILON
+        front_lo, front_hi, front = _half_interval( start_distance+offset, slope, lo, hi )
+        back_lo, back_hi, back = _half_interval( offset-start_distance, -slope, lo, hi )
+        trace = numpy.concatenate( (trace[front], trace[back]) )
+        node = numpy.concatenate( (
+            records['children'][front,0], records['children'][back,1],
+        ) )
+        lo = numpy.concatenate( (front_lo[front], back_lo[back]) )
+        hi = numpy.concatenate( (front_hi[front], back_hi[back]) )
+        is_leaf = node < 0
+        traces.append( trace[is_leaf] )
+        leaves.append( -(node[is_leaf]+1) )
+        trace, node, lo, hi = trace[~is_leaf], node[~is_leaf], lo[~is_leaf], hi[~is_leaf]
+    return numpy.concatenate( traces ), numpy.concatenate( leaves )
+
+class Tracer( object ):
+    """Point, ray and box traces against the world brushes of a map
+
+    Only the brushes referenced from the BSP tree's leaves (the world
+    model) are considered, brush models such as doors are not.
+
+    Brushes with no contents in common with a trace's mask are ignored,
+    the default (MASK_SOLID) only collides with solid brushes.
+    """
+    # number of traces processed at once by trace_many
+    chunk_size = 65536
+    def __init__( self, nodes, planes, leafs, leafbrushes, brushes, brushsides, textures ):
+        self.nodes = nodes
+        self.planes = planes
+        self.leafs = leafs
+        self.leafbrushes = leafbrushes
+        self.brushes = brushes
+        self.brushsides = brushsides
+        self.brush_contents = textures['contents'][brushes['texture']]
+
+    def point_leaves( self, points ):
+        """Find the leaf index containing each of points"""
+        return point_leaves( self.nodes, self.planes, points )
+
+    def _leaf_brushes( self, owners, leaves, mask ):
+        """Expand (owner,leaf) pairs to unique (owner,brush) pairs with contents in mask"""
+        brush_ids, pair = gather_ranges(
+            self.leafbrushes,
+            self.leafs['leafbrush'][leaves], self.leafs['n_leafbrushes'][leaves],
+        )
+        owners = owners[pair]
+        wanted = ((self.brush_contents[brush_ids] & mask) != 0) & (
+            self.brushes['n_brushsides'][brush_ids] > 0
+        )
+        # a brush is normally in many leaves, only test it once per owner
+        key = numpy.unique(
+            owners[wanted].astype( 'int64' )*len(self.brushes) + brush_ids[wanted]
+        )
+        return key // len(self.brushes), (key % len(self.brushes)).astype( 'i' )
+
+    def _brush_sides( self, brush_ids ):
+        """Get (planes, owner, bounds) for the sides of each brush in brush_ids
+
+        bounds is the index of the first side of each brush, for reduceat
+        """
+        counts = self.brushes['n_brushsides'][brush_ids]
+        plane_ids, owner = gather_ranges(
+            self.brushsides['plane'], self.brushes['brushside'][brush_ids], counts,
+        )
+        return plane_ids, owner, numpy.cumsum( counts ) - counts
+
+    def point_contents( self, points, mask=MASK_ALL ):
+        """Calculate the combined contents of the brushes containing each point
+
+        returns integer array of contents flags (0 for empty space)
+        """
+        points = numpy.asarray( points, dtype='f' ).reshape( (-1,3) )
+        contents = numpy.zeros( (len(points),), dtype='i' )
+        owners, brush_ids = self._leaf_brushes(
+            numpy.arange( len(points) ), self.point_leaves( points ), mask,
+        )
+        if not len(brush_ids):
+            return contents
+        plane_ids, owner, bounds = self._brush_sides( brush_ids )
+        plane = self.planes[plane_ids]
+        distance = numpy.sum( plane['normal']*points[owners[owner]], -1 ) - plane['distance']
+        inside = numpy.logical_and.reduceat( distance <= 0, bounds )
+        numpy.bitwise_or.at(
+            contents, owners[inside], self.brush_contents[brush_ids[inside]],
+        )
+        return contents
+
+    def trace( self, start, end, mins=None, maxs=None, mask=MASK_SOLID ):
+        """Trace a single ray or box from start to end
+
+        returns a TRACE_RECORD (see trace_many)
+        """
+        return self.trace_many(
+            numpy.reshape( start, (1,3) ), numpy.reshape( end, (1,3) ),
+            mins, maxs, mask,
+        )[0]
+
+    def trace_many( self, starts, ends, mins=None, maxs=None, mask=MASK_SOLID ):
+        """Trace rays or boxes from starts to ends
+
+        starts, ends -- N x 3 arrays of positions
+        mins, maxs -- box relative to the positions, 3 or N x 3, if not
+            provided traces are rays
+        mask -- contents flags of the brushes to collide with
+
+        returns N TRACE_RECORD array with the fraction of the way from
+        start to end the trace got, the end position, the plane, normal,
+        contents and brush of the first brush hit (-1 for no hit), and
+        whether the trace started (start_solid) or stayed (all_solid)
+        inside a brush
+        """
+        starts = numpy.asarray( starts, dtype='f' ).reshape( (-1,3) )
+        ends = numpy.asarray( ends, dtype='f' ).reshape( (-1,3) )
+        if mins is None or maxs is None:
+            mins = maxs = numpy.zeros( (3,), dtype='f' )
+        mins = numpy.broadcast_to( numpy.asarray( mins, dtype='f' ), starts.shape )
+        maxs = numpy.broadcast_to( numpy.asarray( maxs, dtype='f' ), starts.shape )
+        result = numpy.zeros( (len(starts),), dtype=TRACE_RECORD )
+        for i in range( 0, len(starts), self.chunk_size ):
+            chunk = slice( i, i+self.chunk_size )
+            result[chunk] = self._trace_chunk(
+                starts[chunk], ends[chunk], mins[chunk], maxs[chunk], mask,
+            )
+        return result
+
+    def _trace_chunk( self, starts, ends, mins, maxs, mask ):
+        """Trace one chunk of trace_many"""
+        result = numpy.zeros( (len(starts),), dtype=TRACE_RECORD )
+        result['fraction'] = 1.0
+        result['plane'] = -1
+        result['brush'] = -1
+        # sweep a symmetric box around the centre of the (mins,maxs) box
+        centre = (mins+maxs)/2.
+        extents = (maxs-mins)/2.
+        box_starts, box_ends = starts+centre, ends+centre
+        traces, leaves = sweep_leaves(
+            self.nodes, self.planes, box_starts, box_ends, extents,
+        )
+        traces, brush_ids = self._leaf_brushes( traces, leaves, mask )
+        if len(brush_ids):
+            self._clip_brushes( result, traces, brush_ids, box_starts, box_ends, extents )
+        result['end'] = starts + result['fraction'][:,numpy.newaxis]*(ends-starts)
+        return result
+
+    def _clip_brushes( self, result, traces, brush_ids, starts, ends, extents ):
+        """Clip (trace,brush) pairs against the brush sides, updating result"""
+        plane_ids, owner, bounds = self._brush_sides( brush_ids )
+        plane = self.planes[plane_ids]
+        normal = plane['normal']
+        side_trace = traces[owner]
+        # push the planes out by the box's extent along the normal
+        distance = plane['distance'] + numpy.sum( numpy.abs( normal )*extents[side_trace], -1 )
+        d1 = numpy.sum( normal*starts[side_trace], -1 ) - distance
+        d2 = numpy.sum( normal*ends[side_trace], -1 ) - distance
+
+        # entirely in front of any side means the trace misses the brush
+        missed = numpy.logical_or.reduceat(
+            (d1 > 0) & ((d2 >= SURFACE_CLIP_EPSILON) | (d2 >= d1)), bounds,
+        )
+        crossing = (d1 > 0) | (d2 > 0)
+        entering = crossing & (d1 > d2)
+        leaving = crossing & (d1 <= d2)
+        denominator = numpy.where( d1 == d2, 1, d1-d2 )
+        # as CM_TraceThroughBrush, clamp each side's fractions to [0,1] so a
+        # short move starting within the epsilon of a side is blocked at 0
+        enter = numpy.where(
+            entering, numpy.maximum( (d1-SURFACE_CLIP_EPSILON)/denominator, 0 ), -1,
+        )
+        leave = numpy.where(
+            leaving, numpy.minimum( (d1+SURFACE_CLIP_EPSILON)/denominator, 1 ), 1,
+        )
+        enter_fraction = numpy.maximum.reduceat( enter, bounds )
+        leave_fraction = numpy.minimum.reduceat( leave, bounds )
+        start_out = numpy.logical_or.reduceat( d1 > 0, bounds )
+        get_out = numpy.logical_or.reduceat( d2 > 0, bounds )
+
+        # the plane we entered through is the one with the latest entry
+        candidates = numpy.flatnonzero( entering & (enter == enter_fraction[owner]) )
+        _, first = numpy.unique( owner[candidates], return_index=True )
+        hit_plane = numpy.full( (len(brush_ids),), -1, dtype='i' )
+        hit_plane[owner[candidates[first]]] = plane_ids[candidates[first]]
+
+        start_solid = ~missed & ~start_out
+        numpy.logical_or.at( result['start_solid'], traces[start_solid], True )
+        numpy.logical_or.at(
+            result['all_solid'], traces[start_solid & ~get_out], True,
+        )
+        hit = numpy.flatnonzero(
+            ~missed & start_out & (enter_fraction < leave_fraction) & (enter_fraction > -1)
+        )
+        fraction = enter_fraction[hit]
+
+        # keep the closest hit for each trace
+        order = numpy.lexsort( (fraction, traces[hit]) )
+        _, first = numpy.unique( traces[hit][order], return_index=True )
+        closest = hit[order[first]]
+        trace_ids = traces[closest]
+        result['fraction'][trace_ids] = fraction[order[first]]
+        result['brush'][trace_ids] = brush_ids[closest]
+        result['contents'][trace_ids] = self.brush_contents[brush_ids[closest]]
+        planes = hit_plane[closest]
+        result['plane'][trace_ids] = planes
+        result['normal'][trace_ids[planes >= 0]] = self.planes['normal'][planes[planes >= 0]]
+        result['fraction'][result['all_solid']] = 0
+
+    def line_of_sight( self, starts, ends, mask=MASK_SOLID ):
+        """Check whether each start can see the corresponding end
+
+        returns boolean array, True where nothing in mask is in the way
+        """
+        traces = self.trace_many( starts, ends, mask=mask )
+        return (traces['fraction'] >= 1.0) & ~traces['start_solid']
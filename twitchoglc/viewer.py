@@ -5,7 +5,7 @@ import OpenGL
 # OpenGL.FULL_LOGGING = True
 import logging, numpy, sys, threading, os
 from OpenGLContext import testingcontext
-from . import maprender
+from . import maprender, renderstats, pk3
 from OpenGL.GL import *
 from OpenGL.arrays import vbo
 from OpenGLContext.scenegraph import imagetexture, shape, transform
@@ -19,18 +19,32 @@ BaseContext = testingcontext.getInteractive()
 class TwitchContext(BaseContext):
     def __init__(self, *args, **named):
         self.target = named.pop("target")
+        self.backend = named.pop("backend", maprender.Map.backend)
+        self.stats = named.pop("stats", None)
+        self.show_stats = named.pop("show_stats", True)
         super(TwitchContext, self).__init__(*args, **named)
 
     def OnInit(self):
         self.renderer = maprender.Map(self.target)
+        self.renderer.backend = self.backend
+        self.renderer.stats = self.stats
+        if self.stats is not None:
+            self.addEventHandler("keypress", name="i", function=self.OnToggleStats)
+        spawn = self.renderer.spawn_point()
+        if spawn is not None:
+            position, orientation = spawn
+            self.platform.setPosition(position)
+            self.platform.setOrientation(orientation)
+        else:
+            log.info("No spawn point found in %s", self.target)
         threading.Thread(target=self.LoadAndRefresh).start()
         # default near is far too close for 8 units/foot quake model size
         self.platform.setFrustum(near=30, far=50000)
         self.movementManager.STEPDISTANCE = 50
 
     def LoadAndRefresh(self):
-        self.renderer.load()
-        self.triggerRedraw(False)
+        # redraw as data arrives, Render uploads it on the GL thread
+        self.renderer.load(refresh=lambda: self.triggerRedraw(False))
 
     def Render(self, mode=None):
         """Render the geometry for the scene."""
@@ -41,6 +55,52 @@ class TwitchContext(BaseContext):
             glRotatef(-90, 1.0, 0, 0)
             # glScalef( .01, .01, .01 )
             self.renderer.Render(mode)
+            if self.renderer.uploads:
+                # more loaded data than fit in this frame's upload budget
+                self.triggerRedraw(False)
+            if self.stats is not None and self.show_stats:
+                self.RenderStats(mode)
+
+    stats_text = None
+
+    def OnToggleStats(self, event):
+        """Show/hide the render statistics overlay"""
+        self.show_stats = not self.show_stats
+        self.triggerRedraw(False)
+
+    def RenderStats(self, mode):
+        """Draw the latest frame's render statistics in the top-left corner"""
+        if self.stats_text is None:
+            from OpenGLContext.scenegraph.basenodes import FontStyle
+
+            self.stats_text = text.Text(
+                fontStyle=FontStyle(
+                    family=["TYPEWRITER"],
+                    format="bitmap",
+                    justify="BEGIN",
+                ),
+            )
+        self.stats_text.string = self.stats.overlay_lines()
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadIdentity()
+        glPushAttrib(GL_ENABLE_BIT)
+        try:
+            glDisable(GL_DEPTH_TEST)
+            glDisable(GL_LIGHTING)
+            glDisable(GL_TEXTURE_2D)
+            glColor3f(1.0, 1.0, 0.0)
+            glTranslatef(-0.98, 0.94, 0)
+            self.stats_text.render(mode=mode)
+        finally:
+            glPopAttrib()
+            glPopMatrix()
+            glMatrixMode(GL_PROJECTION)
+            glPopMatrix()
+            glMatrixMode(GL_MODELVIEW)
 
 
 def get_options():
@@ -54,9 +114,35 @@ def get_options():
         "--bsp",
         default=None,
     )
+    parser.add_argument(
+        "-u",
+        "--unpack",
+        help="Unpack .pk3 files into the cache rather than reading them in place",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-r",
+        "--renderer",
+        help="Rendering backend, fixed-function arrays or shaders with vertex array objects",
+        choices=maprender.Map.BACKENDS,
+        default=maprender.Map.backend,
+    )
+    parser.add_argument(
+        "-s",
+        "--stats",
+        help="Record per-frame render statistics and show them (toggle with 'i')",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="Write per-frame render statistics to this file (.csv for CSV, otherwise JSON lines), without the overlay unless --stats is given",
+        default=None,
+    )
     parser.add_argument(
         "target",
-        help="A .bsp (or .pk3) file to (unpack and) parse",
+        help="A .bsp (or .pk3) file to parse",
     )
     return parser
 
@@ -65,21 +151,24 @@ def main():
     logging.basicConfig(level=logging.INFO)
     logging.getLogger("OpenGLContext.scenegraph.text").setLevel(logging.WARNING)
     options = get_options().parse_args()
-    target = options.target
-    if target.startswith("http://") or target.startswith("https://"):
-        from . import downloader
-
-        target = downloader.pull_pk3(target)
-    elif os.path.isfile(target) and (
-        target.lower().endswith(".pk3") or target.lower().endswith(".zip")
-    ):
-        from . import pk3
-
-        url = os.path.basename(target)
-        key = pk3.key(url)
-        directory = pk3.unpack_directory(key)
-        log.info("Unpacking PK3 to %s", directory)
-        target = pk3.unpack(target, directory, bsp_name=options.bsp)
-    else:
-        target = options.target
-    TwitchContext.ContextMainLoop(target=target)
+    target = pk3.resolve_target(
+        options.target, bsp_name=options.bsp, extract=options.unpack
+    )
+    stats = None
+    if options.stats or options.stats_file:
+        stream, format = None, "json"
+        if options.stats_file:
+            stream = open(options.stats_file, "w")
+            if options.stats_file.lower().endswith(".csv"):
+                format = "csv"
+        stats = renderstats.RenderStats(stream=stream, format=format)
+    try:
+        TwitchContext.ContextMainLoop(
+            target=target,
+            backend=options.renderer,
+            stats=stats,
+            show_stats=options.stats,
+        )
+    finally:
+        if stats is not None:
+            stats.close()
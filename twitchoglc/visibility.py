@@ -0,0 +1,260 @@
+"""Potentially-visible-set (PVS) and view-frustum culling for BSP maps
+
+The BSP tree (nodes/planes/leafs) is walked to find the leaf, and
+thus the cluster, which contains the camera.  The visdata lump is a
+bit-packed cluster x cluster table saying which clusters can possibly
+be seen from which other clusters, and the leaffaces lump maps each
+leaf to the faces which are (partially) inside it.  Together they let
+us produce a per-cluster mask of the faces which need to be rendered.
+
+The node and leaf bounding boxes are tested against the clipping 
+planes of the view frustum to produce a per-frame mask of leaves
+(and thus faces) which are on-screen.
+"""
+from __future__ import absolute_import
+import numpy, logging
+log = logging.getLogger( __name__ )
+
+def find_leaf( nodes, planes, position ):
+    """Walk the BSP tree to find the leaf containing position
+
+    nodes -- NODE_RECORD array
+    planes -- PLANE_RECORD array
+    position -- x,y,z coordinate in map space
+
+    returns index into the leafs array
+    """
+    index = 0
+    while index >= 0:
+        node = nodes[index]
+        plane = planes[node['plane']]
+        distance = numpy.dot( plane['normal'], position ) - plane['distance']
+        if distance >= 0:
+            index = node['children'][0]
+        else:
+            index = node['children'][1]
+    return -(index+1)
+
+def gather_ranges( source, starts, counts ):
+    """Gather source[start:start+count] for each start,count into one array
+
+    Uses repeat/cumsum rather than a Python loop over the ranges.
+
+    returns (gathered, owner) where owner is the index of the range
+    from which each gathered element was taken
+    """
+    counts = numpy.asarray( counts, dtype='i' )
+    total = int(numpy.sum( counts ))
+    owner = numpy.repeat( numpy.arange( len(counts), dtype='i' ), counts )
+    if not total:
+        return source[:0], owner
+    # shift from position-in-result to position-in-source for each range
+    shifts = numpy.asarray( starts, dtype='i' ) - (numpy.cumsum( counts ) - counts)
+    return source[numpy.arange( total, dtype='i' ) + shifts[owner]], owner
+
+def merge_ranges( starts, counts, groups=None ):
+    """Merge adjacent (start,count) ranges, dropping empty ones
+    
+    groups -- optional group id for each range, ranges in different 
+        groups are never merged
+    
+    returns (starts, counts, groups) of the merged ranges
+    """
+    starts = numpy.asarray( starts )
+    counts = numpy.asarray( counts )
+    keep = counts > 0
+    starts, counts = starts[keep], counts[keep]
+    if groups is not None:
+        groups = numpy.asarray( groups )[keep]
+    if not len(starts):
+        return starts, counts, groups
+    new_run = numpy.ones( starts.shape, dtype='?' )
+    new_run[1:] = starts[1:] != (starts[:-1] + counts[:-1])
+    if groups is not None:
+        new_run[1:] |= groups[1:] != groups[:-1]
+        groups = groups[new_run]
+    run = numpy.cumsum( new_run ) - 1
+    return (
+        starts[new_run], 
+        numpy.bincount( run, weights=counts ).astype( counts.dtype ), 
+        groups,
+    )
+
+class VisibilityTable( object ):
+    """Bit-packed cluster-to-cluster visibility from the visdata lump"""
+    def __init__( self, n_vecs, sz_vecs, vecs ):
+        self.n_clusters = int(n_vecs)
+        self.sz_vecs = int(sz_vecs)
+        self.bits = numpy.asarray( vecs ).view( 'B' ).reshape( (self.n_clusters,self.sz_vecs) )
+    def visible_clusters( self, cluster ):
+        """Boolean array of the clusters potentially visible from cluster
+
+        A negative cluster (camera outside of the map or inside a solid)
+        can see everything.
+        """
+        if cluster < 0 or cluster >= self.n_clusters:
+            return numpy.ones( (self.n_clusters,), dtype='?' )
+        return numpy.unpackbits(
+            self.bits[cluster], bitorder='little'
+        )[:self.n_clusters].astype( '?' )
+    def is_visible( self, source, target ):
+        """Can target cluster possibly be seen from source cluster?"""
+        if source < 0 or target < 0:
+            return True
+        return bool( self.bits[source,target>>3] & (1<<(target&7)) )
+
+def frustum_planes( matrix ):
+    """Extract the 6 normalized clipping planes from a model-projection matrix
+    
+    matrix -- 4x4 combined model-view-projection matrix, using the 
+        row-vector convention of OpenGLContext's mode.modelproj
+    
+    returns 6x4 array of (a,b,c,d) where a*x+b*y+c*z+d >= 0 inside the frustum
+    """
+    matrix = numpy.asarray( matrix, dtype='d' ).reshape( (4,4) )
+    w = matrix[:,3]
+    planes = numpy.array( [
+        w - matrix[:,0], # right
+        w + matrix[:,0], # left
+        w + matrix[:,1], # bottom
+        w - matrix[:,1], # top
+        w - matrix[:,2], # far
+        w + matrix[:,2], # near
+    ] )
+    magnitude = numpy.sqrt( numpy.sum( planes[:,:3]**2, -1 ) )
+    planes = planes[magnitude > 0] / magnitude[magnitude > 0,numpy.newaxis]
+    return planes.astype( 'f' )
+
+def boxes_outside( mins, maxs, planes ):
+    """Test which axis-aligned boxes are entirely outside any of the planes
+    
+    mins, maxs -- N x 3 arrays of box corners
+    planes -- P x 4 planes as from frustum_planes
+    
+    returns boolean array, True where the box can be culled
+    """
+    normals = planes[:,:3]
+    # the corner furthest along each plane's normal (N x P x 3)
+    corner = numpy.where( 
+        normals[numpy.newaxis,:,:] > 0, 
+        maxs[:,numpy.newaxis,:], 
+        mins[:,numpy.newaxis,:],
+    )
+    distance = numpy.sum( corner * normals, -1 ) + planes[:,3]
+    return numpy.any( distance < 0, -1 )
+
+def cull_leaves( leafs, planes ):
+    """Test every leaf's bounding box against planes at once
+    
+    returns boolean mask of leaves (at least partially) inside the frustum
+    """
+    return ~boxes_outside( 
+        leafs['mins'].astype( 'f' ), leafs['maxs'].astype( 'f' ), planes,
+    )
+
+def cull_tree( nodes, leafs, planes ):
+    """Walk the BSP tree, rejecting whole subtrees outside of planes
+    
+    The tree is processed a level at a time, testing all of the nodes 
+    at a given depth with one vectorized boxes_outside call, so the cost
+    is proportional to the number of nodes inside (or straddling) the 
+    frustum rather than the size of the map.
+    
+    returns boolean mask of leaves (at least partially) inside the frustum
+    """
+    visible = numpy.zeros( (len(leafs),), dtype='?' )
+    if not len(nodes):
+        visible[:] = True
+        return visible
+    frontier = numpy.array( [0], dtype='i' )
+    while len(frontier):
+        records = nodes[frontier]
+        inside = ~boxes_outside( 
+            records['mins'].astype( 'f' ), records['maxs'].astype( 'f' ), planes,
+        )
+        children = records['children'][inside].ravel()
+        leaf_ids = -(children[children < 0]+1)
+        leaf_records = leafs[leaf_ids]
+        visible[leaf_ids[~boxes_outside(
+            leaf_records['mins'].astype( 'f' ), leaf_records['maxs'].astype( 'f' ), planes,
+        )]] = True
+        frontier = children[children >= 0]
+    return visible
+
+class Visibility( object ):
+    """PVS and frustum culling for a loaded map
+
+    Caches the face mask for the most recently requested cluster, as
+    the camera normally stays inside a cluster for many frames.
+    """
+    def __init__( 
+        self, nodes, planes, leafs, leaffaces, visdata, n_faces, 
+        face_leaves=None, face_ids=None,
+    ):
+        """Initialize from the map's lumps
+        
+        face_leaves, face_ids -- previously calculated (leaf,face) pairs
+            (see twitchoglc.mapcache), calculated from leafs and leaffaces 
+            if not provided
+        """
+        self.nodes = nodes
+        self.planes = planes
+        self.leafs = leafs
+        self.n_faces = n_faces
+        self.table = VisibilityTable( *visdata ) if visdata is not None else None
+        if face_leaves is None or face_ids is None:
+            # flatten the leaf->face mapping to (leaf,face) pairs
+            face_ids, face_leaves = gather_ranges(
+                leaffaces, leafs['leafface'], leafs['n_leaffaces'],
+            )
+            in_map = leafs['cluster'][face_leaves] >= 0
+            face_leaves = face_leaves[in_map]
+            face_ids = face_ids[in_map]
+        self.face_leaves = face_leaves
+        self.face_ids = face_ids
+        self.face_clusters = leafs['cluster'][face_leaves]
+        # faces not in any leaf (e.g. brush models such as doors) are 
+        # never culled
+        self.unreferenced = numpy.ones( (n_faces,), dtype='?' )
+        self.unreferenced[face_ids] = False
+        self._cached = (None,None)
+    def find_leaf( self, position ):
+        """Find the leaf index containing position"""
+        if not len(self.nodes):
+            return 0
+        return find_leaf( self.nodes, self.planes, position )
+    def cluster( self, position ):
+        """Find the cluster containing position (-1 for outside the map)"""
+        if not len(self.leafs):
+            return -1
+        return int(self.leafs[self.find_leaf( position )]['cluster'])
+    def face_mask( self, cluster ):
+        """Boolean mask of faces potentially visible from cluster"""
+        if self._cached[0] == cluster:
+            return self._cached[1]
+        if self.table is None or cluster < 0:
+            mask = numpy.ones( (self.n_faces,), dtype='?' )
+        else:
+            clusters = self.table.visible_clusters( cluster )
+            # leafs can reference clusters beyond the vis table
+            valid = self.face_clusters < len(clusters)
+            visible = numpy.zeros( self.face_clusters.shape, dtype='?' )
+            visible[valid] = clusters[self.face_clusters[valid]]
+            mask = self.unreferenced.copy()
+            mask[self.face_ids[visible]] = True
+        self._cached = (cluster,mask)
+        return mask
+    def frustum_leaves( self, planes, hierarchical=True ):
+        """Boolean mask of leaves inside the frustum planes
+        
+        hierarchical -- if True walk the tree (cull_tree), otherwise test 
+            all of the leaves at once (cull_leaves)
+        """
+        if hierarchical:
+            return cull_tree( self.nodes, self.leafs, planes )
+        return cull_leaves( self.leafs, planes )
+    def leaf_face_mask( self, leaf_mask ):
+        """Boolean mask of faces in the leaves of leaf_mask"""
+        mask = self.unreferenced.copy()
+        mask[self.face_ids[leaf_mask[self.face_leaves]]] = True
+        return mask